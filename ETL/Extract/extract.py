@@ -11,10 +11,14 @@ root_directory = os.path.abspath(os.path.join(current_script_directory, os.pardi
 sys.path.append(root_directory)
 
 from PyUtilities.setupFunctions import read_config_file
+from ETL.Transform.planner import list_referenced_fields
 
 from redcap import Project
 import pandas as pd
 import logging
+import random
+import requests
+import threading
 
 # Configure logger
 workflow_logger = logging.getLogger('workflow_logger')
@@ -22,10 +26,29 @@ workflow_logger = logging.getLogger('workflow_logger')
 CONFIG_FILE_PATH = 'config.json'
 CONFIG = read_config_file(CONFIG_FILE_PATH)
 
+# Extraction snapshots (per extraction file, cleaned) and REDCap projects, kept warm between runs of a long-running process
+EXTRACTION_SNAPSHOTS = {}
+# Set by a long-running process (see workflow.run_daemon), the snapshots are only kept then
+KEEP_SNAPSHOTS = threading.Event()
+REDCAP_PROJECTS = {}
+# HTTP session of the exports, its connections are kept alive between requests
+REDCAP_SESSION = requests.Session()
+REDCAP_SESSION.headers.update({'Accept-Encoding': 'gzip, deflate'})
+# Limit of the extractions running at the same time, shared by all projects of the process
+EXTRACTION_SLOTS = threading.BoundedSemaphore(CONFIG.get('max_concurrent_extractions', 2))
+
 def extract_data():
   """
   Function to extract data from the source.
+  At most max_concurrent_extractions extractions (of different projects) run at the same time.
   """ 
+  with EXTRACTION_SLOTS:
+    return extract_project_data()
+
+def extract_project_data():
+  """
+  Function to extract data from the source, for the project of the config.
+  """
   # Check if extraction path is provided
   if CONFIG['extraction_path'] is None:
     workflow_logger.error("No extraction path was specified in the config file, no data will be extracted")
@@ -36,18 +59,38 @@ def extract_data():
   if CONFIG["extract_redcap"] is True:
     # Run function to download data from REDCap
     workflow_logger.info("Extracting data from REDCap")
-    data = extract_redcap_data()
+    data = clean_data(extract_redcap_data())
 
   ## DATA EXTRACTION from CSV
   else:
     # Check if CSV file exists
     try:
-      with open(CONFIG['extraction_path'], 'r') as file:
-        # Logic to read data from CSV using pandas
-        data = pd.read_csv(CONFIG['extraction_path'],dtype=str, index_col='index', encoding='utf-8', na_filter=False)
+      stat = os.stat(CONFIG['extraction_path'])
     except FileNotFoundError:
       workflow_logger.error(f"File not found at the specified extraction path: {CONFIG['extraction_path']}")
       exit()
+    # Only the rows of the fields referenced by the mapping tables are read
+    fields = select_fields()
+    # Reuse the snapshot of the previous run if the file (and the referenced fields) did not change since
+    signature = (stat.st_size, stat.st_mtime_ns, fields)
+    snapshot = EXTRACTION_SNAPSHOTS.get(CONFIG['extraction_path'])
+    if snapshot is not None and snapshot[0] == signature:
+      workflow_logger.info("Extraction file unchanged, reusing the extraction snapshot")
+      data = snapshot[1]
+      if is_subset_run():
+        id_col_name = data.columns[0]
+        data = data[data[id_col_name].isin(select_records(list(data[id_col_name].unique())))]
+    elif is_subset_run():
+      # Read only the rows of the records of the subset run
+      data = clean_data(read_csv_subset(CONFIG['extraction_path'], fields))
+    else:
+      # Logic to read data from CSV using pandas
+      data = clean_data(read_csv_fields(CONFIG['extraction_path'], fields))
+      # Only the cleaned data is kept, and only by a long-running process without a memory budget
+      if KEEP_SNAPSHOTS.is_set() and not CONFIG.get('memory_budget_mb'):
+        EXTRACTION_SNAPSHOTS[CONFIG['extraction_path']] = (signature, data)
+      else:
+        EXTRACTION_SNAPSHOTS.pop(CONFIG['extraction_path'], None)
   
     # check if data is empty
   if data.empty:
@@ -55,6 +98,27 @@ def extract_data():
     exit()
 
   workflow_logger.info(f"Data extracted:\n{data}")
+  workflow_logger.info(f"Data cleaned:{data[data.values == '{']}")
+  return data
+
+def clean_data(data):
+  """
+  Function to replace the characters which could disrupt the transformation, in all cells of the data:
+  all "'" and '"' with "`", all "(" with ".(" and ")" with ")." and, in the value column, all new lines with a space.
+  The data is cleaned in place, column by column, so no second copy of the extracted data is created.
+
+  Args:
+  data (pandas.DataFrame): The extracted data, it is changed.
+
+  Returns:
+  pandas.DataFrame: The cleaned data.
+  """
+  table = str.maketrans({"'": "`", '"': "`", "(": ".(", ")": ")."})
+  value_table = str.maketrans({"'": "`", '"': "`", "(": ".(", ")": ").", "\n": " "})
+  for column in data.columns:
+    if data[column].dtype == object:
+      column_table = value_table if column == 'value' else table
+      data[column] = data[column].map(lambda cell: cell.translate(column_table) if isinstance(cell, str) else cell)
   return data
 
 def extract_redcap_data():
@@ -71,35 +135,188 @@ def extract_redcap_data():
     exit()
   
   ## LOGIC to extract data from REDCap
-  api_url = CONFIG['redcap_api_address']
-  api_key = CONFIG['redcap_api_token']
-  project = Project(api_url, api_key)
+  project = get_redcap_project()
   workflow_logger.debug("Project variables defined")
-  # Download data from REDCap
-  data = project.export_records(format_type='json',
-                                records=None,
-                                fields=None, 
-                                forms=None, 
-                                events=None, 
-                                raw_or_label='label', 
-                                raw_or_label_headers='raw', 
-                                event_name='label', 
-                                record_type='eav', 
-                                export_survey_fields=False, 
-                                export_data_access_groups=False, 
-                                export_checkbox_labels=True, 
-                                filter_logic=None, 
-                                date_begin=None, 
-                                date_end=None, 
-                                decimal_character=None, 
-                                export_blank_for_gray_form_status=None, 
-                                df_kwargs=None) 
+  # Select the records of a subset run, from the list of all record IDs
+  records = None
+  if is_subset_run():
+    record_ids = [record[project.def_field] for record in project.export_records(format_type='json', fields=[project.def_field])]
+    records = select_records(list(dict.fromkeys(record_ids)))
+  # Only the fields referenced by the mapping tables (and the record ID) are downloaded
+  fields = select_fields()
+  if fields is not None:
+    fields = [project.def_field] + sorted(fields.intersection(project.field_names) - {project.def_field})
+    workflow_logger.info("Exporting %s of %s fields of the project", len(fields), len(project.field_names))
+  # Download data from REDCap, streamed to the extraction file
+  download_records(project, CONFIG['extraction_path'], records=records, fields=fields)
   workflow_logger.debug("Data acquired from REDCap API")
-  # Save data to a file using pandas
-  df = pd.DataFrame(data)
-  df.to_csv(CONFIG['extraction_path'],  index=True, index_label='index', encoding='utf-8')
   workflow_logger.info("Data saved to file: %s", CONFIG['extraction_path'])
-  return df
+  return read_csv_fields(CONFIG['extraction_path'])
+
+def download_records(project, extraction_path, records=None, fields=None, chunk_size=2**20):
+  """
+  Function to download the records of a REDCap project (EAV, labels) into an extraction file, without holding the export in memory.
+  The CSV export is streamed (compressed, over a kept-alive connection) into a download file next to the extraction file,
+  which is then converted in chunks into the extraction file (with an "index" column, see extract_project_data).
+
+  Args:
+  project (redcap.Project): The REDCap project.
+  extraction_path (str): The path to the extraction file.
+  records (list): Only export these record IDs, or None for all records.
+  fields (list): Only export these fields, or None for all fields.
+  chunk_size (int): The number of bytes written at once.
+
+  Returns:
+  int: The number of downloaded rows.
+  """
+  payload = {'token': project.token, 'content': 'record', 'format': 'csv', 'type': 'eav',
+             'rawOrLabel': 'label', 'rawOrLabelHeaders': 'raw', 'eventName': 'label',
+             'exportSurveyFields': 'false', 'exportDataAccessGroups': 'false', 'exportCheckboxLabel': 'true'}
+  for key, values in (('records', records), ('fields', fields)):
+    for number, value in enumerate(values or []):
+      payload[f'{key}[{number}]'] = value
+
+  download_path = extraction_path + '.download'
+  os.makedirs(os.path.dirname(extraction_path) or '.', exist_ok=True)
+  try:
+    with REDCAP_SESSION.post(project.url, data=payload, stream=True) as response:
+      if response.status_code != 200:
+        workflow_logger.error("REDCap export failed with status %s: %s", response.status_code, response.text[:500])
+        exit()
+      with open(download_path, 'wb') as file:
+        # iter_content decompresses the response body
+        for block in response.iter_content(chunk_size=chunk_size):
+          file.write(block)
+  except requests.RequestException as e:
+    workflow_logger.error("REDCap export failed: %s", e)
+    exit()
+
+  # Convert the export into the extraction file, chunk by chunk
+  rows = 0
+  try:
+    chunks = pd.read_csv(download_path, dtype=str, encoding='utf-8', na_filter=False, chunksize=100000)
+    with open(extraction_path + '.part', 'w', encoding='utf-8', newline='') as file:
+      for chunk in chunks:
+        chunk.index = pd.RangeIndex(rows, rows + len(chunk))
+        chunk.to_csv(file, index=True, index_label='index', header=rows == 0)
+        rows += len(chunk)
+  except pd.errors.EmptyDataError:
+    workflow_logger.error("REDCap export is empty")
+    exit()
+  os.replace(extraction_path + '.part', extraction_path)
+  os.remove(download_path)
+  workflow_logger.info("Rows exported from REDCap: %s", rows)
+  return rows
+
+def is_subset_run():
+  """
+  Function to check if the run is restricted to a subset of the records (subset_records, subset_sample or subset_first).
+  """
+  return bool(CONFIG.get('subset_records') or CONFIG.get('subset_sample') or CONFIG.get('subset_first'))
+
+def select_records(record_ids):
+  """
+  Function to select the records of a subset run:
+  the listed records (subset_records), a random sample of subset_sample records (reproducible with subset_seed)
+  or the first subset_first records.
+
+  Args:
+  record_ids (list): All record IDs, in the order of the source.
+
+  Returns:
+  list: The selected record IDs.
+  """
+  if CONFIG.get('subset_records'):
+    wanted = [str(record) for record in CONFIG['subset_records']]
+    missing = sorted(set(wanted) - set(record_ids))
+    if missing:
+      workflow_logger.warning("Records not found in the source: %s", missing)
+    selected = [record for record in wanted if record not in missing]
+  elif CONFIG.get('subset_sample'):
+    sample_size = min(CONFIG['subset_sample'], len(record_ids))
+    selected = random.Random(CONFIG.get('subset_seed')).sample(record_ids, sample_size)
+  else:
+    selected = record_ids[:CONFIG['subset_first']]
+  if not selected:
+    workflow_logger.error("No records selected for the subset run")
+    exit()
+  workflow_logger.info("Subset run with %s of %s records: %s", len(selected), len(record_ids), selected)
+  return selected
+
+def select_fields():
+  """
+  Function to select the fields to extract: the fields referenced by the mapping tables (see planner.list_referenced_fields).
+  With extract_all_fields, all fields are extracted.
+
+  Returns:
+  frozenset: The selected fields, or None for all fields.
+  """
+  if CONFIG.get('extract_all_fields'):
+    return None
+  return frozenset(list_referenced_fields())
+
+def read_csv_subset(csv_path, fields=None):
+  """
+  Function to read only the rows of the selected records (see select_records) from the extraction file.
+  The record IDs are read first, then the file is read in chunks and only the rows of the selected records are kept.
+
+  Args:
+  csv_path (str): The path to the extraction file.
+  fields (frozenset): Only keep the rows of these fields, or None for all fields.
+
+  Returns:
+  pandas.DataFrame: The data of the selected records.
+  """
+  id_col_name = pd.read_csv(csv_path, nrows=0, index_col='index', encoding='utf-8').columns[0]
+  record_ids = pd.read_csv(csv_path, usecols=[id_col_name], dtype=str, encoding='utf-8', na_filter=False)[id_col_name]
+  selected = set(select_records(list(record_ids.unique())))
+  chunks = pd.read_csv(csv_path, dtype=str, index_col='index', encoding='utf-8', na_filter=False, chunksize=100000)
+  return pd.concat(chunk[chunk[id_col_name].isin(selected) & (fields is None or chunk['field_name'].isin(fields))] for chunk in chunks)
+
+def read_csv_fields(csv_path, fields=None):
+  """
+  Function to read the rows of the selected fields (see select_fields) from the extraction file.
+  The file is read in chunks, so the rows of the other fields are never held all at once.
+
+  Args:
+  csv_path (str): The path to the extraction file.
+  fields (frozenset): Only keep the rows of these fields, or None for all fields.
+
+  Returns:
+  pandas.DataFrame: The data of the selected fields.
+  """
+  if fields is None:
+    return pd.read_csv(csv_path, dtype=str, index_col='index', encoding='utf-8', na_filter=False)
+  chunks = pd.read_csv(csv_path, dtype=str, index_col='index', encoding='utf-8', na_filter=False, chunksize=100000)
+  data = pd.concat(chunk[chunk['field_name'].isin(fields)] for chunk in chunks)
+  workflow_logger.info("Rows of the fields referenced by the mapping tables: %s", len(data))
+  return data
+
+def read_data_dictionary():
+  """
+  Function to read the fields of the REDCap data dictionary, to check the mapping tables against it:
+  from redcap_data_dictionary (a data dictionary file exported from REDCap, CSV) or, if the data is extracted from REDCap,
+  from the metadata of the project.
+
+  Returns:
+  set: The fields, or None if no data dictionary is available.
+  """
+  if CONFIG.get('redcap_data_dictionary'):
+    return set(pd.read_csv(CONFIG['redcap_data_dictionary'], dtype=str, usecols=[0], encoding='utf-8').iloc[:, 0].dropna())
+  if CONFIG['extract_redcap'] is True and CONFIG['redcap_api_address'] is not None and CONFIG['redcap_api_token'] is not None:
+    return set(get_redcap_project().field_names)
+  return None
+
+def get_redcap_project():
+  """
+  Function to get the REDCap project of the config file.
+  The project is created once and reused, so its lazily loaded metadata stays warm between runs.
+  """
+  api_url = CONFIG['redcap_api_address']
+  api_key = CONFIG['redcap_api_token']
+  if (api_url, api_key) not in REDCAP_PROJECTS:
+    REDCAP_PROJECTS[(api_url, api_key)] = Project(api_url, api_key)
+  return REDCAP_PROJECTS[(api_url, api_key)]
 
 # Extract program
 if __name__ == "__main__":
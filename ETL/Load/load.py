@@ -1,35 +1,95 @@
 from PyUtilities.setupFunctions import read_config_file
-from PyUtilities.databaseFunctions import create_database, execute_sql_script, data_check
+from PyUtilities.databaseFunctions import create_database, close_connections, delete_table_rows, execute_sql_script, execute_insert_statements, generate_parameterized_insert, resolve_search_values, coerce_values, deduplicate_rows, read_schema, read_column_types, merge_shard_database, is_batch_loaded, clear_loaded_batches
+from PyUtilities.stagingFunctions import staging_path, list_staged_entities, read_staged_rows, close_staging, assign_patient_shards, count_staged_rows
+from ETL.Transform.planner import compile_mapping_plan, find_search_lookups
+from ETL.Transform.transform_utils import clean_mapping_table
+from PyUtilities.journalFunctions import record_journal_event, is_journaled
 
+import collections
+import concurrent.futures
+import json
 import logging
+import multiprocessing
 import os
+import threading
 
 CONFIG_FILE_PATH = 'config.json'
 CONFIG = read_config_file(CONFIG_FILE_PATH)
 # Configure logger
 workflow_logger = logging.getLogger('workflow_logger')
 
-def load_data():
+# One lock per database, projects loading into the same database are loaded one after the other
+DATABASE_LOCKS = {}
+DATABASE_LOCKS_LOCK = threading.Lock()
+
+def load_data(journal=None, tables=None):
     """
     Function to load data into the destination database.
+    If the run resumes an interrupted run (see PyUtilities.journalFunctions), the database is not set up (wiped) again
+    and the batches which were already committed are skipped.
+    Projects of the same process which load into the same database wait for each other.
+
+    Args:
+    journal (dict): The run journal, or None.
+    tables (set): Only reload these tables (lower case): the database is kept and the rows of the tables are replaced.
+                  None to set up the database and load all tables.
+    """
+    with get_database_lock(CONFIG['db_path']):
+      load_project_data(journal, tables)
+
+def get_database_lock(db_path):
+    """
+    Function to get the lock of a database, it is created on first use.
+
+    Args:
+    db_path (str): The path to the database.
+
+    Returns:
+    threading.Lock: The lock of the database.
+    """
+    key = os.path.abspath(db_path) if db_path is not None else None
+    with DATABASE_LOCKS_LOCK:
+      return DATABASE_LOCKS.setdefault(key, threading.Lock())
+
+def load_project_data(journal=None, tables=None):
+    """
+    Function to load data into the destination database, for the project of the config.
+
+    Args:
+    journal (dict): The run journal, or None.
+    tables (set): Only reload these tables, see load_data.
     """
     ## DATABASE CREATION
-    workflow_logger.info("Database setup started.")
-    database_setup()
-    workflow_logger.info("Database setup completed.")
+    if is_journaled(journal, 'database_ready', CONFIG['db_path']):
+      workflow_logger.info("Database setup skipped, the database was already set up by the interrupted run.")
+    elif tables is not None:
+      # Only some tables are reloaded, the rows of the other tables stay in the database
+      deleted = delete_table_rows(CONFIG['db_path'], tables)
+      record_journal_event(journal, 'database_ready', CONFIG['db_path'])
+      workflow_logger.info("Rows of the reloaded tables deleted: %s", deleted)
+    else:
+      workflow_logger.info("Database setup started.")
+      database_setup()
+      record_journal_event(journal, 'database_ready', CONFIG['db_path'])
+      workflow_logger.info("Database setup completed.")
+
+    ## INDEXES FOR THE SRCH LOOKUPS
+    apply_index_file()
 
     ## DATA LOADING
     workflow_logger.info("Data loading started.")
-    load_data_into_database()
+    statistics = load_data_into_database(journal, tables is not None)
     workflow_logger.info("Data loaded into the database.")
 
     ## CHECK IF DATA LOADED
-    data_check(CONFIG['db_path'])
+    if statistics is not None:
+      validate_load_statistics(statistics)
 
 # Database setup Function
 def database_setup():
     """
     Function to create a new SQLite database if the config file specifies it.
+    The database is copied from the empty template database of the schema in {data_path}/Templates (see create_database).
     """
     # Check if a new database should be created
     if CONFIG['db_creation'] is True:
@@ -41,26 +101,59 @@ def database_setup():
       if CONFIG['db_schema'] is None:
         workflow_logger.error("No database schema (SQL file) was specified in the config file")
         exit()
+      template_dir = os.path.join(CONFIG['data_path'], 'Templates') if CONFIG['data_path'] is not None else None
       # Check if the database already exists
       if os.path.exists(CONFIG['db_path']):
         workflow_logger.warning("Database already exists: %s", CONFIG['db_path'])
         # Check if the database should be wiped
         if CONFIG['db_wipe'] is True:
-          create_database(CONFIG['db_path'], CONFIG['db_schema'], wipe=True)
+          create_database(CONFIG['db_path'], CONFIG['db_schema'], wipe=True, template_dir=template_dir)
           workflow_logger.info("Database wiped: %s", CONFIG['db_path'])
         else:
           workflow_logger.info("Database have not been wiped: %s", CONFIG['db_path'])
       else:
-        create_database(CONFIG['db_path'], CONFIG['db_schema'])
+        create_database(CONFIG['db_path'], CONFIG['db_schema'], template_dir=template_dir)
         workflow_logger.info("Database created: %s", CONFIG['db_path'])
 
+# Index file Function
+def apply_index_file():
+    """
+    Function to create the indexes of the index file before the data is loaded, if the config file specifies one.
+    The index file holds CREATE INDEX IF NOT EXISTS statements for the SRCH lookups of the mapping tables
+    (see PyUtilities/helpful_scripts/DataMappings_helper.py --indexes), it can be applied to an existing database again.
+    """
+    index_file = CONFIG.get('db_index_file')
+    if not index_file:
+      return
+    if not os.path.exists(index_file):
+      workflow_logger.error("The index file was not found: %s", index_file)
+      exit()
+    with open(index_file, 'r') as file:
+      result = execute_sql_script(file.read(), CONFIG['db_path'])
+    workflow_logger.info("Index file %s executed %s", index_file, result)
+
 # Load data into database Function
-def load_data_into_database():
+def load_data_into_database(journal=None, partial=False):
     """
     Function to load the data into the destination database.
     Check if the sqlite database is created.
-    Check if sql files are provided, in the Patients folder.
-    Execute the sql files to load the data into the database.
+    Check if rows are staged, in the staging database of the data folder (see PyUtilities.stagingFunctions).
+    Load the staged rows table by table, in the order of the mapping plan (referenced entities first),
+    reading the rows of each entity sequentially in batches of db_load_batch_size rows.
+    Duplicate rows (see deduplicate_rows) are dropped over all patients and mapping tables of an entity.
+    Every batch is loaded in one transaction and recorded as a committed batch in the run journal.
+    The batch is also recorded in the database, in the transaction of the batch (see record_loaded_batch), so a batch
+    committed just before a crash is not loaded again. These records are removed once all batches are loaded.
+    With db_load_shards > 1, the rows are loaded in parallel processes into shard databases, which are merged
+    into the database afterwards (see load_sharded). A run reloading only some tables is loaded without shards,
+    as the SRCH statements of a shard could not find the rows of the tables which stay in the database.
+
+    Args:
+    journal (dict): The run journal, or None.
+    partial (bool): True if only some tables are reloaded, see load_data.
+
+    Returns:
+    dict: The load statistics (see load_staged_entities) with the staged rows per table, or None if no data is loaded.
     """
 
     # Check if the data should be loaded into the database
@@ -69,39 +162,330 @@ def load_data_into_database():
       if CONFIG['data_path'] is None:
         workflow_logger.error("No data path was specified in the config file")
         exit()
-      # Check if there is a Patients folder in the data folder CONFIG["data_path"]}/Patients
-      if not os.path.exists(f"{CONFIG['data_path']}/Patients"):
-        workflow_logger.error("No Patients folder was found in the data path")
+      # Check if there is a staging database in the data folder
+      staging_db = staging_path(CONFIG['data_path'])
+      if not os.path.exists(staging_db):
+        workflow_logger.error("No staging database was found in the data path")
         exit()
-      # Check if there are any patient folder with sql files in the Patients folder
-      if not os.listdir(f"{CONFIG['data_path']}/Patients"):
-        workflow_logger.error("No patient folders were found in the Patients folder")
+      # Check if there are any staged rows in the staging database
+      entities = list_staged_entities(staging_db)
+      if not entities and partial:
+        workflow_logger.info("No staged rows for the reloaded tables")
+        return None
+      if not entities:
+        workflow_logger.error("No staged rows were found in the staging database")
         exit()
       # Check if the database path is valid
       if CONFIG['db_path'] is None:
         workflow_logger.error("No database path was specified in the config file")
         exit()
-      
-      # List all SQL files in the Patients folder and subfolders
-      sql_files = list_sql_files()
-    
-      # Execute the SQL files
-      for sql_file in sql_files:
-        with open(sql_file, 'r') as file:
-          sql = file.read()
-          # Execute the SQL
-          result = execute_sql_script(sql,CONFIG['db_path'])
-          workflow_logger.info("SQL file %s executed %s", sql_file, result)
 
+      schema = read_schema(CONFIG['db_schema']) if CONFIG['db_schema'] is not None else {}
+      batch_size = CONFIG.get('db_load_batch_size', 5000)
+
+      shard_count = CONFIG.get('db_load_shards', 1)
+      if shard_count > 1 and partial:
+        workflow_logger.info("Only some tables are reloaded, the rows are loaded without shards")
+        shard_count = 1
+      if shard_count > 1:
+        statistics = load_sharded(staging_db, entities, schema, batch_size, shard_count, journal)
+      else:
+        statistics = load_staged_entities(staging_db, entities, CONFIG['db_path'], schema, batch_size, journal)
+      statistics['staged'] = count_staged_rows(staging_db)
+      # All batches are loaded and recorded in the run journal, their records in the database are not needed anymore
+      if journal is not None:
+        clear_loaded_batches(CONFIG['db_path'])
+
+      close_staging(staging_db)
       workflow_logger.debug("Data loaded into SQLite Database")
+      return statistics
+
+def load_staged_entities(staging_db, entities, db_file, schema, batch_size, journal=None, shard=None):
+    """
+    Function to load the staged rows of the entities into a database, entity by entity in the given order.
+    The SRCH values of a batch are resolved set-based before it is loaded (see resolve_search_values),
+    then duplicate rows (see deduplicate_rows) are dropped over all patients and mapping tables of an entity,
+    the values are converted to the types of their columns in the schema (see coerce_values) and bound as parameters.
+    Every batch is loaded in one transaction, recorded as loaded in the database in the same transaction,
+    and then recorded as a committed batch in the run journal.
+    The outcome of every row is counted per table and per patient: attempted, inserted, ignored (as a duplicate)
+    and failed. The rows of batches committed by an interrupted run are counted as skipped.
+
+    Args:
+    staging_db (str): The path to the staging database.
+    entities (list): Tuples of (level, entity name) in load order, see list_staged_entities.
+    db_file (str): The path to the database.
+    schema (dict): The schema, as returned by read_schema.
+    batch_size (int): The number of rows per batch.
+    journal (dict): The run journal, or None.
+    shard (int): Only load the rows of the patients of this shard, or None for all rows.
+
+    Returns:
+    dict: The load statistics, with the keys tables (table (lower case) -> Counter) and patients (patient ID -> Counter).
+    """
+    statistics = {'tables': {}, 'patients': {}}
+    column_types = read_column_types(schema)
+    for level, entity_name in entities:
+      seen = set()
+      table_counts = statistics['tables'].setdefault(entity_name.lower(), collections.Counter())
+      for staged in read_staged_rows(staging_db, entity_name, batch_size, shard):
+        batch = f"{entity_name.lower()}:{staged[0][0]}-{staged[-1][0]}"
+        # Resolve the SRCH values first, keys with a value which is not found (NULL) are not deduplicated
+        resolved = resolve_search_values(db_file, entity_name, [row for _, _, row in staged], column_types)
+        # Deduplicate also the batches which are skipped, they hold the first occurrence of a key
+        rows, duplicates = deduplicate_rows(entity_name, resolved, schema, seen)
+        # Skip batches which were already committed by an interrupted run
+        if is_batch_committed(journal, db_file, batch):
+          table_counts['skipped'] += len(staged)
+          continue
+        # Execute the statements in one transaction, so a batch is either loaded completely or not at all
+        rows_to_load = coerce_values(rows, column_types.get(entity_name.lower()))
+        statements = [generate_parameterized_insert(entity_name, row, column_types) for row in rows_to_load]
+        outcomes = execute_insert_statements(statements, db_file, batch_key(journal, batch))
+        committed = isinstance(outcomes, list)
+
+        # Count the outcome of every staged row, the rows dropped by deduplicate_rows are ignored
+        kept = {id(row) for row in rows}
+        row_outcomes = iter(outcomes) if committed else None
+        batch_counts = collections.Counter()
+        for (_, patient_id, _), row in zip(staged, resolved):
+          if id(row) not in kept:
+            outcome = 'ignored'
+          else:
+            outcome = next(row_outcomes) if committed else 'failed'
+          batch_counts[outcome] += 1
+          statistics['patients'].setdefault(patient_id, collections.Counter()).update(('attempted', outcome))
+        batch_counts['attempted'] = len(staged)
+        table_counts.update(batch_counts)
+
+        workflow_logger.info("Batch %s (level %s): %s rows, %s inserted, %s ignored (%s dropped before), %s failed",
+                             batch, level, len(staged), batch_counts['inserted'], batch_counts['ignored'], duplicates, batch_counts['failed'])
+        if committed:
+          record_journal_event(journal, 'batch', batch)
+    return statistics
+
+def batch_key(journal, batch):
+    """
+    Function to get the key a batch is recorded with in the destination database (see record_loaded_batch).
+
+    Args:
+    journal (dict): The run journal, or None.
+    batch (str): The name of the batch.
+
+    Returns:
+    tuple: The run (the input hash of the journal) and the batch, or None without a journal.
+    """
+    return (journal['input_hash'], batch) if journal is not None else None
+
+def is_batch_committed(journal, db_file, batch):
+    """
+    Function to check if a batch was committed by an interrupted run: it is recorded in the run journal,
+    or, if the process stopped between the commit and the journal entry, in the destination database.
+
+    Args:
+    journal (dict): The run journal, or None.
+    db_file (str): The path to the database.
+    batch (str): The name of the batch.
+
+    Returns:
+    bool: True if the batch was committed.
+    """
+    if is_journaled(journal, 'batch', batch):
+      return True
+    return journal is not None and journal['resumed'] and is_batch_loaded(db_file, journal['input_hash'], batch)
+
+def load_sharded(staging_db, entities, schema, batch_size, shard_count, journal=None):
+    """
+    Function to load the staged rows in parallel: the patients are split into shard_count shards (see assign_patient_shards),
+    each shard is loaded in its own process into its own database ({data_path}/Shards), copied from the template database.
+    The shard databases are then merged one by one into the database (see merge_shard_database), every shard in one transaction.
+    Loaded and merged shards are recorded in the run journal, an interrupted run continues with the remaining shards.
+    A merge is also recorded in the database in its transaction, so a shard is never merged twice.
+    SRCH statements are resolved within the shard of the patient, so they have to find the rows of the same patient.
 
-def list_sql_files():
+    Args:
+    staging_db (str): The path to the staging database.
+    entities (list): Tuples of (level, entity name) in load order, see list_staged_entities.
+    schema (dict): The schema, as returned by read_schema.
+    batch_size (int): The number of rows per batch.
+    shard_count (int): The number of shards (and processes).
+    journal (dict): The run journal, or None.
+
+    Returns:
+    dict: The load statistics (see load_staged_entities). The table counters count the rows inserted into the database,
+          rows dropped in the merge (already in the database from another shard) are counted as ignored.
+          The patient counters count the rows inserted into the shard of the patient.
+    """
+    if CONFIG['db_schema'] is None:
+      workflow_logger.error("No database schema (SQL file) was specified in the config file, it is needed for the shards")
+      exit()
+    shard_path = os.path.join(CONFIG['data_path'], 'Shards')
+    template_dir = os.path.join(CONFIG['data_path'], 'Templates')
+    os.makedirs(shard_path, exist_ok=True)
+    shard_dbs = [os.path.join(shard_path, f'shard-{shard:03d}.db') for shard in range(shard_count)]
+
+    # Load the shards in parallel processes
+    shard_rows = assign_patient_shards(staging_db, shard_count)
+    workflow_logger.info("Staged rows per shard: %s", shard_rows)
+    statistics = {'tables': {}, 'patients': {}}
+    with concurrent.futures.ProcessPoolExecutor(shard_count, mp_context=multiprocessing.get_context('spawn')) as executor:
+      futures = {}
+      shard_results = []
+      for shard, shard_db in enumerate(shard_dbs):
+        # Skip shards which were already loaded by an interrupted run, their statistics are kept next to them
+        if is_journaled(journal, 'batch', f'shard-{shard:03d}') and os.path.exists(shard_db):
+          with open(f'{shard_db}.json', 'r') as file:
+            shard_results.append((shard, json.load(file)))
+          continue
+        futures[executor.submit(load_shard, staging_db, entities, shard_db, CONFIG['db_schema'], template_dir, batch_size, shard)] = shard
+      shard_inserted = {}
+      for shard, shard_statistics in shard_results + [(futures[future], future.result()) for future in concurrent.futures.as_completed(futures)]:
+        for key in ('tables', 'patients'):
+          for name, counts in shard_statistics[key].items():
+            statistics[key].setdefault(name, collections.Counter()).update(counts)
+        shard_inserted[shard] = {table: counts['inserted'] for table, counts in shard_statistics['tables'].items()}
+        workflow_logger.info("Shard %s: %s rows loaded", shard, sum(shard_inserted[shard].values()))
+        if shard in futures.values():
+          record_journal_event(journal, 'batch', f'shard-{shard:03d}')
+
+    # Merge the shards into the database, referenced tables first
+    tables = plan_shard_merge(schema, entities)
+    merged = True
+    for shard, shard_db in enumerate(shard_dbs):
+      if is_batch_committed(journal, CONFIG['db_path'], f'merge-{shard:03d}'):
+        continue
+      merge_counts = {}
+      result = merge_shard_database(CONFIG['db_path'], shard_db, tables, merge_counts, batch_key(journal, f'merge-{shard:03d}'))
+      workflow_logger.info("Shard %s merged %s", shard, result)
+      if result == "successfully.":
+        record_journal_event(journal, 'batch', f'merge-{shard:03d}')
+        # Rows of the shard which the database already held are ignored
+        for table, inserted in shard_inserted.get(shard, {}).items():
+          table_counts = statistics['tables'][table]
+          table_counts['inserted'] -= inserted - merge_counts.get(table, 0)
+          table_counts['ignored'] += inserted - merge_counts.get(table, 0)
+      else:
+        merged = False
+    # Remove the shards once all of them are merged
+    if merged:
+      for shard_db in shard_dbs:
+        for shard_file in (shard_db, f'{shard_db}.json'):
+          if os.path.exists(shard_file):
+            os.remove(shard_file)
+    return statistics
+
+def load_shard(staging_db, entities, shard_db, database_sql, template_dir, batch_size, shard):
     """
-    Function to list all SQL files in the Patients folder and subfolders.
+    Function to load the staged rows of the patients of one shard into a new shard database. [Code to be executed in the process]
+
+    Args:
+    staging_db (str): The path to the staging database.
+    entities (list): Tuples of (level, entity name) in load order, see list_staged_entities.
+    shard_db (str): The path to the shard database.
+    database_sql (str): The path to the SQL schema file.
+    template_dir (str): The directory of the template databases.
+    batch_size (int): The number of rows per batch.
+    shard (int): The shard.
+
+    Returns:
+    dict: The load statistics of the shard (see load_staged_entities).
     """
-    sql_files = []
-    for root, dirs, files in os.walk(f"{CONFIG['data_path']}/Patients"):
-      for file in files:
-        if file.endswith(".sql"):
-          sql_files.append(os.path.join(root, file))
-    return sql_files
\ No newline at end of file
+    create_database(shard_db, database_sql, wipe=True, template_dir=template_dir)
+    statistics = load_staged_entities(staging_db, entities, shard_db, read_schema(database_sql), batch_size, shard=shard)
+    close_staging(staging_db)
+    close_connections(shard_db)
+    # Keep the statistics with the shard, for a run which resumes after the shard was loaded
+    with open(f'{shard_db}.json', 'w') as file:
+      json.dump(statistics, file)
+    return statistics
+
+def validate_load_statistics(statistics):
+    """
+    Function to check the load statistics against the rows staged by the transformation and to report them,
+    without scanning the tables of the database.
+    Per table, every staged row has to be attempted (or skipped as loaded by an interrupted run) and every attempted row
+    has to be inserted, ignored or failed. Tables with failed rows or mismatching counters are logged as warnings,
+    as well as the patients with failed rows. The full report is written to {data_path}/load_report.json.
+
+    Args:
+    statistics (dict): The load statistics, as returned by load_data_into_database.
+
+    Returns:
+    bool: True if the counters of all tables match and no row failed.
+    """
+    valid = True
+    for table in sorted(set(statistics['staged']) | set(statistics['tables'])):
+      staged = statistics['staged'].get(table, 0)
+      counts = statistics['tables'].get(table, collections.Counter())
+      summary = (f"Table {table}: {staged} staged, {counts['attempted']} attempted, {counts['inserted']} inserted, "
+                 f"{counts['ignored']} ignored, {counts['failed']} failed, {counts['skipped']} skipped")
+      if counts['attempted'] + counts['skipped'] != staged or counts['inserted'] + counts['ignored'] + counts['failed'] != counts['attempted']:
+        workflow_logger.warning("Data check: counters do not match: %s", summary)
+        valid = False
+      elif counts['failed']:
+        workflow_logger.warning("Data check: %s", summary)
+        valid = False
+      else:
+        workflow_logger.info("Data check: %s", summary)
+
+    failed_patients = sorted(patient_id for patient_id, counts in statistics['patients'].items() if counts['failed'])
+    if failed_patients:
+      workflow_logger.warning("Data check: rows failed for %s patients: %s", len(failed_patients), failed_patients)
+
+    with open(os.path.join(CONFIG['data_path'], 'load_report.json'), 'w') as file:
+      json.dump({'valid': valid, 'staged': statistics['staged'],
+                 'tables': {table: dict(counts) for table, counts in statistics['tables'].items()},
+                 'patients': {patient_id: dict(counts) for patient_id, counts in statistics['patients'].items()}}, file, indent=1)
+    return valid
+
+def plan_shard_merge(schema, entities):
+    """
+    Function to describe how the tables of the shards are merged (see merge_shard_database), in load order.
+    A surrogate key is an INTEGER PRIMARY KEY which is not mapped from the data (e.g. AUTO), it gets new values in the merge.
+    The columns referencing a surrogate key, by a FOREIGN KEY clause or by a SRCH for the key, are remapped.
+
+    Args:
+    schema (dict): The schema, as returned by read_schema.
+    entities (list): Tuples of (level, entity name) in load order, see list_staged_entities.
+
+    Returns:
+    list: The tables, as expected by merge_shard_database.
+    """
+    # Find the mapped attributes and the SRCH references of every entity
+    mapped_attributes = {}
+    search_references = {}
+    for mapping_file, mapping in compile_mapping_plan()['mapping_tables']:
+      table = mapping["Table"].values[0].lower()
+      mapping = clean_mapping_table(mapping)
+      for attribute, field_name in zip(mapping["Attribute"], mapping["field_name"]):
+        mapped_attributes.setdefault(table, set()).add(attribute.lower())
+        for searched_table, searched, _ in find_search_lookups(field_name):
+          search_references.setdefault(table, {}).setdefault(attribute.lower(), (searched_table, searched.lower()))
+
+    surrogate_keys = {}
+    for table, info in schema.items():
+      primary_key = info['primary_key']
+      if len(primary_key) == 1 and info['types'][primary_key[0]].upper() == 'INTEGER' and primary_key[0].lower() not in mapped_attributes.get(table, set()):
+        surrogate_keys[table] = primary_key[0]
+
+    tables = []
+    for level, entity_name in entities:
+      table = entity_name.lower()
+      if table not in schema:
+        workflow_logger.warning("Shard merge: %s is not a table of the schema", entity_name)
+        continue
+      info = schema[table]
+      remap = {}
+      for column, referenced_table, referenced_column in info['foreign_keys']:
+        if referenced_table in surrogate_keys and (referenced_column is None or referenced_column.lower() == surrogate_keys[referenced_table].lower()):
+          remap[column] = referenced_table
+      for column in info['columns']:
+        searched_table, searched = search_references.get(table, {}).get(column.lower(), (None, None))
+        if searched_table in surrogate_keys and searched == surrogate_keys[searched_table].lower():
+          remap[column] = searched_table
+      if table in remap.values():
+        workflow_logger.warning("Shard merge: %s references itself, these references are not remapped", entity_name)
+        remap = {column: referenced_table for column, referenced_table in remap.items() if referenced_table != table}
+      tables.append({'name': info['name'], 'columns': info['columns'], 'surrogate_key': surrogate_keys.get(table),
+                     'unique': info['unique'], 'remap': remap})
+    return tables
@@ -0,0 +1,167 @@
+from PyUtilities.setupFunctions import read_config_file
+from ETL.Transform.transform_utils import clean_mapping_table, getAllOccurringAttributes
+from ETL.Transform.planner import compile_mapping_plan, select_mapping_files
+from ETL.Transform.table_transform import list_simple_mapping_files
+from ETL.Transform.transform import estimate_patient_costs, schedule_patients, TRANSFORM_POOL_SIZE
+
+import json
+import logging
+import math
+
+# load configuration file
+CONFIG_FILE_PATH = 'config.json'
+CONFIG = read_config_file(CONFIG_FILE_PATH)
+
+# Configure logger
+workflow_logger = logging.getLogger('workflow_logger')
+
+# Bytes a staged row needs besides its attributes and values (JSON syntax, patient ID, mapping file, index entries)
+ROW_OVERHEAD_BYTES = 64
+
+def estimate_run(data, tables=None):
+    """
+    This function estimates a run from the compiled mapping plan and cheap statistics over the extracted data
+    (the rows and the value lengths per field_name, the records and repeat instances having the fields of an entity),
+    without transforming or loading anything.
+    Per mapping table it estimates the rows (one per record, or per repeat instance, having a field of the entity,
+    one per value of the MULT field), the SRCH lookup subqueries (per row, one per SRCH of the mapping table)
+    and the bytes staged. The estimates are upper bounds, rows dropped by the NOT NULL and DROP rules are counted.
+    The layout of the run is reported with it: the levels of the plan, the column-wise and per-patient mapping tables,
+    the transform workers and tasks (see transform.schedule_patients) and the load batches and shards.
+
+    Args:
+    data (pandas.DataFrame): The extracted data.
+    tables (set): Only the mapping tables of these entities (lower case) are run, or None for all entities.
+
+    Returns:
+    dict: The report, with the keys tables (list of dicts per mapping table), totals, levels, transform and load.
+    """
+    plan = compile_mapping_plan()
+    id_col_name = data.columns[0]
+    keys = [id_col_name] + (['redcap_repeat_instance'] if 'redcap_repeat_instance' in data.columns else [])
+
+    # Statistics per field: the rows and the mean length of the values, and the instances (record, repeat) having the field
+    field_rows = data.groupby('field_name').size().to_dict()
+    field_lengths = data['value'].astype(str).str.len().groupby(data['field_name']).mean().to_dict()
+    field_instances = data[keys + ['field_name']].drop_duplicates()
+
+    # The mapping tables of the run (see transform.transform_data)
+    skipped_mapping_files = set()
+    if CONFIG.get('subset_tables'):
+        selected_mapping_files = select_mapping_files(CONFIG['subset_tables'])
+        skipped_mapping_files = {mapping_file for mapping_file, _ in plan['mapping_tables'] if mapping_file not in selected_mapping_files}
+    elif tables is not None:
+        skipped_mapping_files = {mapping_file for mapping_file, mapping in plan['mapping_tables'] if mapping["Table"].values[0].lower() not in tables}
+    simple_files = list_simple_mapping_files()
+    batch_size = CONFIG.get('db_load_batch_size', 5000)
+
+    report_tables = []
+    for mapping_file, mapping in plan['mapping_tables']:
+        if mapping_file in skipped_mapping_files:
+            continue
+        entity_name = mapping["Table"].values[0]
+        mapping = clean_mapping_table(mapping)
+        field_names = list(mapping["field_name"])
+        fields = set(getAllOccurringAttributes(field_names))
+        instances = len(field_instances.loc[field_instances['field_name'].isin(fields), keys].drop_duplicates())
+        mult_fields = [field_name.split("MULT(")[1].split(")")[0] for field_name in field_names if 'MULT' in field_name]
+        rows = field_rows.get(mult_fields[0], 0) if mult_fields else instances
+        lookups = sum(field_name.count("SRCH(") for field_name in field_names)
+        row_bytes = ROW_OVERHEAD_BYTES + sum(len(attribute) + estimate_value_length(field_name, field_lengths)
+                                             for attribute, field_name in zip(mapping["Attribute"], field_names))
+        report_tables.append({
+            'table': entity_name,
+            'mapping_file': mapping_file,
+            'level': plan['entity_levels'][entity_name.lower()],
+            'transform': 'column-wise' if mapping_file in simple_files else 'per patient',
+            'rows': rows,
+            'mult_expansions': rows if mult_fields else 0,
+            'srch_lookups': rows * lookups,
+            'staged_bytes': int(rows * row_bytes),
+            'load_batches': math.ceil(rows / batch_size),
+        })
+
+    totals = {key: sum(table[key] for table in report_tables) for key in ('rows', 'mult_expansions', 'srch_lookups', 'staged_bytes', 'load_batches')}
+
+    # The transform tasks of the patients, as they would be scheduled
+    patient_files = {table['mapping_file'] for table in report_tables if table['transform'] == 'per patient'}
+    skip_mapping_files = frozenset(mapping_file for mapping_file, _ in plan['mapping_tables'] if mapping_file not in patient_files)
+    processes = CONFIG.get('transform_processes')
+    workers = processes or TRANSFORM_POOL_SIZE
+    records = list(data[id_col_name].unique())
+    tasks = schedule_patients(records, estimate_patient_costs(data, data.groupby(id_col_name, sort=False, dropna=False).indices), skip_mapping_files, workers) if patient_files else []
+
+    return {
+        'tables': report_tables,
+        'totals': totals,
+        'levels': [[table for table in level if any(entry['table'].lower() == table for entry in report_tables)] for level in plan['levels']],
+        'transform': {
+            'workers': f"{processes} processes" if processes else f"{TRANSFORM_POOL_SIZE} threads",
+            'patients': len(records),
+            'tasks': len(tasks),
+            'split_patients': len(tasks) - len({record for record, _ in tasks}),
+        },
+        'load': {
+            'batch_size': batch_size,
+            'shards': CONFIG.get('db_load_shards', 1),
+            'database': CONFIG['db_path'],
+            'tables': 'all' if tables is None else sorted(tables),
+        },
+    }
+
+def estimate_value_length(field_name, field_lengths):
+    """
+    This function estimates the length of the value of a mapping expression in a staged row.
+    A field has the mean length of its values, a SET_ its constant, other expressions (e.g. SRCH statements)
+    are estimated with the length of the expression and the mean length of the values of the fields they reference.
+
+    Args:
+    field_name (str): The mapping expression.
+    field_lengths (dict): Per field the mean length of its values.
+
+    Returns:
+    float: The estimated length.
+    """
+    if field_name in field_lengths:
+        return field_lengths[field_name]
+    if field_name[:4] == "SET_":
+        return len(field_name) - 6
+    return len(field_name) + sum(field_lengths.get(field, 0) for field in getAllOccurringAttributes([field_name]))
+
+def format_estimate(report):
+    """
+    This function formats the report of estimate_run as text.
+
+    Args:
+    report (dict): The report.
+
+    Returns:
+    str: The report as a table, followed by the layout of the run.
+    """
+    columns = ('level', 'table', 'mapping_file', 'transform', 'rows', 'mult_expansions', 'srch_lookups', 'staged_bytes', 'load_batches')
+    lines = [[str(table[column]) for column in columns] for table in report['tables']]
+    lines.append(['', 'total', '', ''] + [str(report['totals'][column]) for column in columns[4:]])
+    widths = [max(len(column), *(len(line[number]) for line in lines)) for number, column in enumerate(columns)]
+    text = ['  '.join(column.ljust(width) for column, width in zip(columns, widths))]
+    text.extend('  '.join(value.ljust(width) for value, width in zip(line, widths)) for line in lines)
+    text.append(f"Stages: {' -> '.join(str(level) for level in report['levels'] if level)}")
+    text.append(f"Transform: {report['transform']['patients']} patients in {report['transform']['tasks']} tasks "
+                f"({report['transform']['split_patients']} split by entity) on {report['transform']['workers']}")
+    text.append(f"Load: {report['totals']['load_batches']} batches of {report['load']['batch_size']} rows, "
+                f"{report['load']['shards']} shard(s), tables {report['load']['tables']} into {report['load']['database']}")
+    return '\n'.join(text)
+
+def write_estimate(report, report_path):
+    """
+    This function writes the report of estimate_run as JSON.
+
+    Args:
+    report (dict): The report.
+    report_path (str): The path to the report file.
+
+    Returns:
+    None
+    """
+    with open(report_path, 'w') as file:
+        json.dump(report, file, indent=2, default=str)
+    workflow_logger.info("Dry run report written: %s", report_path)
@@ -0,0 +1,164 @@
+from PyUtilities.setupFunctions import read_config_file, read_mapping_tables
+from PyUtilities.databaseFunctions import read_schema
+from ETL.Transform.transform_utils import parse_arguments
+
+import logging
+import re
+import sys
+
+# load configuration file
+CONFIG_FILE_PATH = 'config.json'
+CONFIG = read_config_file(CONFIG_FILE_PATH)
+
+# Configure logger
+workflow_logger = logging.getLogger('workflow_logger')
+
+# Functions of the mapping expressions, with their number of arguments (None: checked by the function)
+FUNCTIONS = {"SET_": 1, "LIST": 1, "GLOB": 1, "MULT": 1, "SRCH": None, "__IF": 4}
+# Fields REDCap adds to the data, they are not in the data dictionary
+REDCAP_FIELD = re.compile(r"^redcap_\w+$|^\w+_complete$")
+# Checkbox fields are exported as <field>___<code>
+CHECKBOX_SUFFIX = re.compile(r"___\w+$")
+# Literal values (quoted text or numbers), e.g. the searched values of a SRCH
+LITERAL = re.compile(r"^'[^']*'$|^\"[^\"]*\"$|^[+-]?(?:\d+\.?\d*|\.\d+)$")
+
+def validate_mappings(field_names=None):
+    """
+    This function checks the mapping tables of mapping_path before the run, so errors do not show up per patient or at load time.
+    Every field_name expression is checked against the grammar of the mapping expressions (see check_expression),
+    the tables and attributes against the db_schema and, if given, the REDCap fields against the data dictionary.
+    All errors are logged, the run is aborted if there is one.
+
+    Args:
+    field_names (set): The fields of the REDCap data dictionary, or None to skip the check of the fields.
+
+    Returns:
+    None
+    """
+    errors = []
+    schema = read_schema(CONFIG['db_schema']) if CONFIG['db_schema'] is not None else None
+    for mapping_file, mapping in read_mapping_tables(CONFIG['mapping_path']):
+        errors.extend(f"{mapping_file}: {error}" for error in check_mapping_table(mapping, schema, field_names))
+    if errors:
+        for error in errors:
+            workflow_logger.error("Mapping check: %s", error)
+        workflow_logger.error("Mapping check: %s errors in the mapping tables, the run is aborted", len(errors))
+        sys.exit(1)
+    workflow_logger.info("Mapping check: mapping tables are valid")
+
+def check_mapping_table(mapping, schema=None, field_names=None):
+    """
+    This function checks ONE mapping table.
+
+    Args:
+    mapping (pandas.DataFrame): The mapping data of ONE entity.
+    schema (dict): The schema, as returned by read_schema, or None to skip the checks against the schema.
+    field_names (set): The fields of the REDCap data dictionary, or None to skip the check of the fields.
+
+    Returns:
+    list: The errors (str).
+    """
+    missing = [column for column in ("Table", "Attribute", "NotNull", "field_name") if column not in mapping.columns]
+    if missing:
+        return [f"missing columns {missing}"]
+    errors = []
+    tables = set(mapping["Table"].dropna())
+    if len(tables) != 1:
+        errors.append(f"one table per mapping table expected, found {sorted(tables)}")
+    table = schema.get(str(mapping["Table"].values[0]).lower()) if schema is not None else None
+    if schema is not None and table is None:
+        errors.append(f"table {mapping['Table'].values[0]} is not in the schema")
+    if table is not None:
+        columns = {column.lower() for column in table['columns']}
+        for attribute in mapping["Attribute"]:
+            if str(attribute).lower() not in columns:
+                errors.append(f"attribute {attribute} is not a column of the table {table['name']}")
+
+    for row_number, (attribute, field_name) in enumerate(zip(mapping["Attribute"], mapping["field_name"]), 2):
+        # AUTO attributes are left to the database (a misspelled "Auto" is not found in the data and left out as well)
+        if not isinstance(field_name, str) or field_name.strip().upper() == "AUTO" or "AUTO" in field_name:
+            continue
+        errors.extend(f"line {row_number} ({attribute}): {error}" for error in check_expression(field_name, schema, field_names))
+    return errors
+
+def check_expression(expression, schema=None, field_names=None):
+    """
+    This function checks a mapping expression (a field_name of a mapping table) against the grammar:
+    expression := field | literal | DROP... | SET_(value) | LIST(field) | GLOB(field) | MULT(field)
+                | SRCH(attribute, table, (attribute, expression)+) | __IF(expression, expression, expression, expression)
+    literal := 'text' | "text" | number
+    The parentheses have to be balanced, the searched tables and attributes have to be in the schema
+    and the fields in the data dictionary.
+
+    Args:
+    expression (str): The mapping expression.
+    schema (dict): The schema, as returned by read_schema, or None to skip the checks against the schema.
+    field_names (set): The fields of the REDCap data dictionary, or None to skip the check of the fields.
+
+    Returns:
+    list: The errors (str).
+    """
+    expression = expression.strip()
+    if not expression:
+        return ["empty expression"]
+    depth = 0
+    for char in expression:
+        depth += (char == "(") - (char == ")")
+        if depth < 0:
+            return [f"unbalanced parentheses in {expression}"]
+    if depth != 0:
+        return [f"unbalanced parentheses in {expression}"]
+
+    if LITERAL.match(expression):
+        return []
+    function = expression[:4]
+    if function == "DROP":
+        return []
+    if function not in FUNCTIONS:
+        if "(" in expression or "," in expression:
+            return [f"unknown function in {expression}"]
+        return check_field(expression, field_names)
+    if expression[4:5] != "(" or expression[-1] != ")":
+        return [f"{function} expects {function}(...), found {expression}"]
+    if function == "SET_":
+        return []
+
+    arguments = parse_arguments(expression)
+    if FUNCTIONS[function] is not None and len(arguments) != FUNCTIONS[function]:
+        return [f"{function} expects {FUNCTIONS[function]} arguments, found {len(arguments)} in {expression}"]
+    if function in ("LIST", "GLOB", "MULT"):
+        return check_field(arguments[0], field_names)
+    if function == "__IF":
+        return [error for argument in arguments for error in check_expression(argument, schema, field_names)]
+
+    # SRCH(attribute, table, (attribute, expression)+)
+    if len(arguments) < 4 or len(arguments) % 2 != 0:
+        return [f"SRCH expects an attribute, a table and pairs of attribute and value, found {len(arguments)} arguments in {expression}"]
+    errors = []
+    if schema is not None:
+        table = schema.get(arguments[1].lower())
+        if table is None:
+            errors.append(f"SRCH table {arguments[1]} is not in the schema")
+        else:
+            columns = {column.lower() for column in table['columns']}
+            errors.extend(f"SRCH attribute {attribute} is not a column of the table {table['name']}"
+                          for attribute in (arguments[0],) + arguments[2::2] if attribute.lower() not in columns)
+    for argument in arguments[3::2]:
+        errors.extend(check_expression(argument, schema, field_names))
+    return errors
+
+def check_field(field, field_names=None):
+    """
+    This function checks if a field is in the REDCap data dictionary.
+    Checkbox fields (<field>___<code>) and the fields REDCap adds (redcap_*, <form>_complete) are accepted.
+
+    Args:
+    field (str): The field.
+    field_names (set): The fields of the data dictionary, or None to skip the check.
+
+    Returns:
+    list: The errors (str).
+    """
+    if field_names is None or field in field_names or CHECKBOX_SUFFIX.sub("", field) in field_names or REDCAP_FIELD.match(field):
+        return []
+    return [f"field {field} is not in the REDCap data dictionary"]
@@ -1,9 +1,10 @@
-from PyUtilities.setupFunctions import read_config_file, csvs_reader
-from PyUtilities.databaseFunctions import generate_insert_statement
-from ETL.Transform.transform_utils import drop_rows_with_NULL, getRedCapValueROW, getAllOccurringAttributes
+from PyUtilities.setupFunctions import read_config_file
+from PyUtilities.stagingFunctions import stage_rows, staging_path
+from PyUtilities.memoryFunctions import over_memory_budget
+from ETL.Transform.transform_utils import clean_mapping_table, drop_rows_with_NULL, getRedCapValueROW, getAllOccurringAttributes, MultInstance
+from ETL.Transform.planner import compile_mapping_plan
 
 import logging
-import os
 import pandas as pd
 
 # load configuration file
@@ -13,66 +14,76 @@ CONFIG = read_config_file(CONFIG_FILE_PATH)
 # Configure logger
 workflow_logger = logging.getLogger('workflow_logger')
 
-def transform_patient(patient_df):
+def transform_patient(patient_df, skip_mapping_files=frozenset()):
     """
-    This function creates import-sqls for a patient. [Code to be executed in the thread]
-    It creates patient-specific log files and logs the creation of the SQLs.
-    Creates a initial SQL file for the patient.
-    The CSVs reader is used to read the mapping files one by one and process them. One mapping file corresponds to one entity.
-    It calls the create_imports_entity function to create import-sqls for each entity.
+    This function creates the rows of a patient. [Code to be executed in the thread]
+    It logs the creation of the rows to the shared patient log (see transform.setup_patient_logger), tagged with the patient ID.
+    The mapping files are processed one by one in the order of the mapping plan (dependencies first). One mapping file corresponds to one entity.
+    It calls the create_imports_entity function to create the rows for each entity.
+    Mapping files which are transformed column-wise for all patients (see table_transform) are skipped.
+    All rows of the patient are staged in one transaction (see PyUtilities.stagingFunctions),
+    with a memory budget (memory_budget_mb) the rows are staged earlier, after an entity, if the process is over the budget.
 
     Args:
     patient_df (pandas.DataFrame): The ONE patient data.
+    skip_mapping_files (frozenset): The filenames of the mapping tables to skip.
+
+    Returns:
+    int: The number of staged rows.
     """
     # Get the patient ID
     id_col_name = patient_df.columns[0]
     patient_id = patient_df[id_col_name].values[0]
-    workflow_logger.info("PATIENT: Prepare Import script Patient %s", patient_id)
-
-    # check if data directory exists or create it
-    if not os.path.exists(f'{CONFIG["data_path"]}/Patients/Patient-{patient_id}'):
-        os.makedirs(f'{CONFIG["data_path"]}/Patients/Patient-{patient_id}')
+    workflow_logger.info("PATIENT: Prepare rows of Patient %s", patient_id)
 
-    # Create the patient-specific SQL file
-    with open(f'{CONFIG["data_path"]}/Patients/Patient-{patient_id}/Patient-{patient_id}.sql', 'w') as f:
-        f.write(f'-- Patient: {patient_id}\n')
-        
     ## SETUP Patient LOGGING
-    # Configure patient logger only for file logging not for console logging
-    plogger = logging.getLogger(f'PatientLogger{patient_id}')
-    plogger.setLevel(logging.DEBUG)
-    plogger.propagate = False  # Prevent propagation to the root logger
-    file_patient = logging.FileHandler(f'{CONFIG["data_path"]}/Patients/Patient-{patient_id}/Patient-{patient_id}.log')
-    formatter = logging.Formatter('%(asctime)-20s - %(levelname)-10s - %(filename)-25s - %(funcName)-25s %(message)-50s')
-    file_patient.setFormatter(formatter)
-    plogger.addHandler(file_patient)
+    # The patient log is shared by all patients, every line carries the patient ID
+    plogger = logging.LoggerAdapter(get_patient_logger(), {'patient_id': patient_id})
     plogger.info("PATIENT %s", patient_id)
 
-    # Read CSVs and create a generator
-    csv_mapping_reader = csvs_reader(CONFIG['mapping_path'])
-
-    # Use a while loop to read and process each CSV file
-    while True:
-        try:
-            entity_df = next(csv_mapping_reader)
-            plogger.info("------------------------------------")
-            plogger.info("ENTITY: Start SQL creation of entity: %s",entity_df["Table"][0])
-            create_imports_entity(patient_df,entity_df,plogger)
-            plogger.info("------------------------------------")
-        except StopIteration:
-            break
-    
-    # Log the completion of the import script for the patient
-    plogger.info("PATIENT: Import script for Patient %s is ready", patient_id)
-
-    # Close the patient-specific log file
-    file_patient.close()
-
+    # Cache for mapping expressions which do not change within the patient (e.g. GLOB values)
+    patient_cache = {}
+
+    # Process the (cached) mapping tables in the order of the mapping plan
+    plan = compile_mapping_plan()
+    staged_rows = []
+    number_of_rows = 0
+    for mapping_file, entity_df in plan['mapping_tables']:
+        if mapping_file in skip_mapping_files:
+            continue
+        entity_name = entity_df["Table"].values[0]
+        plogger.info("------------------------------------")
+        plogger.info("ENTITY: Start SQL creation of entity: %s (%s)",entity_name,mapping_file)
+        level = plan['entity_levels'][entity_name.lower()]
+        for row in create_imports_entity(patient_df,entity_df,plogger,patient_cache):
+            staged_rows.append((level, entity_name, mapping_file, patient_id, row))
+        plogger.info("------------------------------------")
+        # Spill the rows to the staging database if the memory budget is reached
+        if staged_rows and over_memory_budget(CONFIG.get('memory_budget_mb')):
+            number_of_rows += stage_rows(staging_path(CONFIG["data_path"]), staged_rows)
+            staged_rows = []
+
+    # Stage the rows of the patient in one transaction
+    number_of_rows += stage_rows(staging_path(CONFIG["data_path"]), staged_rows)
+
+    # Log the completion of the rows for the patient
+    plogger.info("PATIENT: %s rows of Patient %s are staged", number_of_rows, patient_id)
+    return number_of_rows
+
+
+
+def get_patient_logger():
+    """
+    This function returns the patient logger of the project, see transform.setup_patient_logger.
 
+    Returns:
+    logging.Logger: The patient logger.
+    """
+    return logging.getLogger(f'patient_logger[{CONFIG["data_path"]}]')
 
-def create_imports_entity(patient_df,mapping,plogger):
+def create_imports_entity(patient_df,mapping,plogger,patient_cache=None):
     """
-    This function creates all import-sqls for an entity.
+    This function creates all rows of an entity.
     It creates a subset of the patient data based on the found attributes in the mapping file.
     It checks if the subset is empty and logs a warning if it is.
     It checks if the subset contains the 'redcap_repeat_instance' column.
@@ -84,16 +95,18 @@ def create_imports_entity(patient_df,mapping,plogger):
     patient_df (pandas.DataFrame): The patient data.
     mapping (pandas.DataFrame): The mapping data of ONE entity.
     plogger (logging.Logger): The logger for the patient.
+    patient_cache (dict): Cache for values which do not change within the patient.
+
+    Yields:
+    dict: The rows (attribute -> value) of the entity, one at a time.
     """
     # Start import of entity
     plogger.debug("------------------------------------")
     plogger.debug("ENTITY: Start SQL creation of entity: %s",mapping["Table"][0])
     plogger.debug("------------------------------------")
 
-    # shorten mapping table / Drop those which are not assigned
-    mapping = mapping.dropna(subset=['field_name'])
-    # clean mapping table
-    mapping = mapping[~mapping["field_name"].str.contains('AUTO', case=True)]
+    # shorten mapping table / Drop those which are not assigned and AUTO
+    mapping = clean_mapping_table(mapping)
 
     if mapping.empty:
         plogger.warning(f"ENTITY: No field_name in mapping table (after dropna & AUTO remove) for entity: {mapping['Table'][0]}")
@@ -111,7 +124,9 @@ def create_imports_entity(patient_df,mapping,plogger):
     # Check if the patient_subset_df contains the 'redcap_repeat_instance' column
     if 'redcap_repeat_instance' not in patient_subset_df.columns:
         plogger.debug("ENTITY: No repeats found")
-        build_SQL_for_single_entity(patient_subset_df,patient_df,mapping,plogger)
+        row = build_SQL_for_single_entity(patient_subset_df,patient_df,mapping,plogger,patient_cache)
+        if row:
+            yield row
         return
     
     # Otherwise, the patient_subset_df contains the 'redcap_repeat_instance' column
@@ -120,12 +135,12 @@ def create_imports_entity(patient_df,mapping,plogger):
     plogger.debug("ENTITY: How many repeats: %s",len(repeats))
     # each repeat creates a single entity in SQLite
     for num, repeat in repeats:
-        create_imports_repeat(num,repeat,patient_df,mapping,plogger)
+        yield from create_imports_repeat(num,repeat,patient_df,mapping,plogger,patient_cache)
     plogger.debug("------------------------------------")
 
-def create_imports_repeat(num,entity_repeat,patient_df,mapping,plogger):
+def create_imports_repeat(num,entity_repeat,patient_df,mapping,plogger,patient_cache=None):
     """
-    This function creates all import-sqls for a repeat.
+    This function creates all rows for a repeat.
     It checks if the mapping file contains a 'MULT' field.
     If it contains a 'MULT' field, it splits the DataFrame based on the 'MULT' field.
     It then calls the build_SQL_for_single_entity function for each split.
@@ -137,6 +152,10 @@ def create_imports_repeat(num,entity_repeat,patient_df,mapping,plogger):
     patient_df (pandas.DataFrame): The patient data.
     mapping (pandas.DataFrame): The mapping data of ONE entity.
     plogger (logging.Logger): The logger for the patient.
+    patient_cache (dict): Cache for values which do not change within the patient.
+
+    Returns:
+    iterable: The rows (dicts of attribute -> value) of the repeat, the rows of a MULT entity are generated one at a time.
     """
     plogger.debug("REPEAT: import entity %s \tNumber: %s",mapping["Table"].values[0],num)
     plogger.debug("REPEAT: \n%s",entity_repeat)
@@ -146,27 +165,32 @@ def create_imports_repeat(num,entity_repeat,patient_df,mapping,plogger):
         # build and import multiple entities
         plogger.debug("REPEAT: MULT found")
         plogger.debug("REPEAT: MappingTable: \n%s",mapping)
-        build_SQL_for_multiple_entity(entity_repeat,patient_df,mapping,plogger)
-        
+        return build_SQL_for_multiple_entity(entity_repeat,patient_df,mapping,plogger,patient_cache)
+
     else:
         # build and import single entity
         plogger.debug("REPEAT: No MULT found")
         plogger.debug("REPEAT: MappingTable: \n%s",mapping)
-        build_SQL_for_single_entity(entity_repeat,patient_df,mapping,plogger)
+        row = build_SQL_for_single_entity(entity_repeat,patient_df,mapping,plogger,patient_cache)
+        return [row] if row else []
 
-def build_SQL_for_multiple_entity(multi_entity_repeat,patient_df,mapping,plogger):
+def build_SQL_for_multiple_entity(multi_entity_repeat,patient_df,mapping,plogger,patient_cache=None):
     """
-    This function creates all import-sqls for multiple entities.
+    This function creates all rows for multiple entities, one at a time.
     It gets the 'MULT' field from the mapping file.
     It splits the DataFrame based on the 'MULT' field.
-    It creates a DataFrame for each row with the 'MULT' field.
-    It calls the build_SQL_for_single_entity function for each resulting DataFrame.
+    It creates an instance for each row with the 'MULT' field (see iter_mult_instances).
+    It calls the build_SQL_for_single_entity function for each instance.
 
     Args:
     multi_entity_repeat (pandas.DataFrame): The repeat data.
     patient_df (pandas.DataFrame): The patient data.
     mapping (pandas.DataFrame): The mapping data of ONE entity.
     plogger (logging.Logger): The logger for the patient.
+    patient_cache (dict): Cache for values which do not change within the patient.
+
+    Yields:
+    dict: The row (attribute -> value) of each entity.
     """
     plogger.debug("REPEAT: MULT found")
     # get the MULT field | Specify the value in the 'fieldname' column to consider
@@ -174,36 +198,39 @@ def build_SQL_for_multiple_entity(multi_entity_repeat,patient_df,mapping,plogger
     # clean the MULT value IF(XXX MULT(YYY),XXX,"*") -> YYY
     specified_value = uncleanedspecified_value.split("MULT(")[1].split(")")[0]
     plogger.debug("REPEAT: specified_value %s",specified_value)
-    # Find the indices where the specified value appears in the 'fieldname' column
-    indices = multi_entity_repeat[multi_entity_repeat['field_name'] == specified_value].index
-
-    # Initialize an empty list to store the resulting DataFrames
-    mult_dfs = []
-
-    # Iterate through the indices and create a DataFrame for each row with the specified value
-    for idx in indices:
-        # Exclude the row with the specified value
-        single_entity_repeat_df = multi_entity_repeat.copy()
-        
-        # Exclude rows with the specified value except for the current index
-        single_entity_repeat_df = single_entity_repeat_df.drop(indices.difference([idx]))
-
-        # Reset the index to start from 0
-        single_entity_repeat_df.reset_index(drop=True, inplace=True)
-        
-        # Append the resulting DataFrame to the list
-        mult_dfs.append(single_entity_repeat_df)
-    plogger.debug("REPEAT: mult_dfs \n%s",mult_dfs)
-
-    # build And Import SingleEntity with the resulting DataFrames
-    for i, single_entity_repeat_df in enumerate(mult_dfs, start=1):
-        plogger.debug("REPEAT: single_entity_repeat_df \n%s",single_entity_repeat_df)
-        build_SQL_for_single_entity(single_entity_repeat_df,patient_df,mapping,plogger)
-    
-def build_SQL_for_single_entity(single_entity_repeat,patient_df,mapping,plogger):
+
+    # build And Import SingleEntity with the instances, one at a time
+    for instance in iter_mult_instances(multi_entity_repeat,specified_value):
+        plogger.debug("REPEAT: MULT instance \n%s",instance.key_row)
+        row = build_SQL_for_single_entity(instance,patient_df,mapping,plogger,patient_cache)
+        if row:
+            yield row
+
+def iter_mult_instances(multi_entity_repeat,specified_value):
     """
-    This function creates an import-sql for a single entity.
-    It gets the patient ID.
+    This function generates the instances of a MULT entity lazily.
+    The rows with the specified value (the varying key rows) are split off once from the shared base rows.
+    Each instance refers to the shared base rows and a view of exactly one key row (see transform_utils.MultInstance),
+    so the base rows are not copied per instance.
+
+    Args:
+    multi_entity_repeat (pandas.DataFrame): The repeat data.
+    specified_value (str): The field_name of the MULT field.
+
+    Yields:
+    MultInstance: The repeat data of one instance.
+    """
+    # Find the rows where the specified value appears in the 'fieldname' column
+    is_key_row = (multi_entity_repeat['field_name'] == specified_value).values
+    base_rows = multi_entity_repeat[~is_key_row]
+    key_rows = multi_entity_repeat[is_key_row]
+
+    for position in range(len(key_rows)):
+        yield MultInstance(base_rows, key_rows.iloc[position:position + 1])
+
+def build_SQL_for_single_entity(single_entity_repeat,patient_df,mapping,plogger,patient_cache=None):
+    """
+    This function creates the row of a single entity.
     It creates a variable to fill with information.
     It defines the entity name.
     It adds values from REDCap to the entity.
@@ -213,27 +240,25 @@ def build_SQL_for_single_entity(single_entity_repeat,patient_df,mapping,plogger)
     It drops rows with 'NaN'.
     It logs the entity.
     It skips empty entities.
-    It extracts two columns as a dictionary.
-    It generates the insert statement for the table.
-    It writes the insert statement to the SQL file.
+    It extracts two columns as a dictionary, the row of the entity.
+    The insert statement is generated from the row when it is loaded (see ETL.Load.load).
 
     Args:
-    single_entity_repeat (pandas.DataFrame): The repeat data.
+    single_entity_repeat (pandas.DataFrame or MultInstance): The repeat data, or the instance of a MULT entity.
     patient_df (pandas.DataFrame): The patient data.
     mapping (pandas.DataFrame): The mapping data of ONE entity.
     plogger (logging.Logger): The logger for the patient.
-    """
-    # Get the patient ID
-    id_col_name = patient_df.columns[0]
-    patient_id = patient_df[id_col_name].values[0]
-    sql_file = f'{CONFIG["data_path"]}/Patients/Patient-{patient_id}/Patient-{patient_id}.sql'
+    patient_cache (dict): Cache for values which do not change within the patient.
 
+    Returns:
+    dict: The row (attribute -> value) of the entity, or None if the entity is empty.
+    """
     # create a variable to fill with information
     entity = mapping.copy()
     # define entityname
     entity_name = entity["Table"].values[0]
     # add values from redcap to entity
-    entity["value"] =  entity.apply(lambda row: getRedCapValueROW(row,single_entity_repeat,patient_df,plogger), axis=1)
+    entity["value"] =  entity.apply(lambda row: getRedCapValueROW(row,single_entity_repeat,patient_df,plogger,patient_cache), axis=1)
 
     # check if all rows with NOTNULL have a value in column value
     mask = (entity["NotNull"] == "NOT NULL") & ((entity["value"] == 'NULL')|entity["value"].isnull())
@@ -256,14 +281,9 @@ def build_SQL_for_single_entity(single_entity_repeat,patient_df,mapping,plogger)
     plogger.info('SINGLE ENTITY: ENITIY - {} \n{}'.format(entity_name,entity.to_string()))
 
     # Skip empty entities
-    if not entity.empty:
-        # Extract two columns as a dictionary
-        entityDict = dict(zip(entity['Attribute'], entity['value']))
-        # Generate the insert statement for the table
-        insert_statement = generate_insert_statement(entity_name, entityDict)
-        plogger.info('SINGLE ENTITY: INSERT STATEMENT - {}'.format(insert_statement))
-
-        # Write the insert statement to the SQL file
-        with open(sql_file, 'a') as f:
-            f.write(insert_statement + '\n')
-        
\ No newline at end of file
+    if entity.empty:
+        return None
+    # Extract two columns as a dictionary
+    entityDict = dict(zip(entity['Attribute'], entity['value']))
+    plogger.info('SINGLE ENTITY: ROW - {}'.format(entityDict))
+    return entityDict
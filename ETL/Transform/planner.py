@@ -0,0 +1,257 @@
+from PyUtilities.setupFunctions import read_config_file, read_mapping_tables
+from PyUtilities.databaseFunctions import read_schema
+from ETL.Transform.transform_utils import clean_mapping_table, parse_arguments, getAllOccurringAttributes
+
+import hashlib
+import logging
+import os
+import threading
+
+# load configuration file
+CONFIG_FILE_PATH = 'config.json'
+CONFIG = read_config_file(CONFIG_FILE_PATH)
+
+# Configure logger
+workflow_logger = logging.getLogger('workflow_logger')
+
+# Cache of the compiled plans (per mapping folder and schema), a plan is only compiled again if the mapping tables or the schema changed
+PLAN_CACHE = {}
+PLAN_LOCK = threading.Lock()
+
+class MappingPlanError(Exception):
+    """
+    The mapping tables cannot be compiled into a plan (e.g. a cycle in the dependencies of the entities).
+    It fails the run; a long-running process keeps running (see workflow.main_workflow).
+    """
+
+def compile_mapping_plan():
+    """
+    This function compiles the mapping tables of the config file into an execution plan.
+    The plan orders the entities (tables) by their dependencies (see build_entity_dependencies) into levels:
+    the entities of a level only depend on entities of earlier levels and can be processed in parallel.
+    A cycle in the dependencies is rejected here, before any data is processed.
+
+    Raises:
+    MappingPlanError: If the entities depend on each other in a cycle.
+
+    Returns:
+    dict: The plan with the keys
+          levels (list of lists of tables, lower case), entity_levels (table -> level number),
+          dependencies (table -> set of tables),
+          mapping_files (table -> list of mapping filenames) and
+          mapping_tables (list of (filename, pandas.DataFrame) in execution order).
+    """
+    mapping_tables = read_mapping_tables(CONFIG['mapping_path'])
+    schema = read_schema(CONFIG['db_schema']) if CONFIG['db_schema'] is not None else {}
+    cache_key = (CONFIG['mapping_path'], CONFIG['db_schema'])
+    with PLAN_LOCK:
+        cached = PLAN_CACHE.get(cache_key)
+        if cached is not None and cached[0] is mapping_tables and cached[1] is schema:
+            return cached[2]
+
+        mapping_files = {}
+        for mapping_file, mapping in mapping_tables:
+            mapping_files.setdefault(mapping["Table"].values[0].lower(), []).append(mapping_file)
+        dependencies = build_entity_dependencies(mapping_tables, schema)
+        try:
+            levels = plan_entity_levels(dependencies)
+        except ValueError as e:
+            raise MappingPlanError(f"Mapping plan: {e}") from e
+
+        # Order the mapping tables by level, keep the filename order within an entity
+        tables_by_file = dict(mapping_tables)
+        order = [mapping_file for level in levels for table in level for mapping_file in mapping_files[table]]
+        plan = {
+            'levels': levels,
+            'entity_levels': {table: level_number for level_number, level in enumerate(levels) for table in level},
+            'dependencies': dependencies,
+            'mapping_files': mapping_files,
+            'mapping_tables': [(mapping_file, tables_by_file[mapping_file]) for mapping_file in order],
+        }
+        workflow_logger.info("Mapping plan: %s", ' -> '.join(str(level) for level in levels))
+        PLAN_CACHE[cache_key] = (mapping_tables, schema, plan)
+        return plan
+
+def select_mapping_files(tables):
+    """
+    This function selects the mapping tables of a run restricted to some entities (tables).
+    The entities these depend on (see build_entity_dependencies) are selected as well, so their SRCH statements find their rows.
+
+    Args:
+    tables (list): The names of the entities.
+
+    Returns:
+    set: The filenames of the mapping tables of the entities and their dependencies.
+    """
+    plan = compile_mapping_plan()
+    unknown = [table for table in tables if table.lower() not in plan['dependencies']]
+    if unknown:
+        workflow_logger.error("No mapping table for the entities %s", unknown)
+        exit()
+    selected = set()
+    pending = [table.lower() for table in tables]
+    while pending:
+        table = pending.pop()
+        if table not in selected:
+            selected.add(table)
+            pending.extend(plan['dependencies'][table])
+    if selected != {table.lower() for table in tables}:
+        workflow_logger.info("Entities selected with their dependencies: %s", sorted(selected))
+    return {mapping_file for table in selected for mapping_file in plan['mapping_files'][table]}
+
+def compute_table_hashes():
+    """
+    This function computes a fingerprint per entity (table) of the plan, from the content of its mapping tables
+    and the fingerprints of the entities it depends on (see build_entity_dependencies).
+    A changed mapping table changes the fingerprint of its entity and of all entities downstream of it.
+
+    Returns:
+    dict: Per table (lower case) the hex digest.
+    """
+    plan = compile_mapping_plan()
+    hashes = {}
+    for level in plan['levels']:
+        for table in level:
+            digest = hashlib.sha256()
+            for mapping_file in plan['mapping_files'][table]:
+                digest.update(mapping_file.encode('utf-8'))
+                with open(os.path.join(CONFIG['mapping_path'], mapping_file), 'rb') as file:
+                    digest.update(file.read())
+            # The entities of earlier levels are hashed already
+            for dependency in sorted(plan['dependencies'][table]):
+                digest.update(hashes[dependency].encode('utf-8'))
+            hashes[table] = digest.hexdigest()
+    return hashes
+
+def list_referenced_fields():
+    """
+    This function lists the fields the mapping tables of the plan reference, with the parsing of the transformation
+    (see transform_utils.getAllOccurringAttributes), so the data of the other fields can be left out of the extraction.
+    The set also holds the other arguments of the mapping expressions (e.g. searched tables and attributes), which are no fields.
+
+    Returns:
+    set: The referenced fields.
+    """
+    fields = set()
+    for _, mapping in compile_mapping_plan()['mapping_tables']:
+        mapping = clean_mapping_table(mapping)
+        fields.update(getAllOccurringAttributes(list(mapping["field_name"])))
+    return fields
+
+def build_entity_dependencies(mapping_tables, schema):
+    """
+    This function derives the dependencies between the mapped entities (tables).
+    An entity depends on another one if one of its mapping expressions searches in it (SRCH target),
+    or if one of its mapped attributes is a FOREIGN KEY referencing it in the schema.
+    References to tables without a mapping table and references of an entity to itself are left out,
+    they do not constrain the order of the entities.
+
+    Args:
+    mapping_tables (list): Tuples of (filename, pandas.DataFrame) of the mapping tables.
+    schema (dict): The schema, as returned by read_schema.
+
+    Returns:
+    dict: Per table (lower case) the set of tables it depends on.
+    """
+    mapped_tables = {mapping["Table"].values[0].lower() for _, mapping in mapping_tables}
+    dependencies = {table: set() for table in mapped_tables}
+    for mapping_file, mapping in mapping_tables:
+        table = mapping["Table"].values[0].lower()
+        mapping = clean_mapping_table(mapping)
+        references = set()
+        for field_name in mapping["field_name"]:
+            references.update(find_search_targets(field_name))
+        # FOREIGN KEY clauses of the mapped attributes
+        mapped_attributes = {attribute.lower() for attribute in mapping["Attribute"]}
+        for column, referenced_table, _ in schema.get(table, {}).get('foreign_keys', []):
+            if column.lower() in mapped_attributes:
+                references.add(referenced_table)
+        for referenced_table in references:
+            if referenced_table not in mapped_tables:
+                workflow_logger.debug("Mapping plan: %s references %s, which has no mapping table", mapping_file, referenced_table)
+            elif referenced_table != table:
+                dependencies[table].add(referenced_table)
+    return dependencies
+
+def find_search_targets(field_name):
+    """
+    This function finds the tables searched by a mapping expression, also in nested SRCH and __IF statements.
+
+    Args:
+    field_name (str): The mapping expression.
+
+    Returns:
+    set: The searched tables (lower case).
+    """
+    field_name = field_name.strip()
+    targets = set()
+    if field_name[:4] == "SRCH":
+        arguments = parse_arguments(field_name)
+        if len(arguments) > 1:
+            targets.add(arguments[1].lower())
+        for argument in arguments[3::2]:
+            targets.update(find_search_targets(argument))
+    elif field_name[:4] == "__IF":
+        for argument in parse_arguments(field_name):
+            targets.update(find_search_targets(argument))
+    return targets
+
+def find_search_lookups(field_name):
+    """
+    This function finds the lookups of a mapping expression, also in nested SRCH and __IF statements.
+    A lookup is the searched table with the columns a SRCH filters on, which an index of the table can serve.
+
+    Args:
+    field_name (str): The mapping expression.
+
+    Returns:
+    set: Tuples of (searched table (lower case), searched attribute, tuple of the filtered columns).
+    """
+    field_name = field_name.strip()
+    lookups = set()
+    if field_name[:4] == "SRCH":
+        arguments = parse_arguments(field_name)
+        if len(arguments) > 3:
+            lookups.add((arguments[1].lower(), arguments[0], tuple(arguments[2::2])))
+        for argument in arguments[3::2]:
+            lookups.update(find_search_lookups(argument))
+    elif field_name[:4] == "__IF":
+        for argument in parse_arguments(field_name):
+            lookups.update(find_search_lookups(argument))
+    return lookups
+
+def plan_entity_levels(dependencies):
+    """
+    This function sorts the entities topologically into levels (Kahn's algorithm).
+    Level 0 holds the entities without dependencies, every further level the entities depending only on earlier levels.
+
+    Args:
+    dependencies (dict): Per table the set of tables it depends on.
+
+    Returns:
+    list: The levels, each a sorted list of tables.
+
+    Raises:
+    ValueError: If the dependencies contain a cycle.
+    """
+    remaining = {table: set(depends_on) for table, depends_on in dependencies.items()}
+    levels = []
+    while remaining:
+        level = sorted(table for table, depends_on in remaining.items() if not depends_on)
+        if not level:
+            # Leave out the entities which only depend on the cycle, but are not part of it
+            cycle = dict(remaining)
+            while True:
+                downstream = [table for table in cycle if not any(table in depends_on for depends_on in cycle.values())]
+                if not downstream:
+                    break
+                for table in downstream:
+                    del cycle[table]
+            raise ValueError(f"cyclic dependencies between the entities {sorted(cycle)}: "
+                             + ', '.join(f"{table} -> {sorted(depends_on & cycle.keys())}" for table, depends_on in sorted(cycle.items())))
+        levels.append(level)
+        for table in level:
+            del remaining[table]
+        for depends_on in remaining.values():
+            depends_on.difference_update(level)
+    return levels
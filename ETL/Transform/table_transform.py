@@ -0,0 +1,207 @@
+from PyUtilities.setupFunctions import read_config_file
+from PyUtilities.stagingFunctions import stage_rows, staging_path
+from PyUtilities.memoryFunctions import over_memory_budget
+from PyUtilities.journalFunctions import record_journal_event, is_journaled
+from ETL.Transform.transform_utils import clean_mapping_table, getAllOccurringAttributes
+from ETL.Transform.planner import compile_mapping_plan
+
+import concurrent.futures
+import contextvars
+import logging
+import pandas as pd
+import threading
+
+# load configuration file
+CONFIG_FILE_PATH = 'config.json'
+CONFIG = read_config_file(CONFIG_FILE_PATH)
+
+# Configure logger
+workflow_logger = logging.getLogger('workflow_logger')
+
+# Number of rows created between two checks of the memory budget
+MEMORY_CHECK_ROWS = 10000
+
+# Worker pool of the column-wise transformation, shared by the runs and projects of the process
+TABLE_POOL_SIZE = 4
+TABLE_POOL = {'executor': None}
+TABLE_POOL_LOCK = threading.Lock()
+
+def is_simple_mapping(mapping):
+    """
+    This function checks if a mapping table is a plain field-to-column mapping.
+    A mapping is simple if every field_name (after dropna & AUTO remove) is a REDCap field, a SET_ or a DROP,
+    so no row needs SRCH, __IF, LIST, GLOB or MULT.
+
+    Args:
+    mapping (pandas.DataFrame): The mapping data of ONE entity.
+
+    Returns:
+    bool: True if the entity can be transformed column-wise for all patients at once.
+    """
+    mapping = clean_mapping_table(mapping)
+    if mapping.empty:
+        return False
+    for field_name in mapping["field_name"]:
+        if field_name[:4] in ("SET_", "DROP"):
+            continue
+        if field_name.strip()[:4] in ("SRCH", "__IF", "LIST", "GLOB", "MULT") or "(" in field_name:
+            return False
+    return True
+
+def list_simple_mapping_files():
+    """
+    This function lists the mapping tables of the mapping plan which are transformed column-wise.
+
+    Returns:
+    set: The filenames of the simple mapping tables.
+    """
+    return {mapping_file for mapping_file, mapping in compile_mapping_plan()['mapping_tables'] if is_simple_mapping(mapping)}
+
+def transform_tables(data, journal=None, skip_mapping_files=frozenset()):
+    """
+    This function transforms the simple mapping tables (see is_simple_mapping) column-wise for all patients at once.
+    The entities are processed level by level of the mapping plan, the mapping tables of one level in parallel
+    (at most TABLE_POOL_SIZE at a time). While the process is over the memory budget (memory_budget_mb), no further
+    mapping table is started until the ones in flight are staged; the pivot of one table itself is not throttled.
+    The rows of each simple mapping table are staged in one transaction (see PyUtilities.stagingFunctions),
+    with the ID of the patient they belong to. Every staged mapping table is recorded in the run journal,
+    mapping tables already recorded by an interrupted run are not transformed again.
+
+    Args:
+    data (pandas.DataFrame): The cleaned data of all patients.
+    journal (dict): The run journal (see PyUtilities.journalFunctions), or None.
+    skip_mapping_files (frozenset): The filenames of the mapping tables to skip.
+
+    Returns:
+    set: The filenames of the mapping tables which are transformed column-wise.
+    """
+    plan = compile_mapping_plan()
+    simple_files = list_simple_mapping_files()
+
+    executor = get_table_pool()
+    budget = CONFIG.get('memory_budget_mb')
+    warned = False
+
+    def wait_for_table(futures):
+        # Wait for the next mapping table to be staged
+        done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            future.result()
+            record_journal_event(journal, 'table', futures.pop(future))
+
+    for level_number, level in enumerate(plan['levels']):
+        futures = {}
+        for mapping_file, mapping in plan['mapping_tables']:
+            if mapping_file not in simple_files or mapping_file in skip_mapping_files or mapping["Table"].values[0].lower() not in level:
+                continue
+            # Skip mapping tables which were already staged by an interrupted run
+            if is_journaled(journal, 'table', mapping_file):
+                continue
+            # Over the memory budget, wait for the mapping tables in flight before submitting more
+            while futures and over_memory_budget(budget):
+                if not warned:
+                    workflow_logger.warning("TABLE: over the memory budget of %s MB, the mapping tables are transformed one at a time; "
+                                            "the pivot of one mapping table over all patients is not throttled by the budget", budget)
+                    warned = True
+                wait_for_table(futures)
+            future = executor.submit(contextvars.copy_context().run, stage_rows_for_table, data, mapping_file, mapping, level_number)
+            futures[future] = mapping_file
+        while futures:
+            wait_for_table(futures)
+    return simple_files
+
+def get_table_pool():
+    """
+    This function returns the worker pool of the column-wise transformation, it is created on first use
+    and reused by every run, so a long-running process does not start new threads for every run.
+    At most TABLE_POOL_SIZE mapping tables are pivoted at the same time.
+
+    Returns:
+    concurrent.futures.ThreadPoolExecutor: The pool.
+    """
+    with TABLE_POOL_LOCK:
+        if TABLE_POOL['executor'] is None:
+            TABLE_POOL['executor'] = concurrent.futures.ThreadPoolExecutor(TABLE_POOL_SIZE, thread_name_prefix='table')
+        return TABLE_POOL['executor']
+
+def stage_rows_for_table(data, mapping_file, mapping, level_number):
+    """
+    This function stages the rows of ONE simple mapping table in one transaction.
+    With a memory budget (memory_budget_mb), the rows created so far are staged whenever the process is over the budget.
+
+    Args:
+    data (pandas.DataFrame): The cleaned data of all patients.
+    mapping_file (str): The filename of the mapping table.
+    mapping (pandas.DataFrame): The simple mapping data of ONE entity.
+    level_number (int): The level of the entity in the mapping plan.
+    """
+    entity_name = mapping["Table"].values[0]
+    staging_db = staging_path(CONFIG["data_path"])
+    staged_rows = []
+    number_of_rows = 0
+    for patient_id, row in build_rows_for_table(data, mapping):
+        staged_rows.append((level_number, entity_name, mapping_file, patient_id, row))
+        if len(staged_rows) % MEMORY_CHECK_ROWS == 0 and over_memory_budget(CONFIG.get('memory_budget_mb')):
+            number_of_rows += stage_rows(staging_db, staged_rows)
+            staged_rows = []
+    number_of_rows += stage_rows(staging_db, staged_rows)
+    workflow_logger.info("TABLE: %s rows of %s created column-wise from %s", number_of_rows, entity_name, mapping_file)
+
+def build_rows_for_table(data, mapping):
+    """
+    This function creates the rows of a simple entity for all patients at once.
+    It follows the rules of the per-patient transformation (see patient_transform.build_SQL_for_single_entity):
+    One entity is created per patient (and per repeat instance, if the data has a 'redcap_repeat_instance' column)
+    which has at least one of the mapped fields. The first value of a field is taken, missing fields are 'NULL'.
+    Entities with a 'NULL' in a NOT NULL attribute or with a value containing 'DROP' are dropped,
+    'NULL' attributes are left out of the insert statement.
+
+    Args:
+    data (pandas.DataFrame): The cleaned data of all patients.
+    mapping (pandas.DataFrame): The simple mapping data of ONE entity.
+
+    Yields:
+    tuple: (patient ID, row), the row being a dict of attribute -> value.
+    """
+    mapping = clean_mapping_table(mapping)
+    entity_name = mapping["Table"].values[0]
+    id_col_name = data.columns[0]
+
+    # Pivot the EAV data once: one row per entity instance, one column per field (first value wins)
+    keys = [id_col_name]
+    if 'redcap_repeat_instance' in data.columns:
+        keys.append('redcap_repeat_instance')
+    subset = data[data['field_name'].isin(getAllOccurringAttributes(list(mapping["field_name"])))]
+    subset = subset.dropna(subset=keys).drop_duplicates(subset=keys + ['field_name'], keep='first')
+    instances = subset.pivot(index=keys, columns='field_name', values='value')
+
+    # Build the value columns of the entity, one per mapping row
+    values = []
+    for field_name in mapping["field_name"]:
+        if field_name[:4] in ("SET_", "DROP"):
+            value = field_name[5:-1] if field_name[:4] == "SET_" else field_name
+            values.append(pd.Series(value, index=instances.index))
+        elif field_name in instances.columns:
+            values.append(instances[field_name].fillna('NULL'))
+        else:
+            values.append(pd.Series('NULL', index=instances.index))
+    if not values or instances.empty:
+        return
+    values = pd.concat(values, axis=1, ignore_index=True)
+
+    # check if all rows with NOTNULL have a value, and drop all entities with a "DROP" value
+    is_null = values == 'NULL'
+    not_null = (mapping["NotNull"] == "NOT NULL").values
+    failed = is_null.loc[:, not_null].any(axis=1)
+    dropped = values.apply(lambda column: column.str.contains('DROP', case=True)).any(axis=1)
+    keep = ~(failed | dropped)
+    workflow_logger.debug("TABLE: %s: %s entities, %s failed the NOTNULL check, %s dropped",
+                          entity_name, len(values), int(failed.sum()), int((dropped & ~failed).sum()))
+
+    # Generate the rows, leaving out the NULL attributes
+    attributes = list(mapping["Attribute"])
+    patient_ids = values.index[keep].get_level_values(id_col_name)
+    for patient_id, row, row_is_null in zip(patient_ids, values[keep].itertuples(index=False), is_null[keep].itertuples(index=False)):
+        entityDict = {attribute: value for attribute, value, null in zip(attributes, row, row_is_null) if not null}
+        if entityDict:
+            yield patient_id, entityDict
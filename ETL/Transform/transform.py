@@ -1,8 +1,22 @@
-from ETL.Transform.patient_transform import transform_patient
-from PyUtilities.setupFunctions import read_config_file
+from ETL.Transform.patient_transform import transform_patient, get_patient_logger
+from ETL.Transform.table_transform import transform_tables, list_simple_mapping_files
+from ETL.Transform.planner import compile_mapping_plan, select_mapping_files
+from PyUtilities.setupFunctions import read_config_file, ACTIVE_PROJECT
+from PyUtilities.sharedFrameFunctions import publish_frame, attach_frame, read_record_frame, release_frame
+from PyUtilities.journalFunctions import record_journal_event, is_journaled
+from PyUtilities.stagingFunctions import open_staging, discard_unfinished_rows, staging_path
+from PyUtilities.memoryFunctions import over_memory_budget, current_rss_mb
 import pandas as pd
+import collections
 import concurrent.futures
+import contextvars
 import logging
+import math
+import multiprocessing
+import numpy as np
+import os
+import threading
+import time
 
 # Configure logger
 workflow_logger = logging.getLogger('workflow_logger')
@@ -10,22 +24,49 @@ workflow_logger = logging.getLogger('workflow_logger')
 CONFIG_FILE_PATH = 'config.json'
 CONFIG = read_config_file(CONFIG_FILE_PATH)
 
-def transform_data(data):
+# Transform worker pool, shared by the projects of the process (see transform_quota)
+TRANSFORM_POOL_SIZE = 50
+TRANSFORM_POOL = {'executor': None, 'active_projects': 0}
+TRANSFORM_POOL_LOCK = threading.Lock()
+
+# The shared frame of a transform process (see init_transform_process)
+TRANSFORM_PROCESS = {'frame': None}
+
+# A patient is split by entity if its cost is this many times the mean cost of the patients (see schedule_patients)
+SPLIT_FACTOR = 4
+# Number of the slowest records reported after the transformation
+SLOWEST_RECORDS = 10
+
+def transform_data(data, journal=None, tables=None, metrics=None):
     """
-    This function transforms the data and creates import scripts for the SQLite database.
-    It uses a ThreadPoolExecutor to run the transformation of each patient in a separate thread.
-    For that, it splits the data into patient specific data and submits the transformation of each patient to the executor.
+    This function transforms the data and stages the rows for the SQLite database.
+    The rows of all entities and patients are written to one staging database (see PyUtilities.stagingFunctions),
+    each with the ID of its patient, and are loaded from there entity by entity (see ETL.Load.load).
+    A run can be restricted to some entities with subset_tables or the tables argument, the other mapping tables are skipped.
+    Simple mapping tables (plain field-to-column mappings) are transformed column-wise for all patients at once.
+    For the other mapping tables, it uses the shared transform pool to run the transformation of each patient in a separate thread.
+    For that, it splits the data into patient specific data and submits the transformation of each patient to the pool,
+    keeping at most the quota of the project (see transform_quota) in the pool at a time.
+    With a memory budget (memory_budget_mb), no further patients or mapping tables are submitted while the process is over the budget.
+    With transform_processes, the patients are transformed in worker processes instead (see transform_patients_in_processes).
+    The largest patients are submitted first, extreme patients are split by entity (see schedule_patients).
+    The latency percentiles of the patients and the slowest records are logged (see report_patient_latency).
+    Every transformed patient is recorded in the run journal, patients already recorded by an interrupted run are skipped.
+    The rows an interrupted run staged for unfinished patients or mapping tables are removed before.
 
     Args:
-    data (pandas.DataFrame): The data to be transformed.
+    data (pandas.DataFrame): The data to be transformed, cleaned at extraction (see ETL.Extract.extract.clean_data).
+    journal (dict): The run journal (see PyUtilities.journalFunctions), or None.
+    tables (set): Only transform the mapping tables of these entities (lower case), or None for all entities.
+    metrics (dict): If given, the latency percentiles of the patients and the slowest records are added to it.
 
     Returns:
-    None
+    int: The number of transformed patients.
     """
     ## Check Data needs to be transformed
     if CONFIG['transform_data'] == False:
         workflow_logger.info("Data transformation is disabled.")
-        return
+        return 0
     
     ## Prepare import of patients
     # Get the name of the column that contains the patient ID
@@ -35,34 +76,304 @@ def transform_data(data):
     number_of_patients = len(list_of_patients)
     workflow_logger.info("Number of patients: %s", str(number_of_patients))
 
-    # Number of threads to run concurrently
-    max_threads = 50
-
-    # Preliminary data cleaning which could disrupt the transformation
-    # replace all occurrences within the data
-    # all "'" with "`" and '"' with "`"
-    # all "(" with "{" and ")" with "}"
-    # all new lines within a cell with a space
-    data = data.replace("'", "`", regex=True)
-    data = data.replace('"', "`", regex=True)
-    data = data.replace("\(", ".(", regex=True)
-    data = data.replace("\)", ").", regex=True)
-    data.value = data.value.str.replace("\n", " ")
-
-    workflow_logger.info(f"Data cleaned:{data[data.values == '{']}")
+    ## Prepare the staging database and the patient log, an interrupted run is continued
+    resumed = journal is not None and journal['resumed']
+    staging_db = staging_path(CONFIG['data_path'])
+    open_staging(staging_db, reset=not resumed)
+    if resumed:
+        removed = discard_unfinished_rows(staging_db, journal['patient'], journal['table'], list_simple_mapping_files())
+        workflow_logger.info("Staged rows of unfinished work removed: %s", removed)
+    setup_patient_logger(resumed)
+
+    ## Restrict the run to some entities (and the entities they depend on), if configured
+    skipped_mapping_files = frozenset()
+    if CONFIG.get('subset_tables'):
+        selected_mapping_files = select_mapping_files(CONFIG['subset_tables'])
+        skipped_mapping_files = frozenset(mapping_file for mapping_file, _ in compile_mapping_plan()['mapping_tables'] if mapping_file not in selected_mapping_files)
+    elif tables is not None:
+        skipped_mapping_files = frozenset(mapping_file for mapping_file, mapping in compile_mapping_plan()['mapping_tables'] if mapping["Table"].values[0].lower() not in tables)
+
+    ## Transform the simple mapping tables for all patients at once
+    table_mapping_files = frozenset(transform_tables(data, journal, skipped_mapping_files)) | skipped_mapping_files
  
-    ## Create a ThreadPoolExecutor with a maximum of max_threads threads
-    with concurrent.futures.ThreadPoolExecutor(max_threads) as executor:
-        futures = []
-
-        # Submit tasks to the executor for each patient in the list
-        for record in list_of_patients:
-            # Get data for each patient
-            patient_df = data[data[id_col_name] == record]
-            future = executor.submit(transform_patient, patient_df)
-            futures.append(future)
-
-        # Wait for all tasks to complete
-        for future in concurrent.futures.as_completed(futures):
-            future.result()
-    return
+    # Skip patients which were already transformed by an interrupted run
+    records = [record for record in list_of_patients if not is_journaled(journal, 'patient', str(record))]
+    workflow_logger.info("Patients to transform: %s", len(records))
+
+    # The rows of each patient are looked up once, the patient frames are only created when they are submitted
+    patient_rows = data.groupby(id_col_name, sort=False, dropna=False).indices
+    costs = estimate_patient_costs(data, patient_rows)
+    latencies = {}
+
+    if CONFIG.get('transform_processes'):
+        tasks = schedule_patients(records, costs, table_mapping_files, CONFIG['transform_processes'])
+        transform_patients_in_processes(data, tasks, journal, latencies)
+        report_patient_latency(latencies, metrics)
+        return len(records)
+
+    ## Submit the patients to the shared pool, at most the quota of the project at a time
+    pool = get_transform_pool()
+    with TRANSFORM_POOL_LOCK:
+        TRANSFORM_POOL['active_projects'] += 1
+    try:
+        tasks = schedule_patients(records, costs, table_mapping_files, transform_quota())
+        open_tasks = collections.Counter(record for record, _ in tasks)
+        pending = iter(tasks)
+        futures = {}
+        while True:
+            while len(futures) < transform_quota():
+                # Over the memory budget, wait for the patients in flight before submitting more
+                if futures and over_memory_budget(CONFIG.get('memory_budget_mb')):
+                    break
+                task = next(pending, pending)
+                if task is pending:
+                    break
+                record, skip_mapping_files = task
+                # Get data for each patient, the task runs with the configuration of the project
+                patient_df = data.iloc[patient_rows[record]]
+                future = pool.submit(contextvars.copy_context().run, timed_call, transform_patient, patient_df, skip_mapping_files)
+                futures[future] = record
+            if not futures:
+                break
+            # Wait for the next task to complete, a patient is finished with its last task
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                record = futures.pop(future)
+                latencies[record] = latencies.get(record, 0) + future.result()[1]
+                open_tasks[record] -= 1
+                if open_tasks[record] == 0:
+                    record_journal_event(journal, 'patient', str(record))
+    finally:
+        with TRANSFORM_POOL_LOCK:
+            TRANSFORM_POOL['active_projects'] -= 1
+    report_patient_latency(latencies, metrics)
+    return len(records)
+
+def estimate_patient_costs(data, patient_rows):
+    """
+    This function estimates the cost of transforming each patient: its number of rows times its number of
+    repeat instances (plus one), as every repeat instance of an entity is built from the rows of the patient.
+
+    Args:
+    data (pandas.DataFrame): The cleaned data of all patients.
+    patient_rows (dict): Per patient ID the positions of its rows in the data.
+
+    Returns:
+    dict: Per patient ID the estimated cost.
+    """
+    instances = {}
+    if 'redcap_repeat_instance' in data.columns:
+        instances = data.groupby(data.columns[0], sort=False)['redcap_repeat_instance'].nunique().to_dict()
+    return {record: len(rows) * (1 + instances.get(record, 0)) for record, rows in patient_rows.items()}
+
+def schedule_patients(records, costs, skip_mapping_files, workers):
+    """
+    This function orders the transformation tasks of the patients, the largest patients (see estimate_patient_costs) first,
+    so they do not start last and keep one worker busy while the others are idle.
+    An extreme patient, costing more than the share of one worker and SPLIT_FACTOR times the mean cost, is split
+    into tasks of its entities (mapping tables, round-robin), so several workers transform it.
+    The entities of a patient can be transformed independently, as the SRCH statements are resolved when the rows are loaded.
+
+    Args:
+    records (list): The IDs of the patients to transform.
+    costs (dict): Per patient ID the estimated cost.
+    skip_mapping_files (frozenset): The filenames of the mapping tables to skip.
+    workers (int): The number of workers transforming the patients.
+
+    Returns:
+    list: The tasks, tuples of (patient ID, filenames of the mapping tables to skip).
+    """
+    if not records:
+        return []
+    ordered = sorted(records, key=lambda record: costs.get(record, 0), reverse=True)
+    mapping_files = [mapping_file for mapping_file, _ in compile_mapping_plan()['mapping_tables'] if mapping_file not in skip_mapping_files]
+    total = sum(costs.get(record, 0) for record in records)
+    threshold = max(total / max(1, workers), SPLIT_FACTOR * total / len(records))
+    tasks = []
+    split = 0
+    for record in ordered:
+        parts = min(len(mapping_files), workers, math.ceil(costs.get(record, 0) / threshold)) if threshold else 1
+        if parts <= 1:
+            tasks.append((record, skip_mapping_files))
+            continue
+        split += 1
+        for part in range(parts):
+            part_files = set(mapping_files[part::parts])
+            tasks.append((record, skip_mapping_files | frozenset(mapping_file for mapping_file in mapping_files if mapping_file not in part_files)))
+    workflow_logger.info("Patients scheduled largest first: %s tasks, %s patients split by entity", len(tasks), split)
+    return tasks
+
+def timed_call(function, *args):
+    """
+    This function calls a function and measures its duration. [Code to be executed in the thread or process]
+
+    Args:
+    function (callable): The function.
+    *args: The arguments of the function.
+
+    Returns:
+    tuple: The result of the function and the duration (seconds).
+    """
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+def report_patient_latency(latencies, metrics=None):
+    """
+    This function logs the percentiles of the transformation time of the patients and the slowest records.
+    The time of a patient split by entity is the sum of its tasks.
+
+    Args:
+    latencies (dict): Per patient ID the transformation time (seconds).
+    metrics (dict): If given, patient_latency (p50, p90, p99, max) and slowest_records are added to it.
+
+    Returns:
+    None
+    """
+    if not latencies:
+        return
+    seconds = np.fromiter(latencies.values(), dtype=float)
+    percentiles = {name: round(float(value), 3) for name, value in zip(('p50', 'p90', 'p99'), np.percentile(seconds, [50, 90, 99]))}
+    percentiles['max'] = round(float(seconds.max()), 3)
+    slowest = [[str(record), round(latency, 3)] for record, latency in sorted(latencies.items(), key=lambda item: item[1], reverse=True)[:SLOWEST_RECORDS]]
+    workflow_logger.info("Patient latency (seconds): %s", percentiles)
+    workflow_logger.info("Slowest records (seconds): %s", slowest)
+    if metrics is not None:
+        metrics['patient_latency'] = percentiles
+        metrics['slowest_records'] = slowest
+
+def transform_patients_in_processes(data, tasks, journal=None, latencies=None):
+    """
+    This function transforms the patients in transform_processes worker processes.
+    An encoded copy of the data is published once in shared memory (see PyUtilities.sharedFrameFunctions), the workers
+    decode the rows of each of their patients from it, so only the record IDs are sent to the workers.
+    The workers stage the rows themselves.
+    At most two tasks per worker are in flight at a time, every transformed patient is recorded in the run journal.
+    With a memory budget (memory_budget_mb), no further tasks are submitted while this process and the workers
+    (with the memory they reported last) are over the budget. The shared frame is published regardless of the budget.
+
+    Args:
+    data (pandas.DataFrame): The cleaned data of all patients.
+    tasks (list): The tasks, tuples of (patient ID, filenames of the mapping tables to skip), see schedule_patients.
+    journal (dict): The run journal (see PyUtilities.journalFunctions), or None.
+    latencies (dict): If given, the transformation time (seconds) of every patient is added to it.
+
+    Returns:
+    None
+    """
+    latencies = {} if latencies is None else latencies
+    open_tasks = collections.Counter(record for record, _ in tasks)
+    processes = CONFIG['transform_processes']
+    budget = CONFIG.get('memory_budget_mb')
+    descriptor, blocks = publish_frame(data)
+    if over_memory_budget(budget):
+        workflow_logger.warning("Over the memory budget of %s MB after publishing the shared frame, "
+                                "the copy of the data in shared memory is not throttled by the budget", budget)
+    # The last memory reported by each worker process (see transform_shared_patient), counted against the budget
+    worker_memory = {}
+    try:
+        with concurrent.futures.ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=init_transform_process, initargs=(dict(CONFIG.current()), descriptor)) as executor:
+            pending = iter(tasks)
+            futures = {}
+            while True:
+                while len(futures) < 2 * processes:
+                    # Over the memory budget (with the workers), wait for the patients in flight before submitting more
+                    if futures and over_memory_budget(budget, sum(worker_memory.values())):
+                        break
+                    task = next(pending, pending)
+                    if task is pending:
+                        break
+                    record, skip_mapping_files = task
+                    futures[executor.submit(timed_call, transform_shared_patient, record, skip_mapping_files)] = record
+                if not futures:
+                    break
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    record = futures.pop(future)
+                    (_, pid, memory), seconds = future.result()
+                    latencies[record] = latencies.get(record, 0) + seconds
+                    if memory is not None:
+                        worker_memory[pid] = memory
+                    open_tasks[record] -= 1
+                    if open_tasks[record] == 0:
+                        record_journal_event(journal, 'patient', str(record))
+    finally:
+        release_frame(blocks)
+
+def init_transform_process(project_config, descriptor):
+    """
+    This function prepares a transform worker process: it runs with the configuration of the project,
+    attaches to the shared frame and logs the patients to the patient log of the project. [Code to be executed in the process]
+
+    Args:
+    project_config (dict): The configuration of the project.
+    descriptor (dict): The descriptor of the shared frame, see publish_frame.
+
+    Returns:
+    None
+    """
+    # The tasks run in the thread of the initializer, so they see the configuration of the project
+    ACTIVE_PROJECT.set(project_config)
+    TRANSFORM_PROCESS['frame'] = attach_frame(descriptor)
+    setup_patient_logger(resume=True)
+
+def transform_shared_patient(record, skip_mapping_files=frozenset()):
+    """
+    This function transforms one patient of the shared frame. [Code to be executed in the process]
+
+    Args:
+    record (str): The ID of the patient.
+    skip_mapping_files (frozenset): The filenames of the mapping tables to skip.
+
+    Returns:
+    tuple: The number of staged rows, the process ID and the memory of the process afterwards (MB, or None).
+    """
+    rows = transform_patient(read_record_frame(TRANSFORM_PROCESS['frame'], record), skip_mapping_files)
+    return rows, os.getpid(), current_rss_mb()
+
+def get_transform_pool():
+    """
+    This function returns the transform worker pool, it is shared by the projects of the process and created on first use.
+
+    Returns:
+    concurrent.futures.ThreadPoolExecutor: The pool.
+    """
+    with TRANSFORM_POOL_LOCK:
+        if TRANSFORM_POOL['executor'] is None:
+            TRANSFORM_POOL['executor'] = concurrent.futures.ThreadPoolExecutor(TRANSFORM_POOL_SIZE, thread_name_prefix='transform')
+        return TRANSFORM_POOL['executor']
+
+def transform_quota():
+    """
+    This function returns the number of tasks a project may have in the transform pool at a time.
+    The pool is split evenly between the projects transforming at the moment, so a large project does not hold up the others.
+
+    Returns:
+    int: The quota of a project.
+    """
+    with TRANSFORM_POOL_LOCK:
+        return max(1, TRANSFORM_POOL_SIZE // max(1, TRANSFORM_POOL['active_projects']))
+
+def setup_patient_logger(resume=False):
+    """
+    This function configures the patient logger, only for file logging not for console logging.
+    All patients of the project log to {data_path}/transform.log, every line carries the patient ID (see patient_transform.transform_patient).
+
+    Args:
+    resume (bool): A flag to indicate if the log of an interrupted run is continued.
+
+    Returns:
+    None
+    """
+    plogger = get_patient_logger()
+    plogger.setLevel(logging.DEBUG)
+    plogger.propagate = False  # Prevent propagation to the root logger
+    # Detach the handler of a previous run, so it does not log twice
+    for handler in list(plogger.handlers):
+        plogger.removeHandler(handler)
+        handler.close()
+    file_patient = logging.FileHandler(f'{CONFIG["data_path"]}/transform.log', mode='a' if resume else 'w')
+    formatter = logging.Formatter('%(asctime)-20s - %(levelname)-10s - Patient %(patient_id)-10s - %(filename)-25s - %(funcName)-25s %(message)-50s')
+    file_patient.setFormatter(formatter)
+    plogger.addHandler(file_patient)
@@ -1,6 +1,12 @@
 from PyUtilities.databaseFunctions import generate_search_statement
+import collections
+import functools
 import pandas as pd
 
+# The repeat data of one instance of a MULT entity: the rows shared by all instances and the one row of the MULT field
+# (see patient_transform.iter_mult_instances), it is read like the repeat data frame (see field_values)
+MultInstance = collections.namedtuple('MultInstance', ['base_rows', 'key_row'])
+
 def getAllOccurringAttributes(field_name_list):
     '''
     Extract all different attributes from the field_name_list
@@ -48,7 +54,7 @@ def getAllOccurringAttributes(field_name_list):
     return list(set(attributes))
 
 # TODO: Check if this function is still needed
-def getRedCapValueROW(row,singleEntityRepeat,patient_df,plogger):
+def getRedCapValueROW(row,singleEntityRepeat,patient_df,plogger,patient_cache=None):
     '''
     Get the RedCap Value for a row in the singleEntityRepeat DataFrame
 
@@ -57,21 +63,24 @@ def getRedCapValueROW(row,singleEntityRepeat,patient_df,plogger):
     singleEntityRepeat (pandas.DataFrame): The DataFrame containing the single repeat data.
     patient_df (pandas.DataFrame): The DataFrame containing the patient data.
     plogger (logging.Logger): The logger object.
+    patient_cache (dict): Cache for values which do not change within a patient (see getRedCapValue).
 
     Returns:
     str: patient value.
     '''
-    return getRedCapValue(row.field_name,singleEntityRepeat,patient_df,plogger)
+    return getRedCapValue(row.field_name,singleEntityRepeat,patient_df,plogger,patient_cache)
 
-def getRedCapValue(value,singleRepeatdf,patient_df,plogger):
+def getRedCapValue(value,singleRepeatdf,patient_df,plogger,patient_cache=None):
     '''
     Get the RedCap Value for a given value
+    Values of expressions which do not change within a patient (see is_patient_invariant) are memoized in patient_cache.
 
     Args:
     value (str): The key_value to be replaced.
     singleRepeatdf (pandas.DataFrame): The DataFrame containing the single repeat data.
     patient_df (pandas.DataFrame): The DataFrame containing the patient data.
     plogger (logging.Logger): The logger object.
+    patient_cache (dict): Cache for the values of the patient, or None to disable memoization.
 
     Returns:
     str: patient value.
@@ -80,16 +89,38 @@ def getRedCapValue(value,singleRepeatdf,patient_df,plogger):
 
     if value is None:
         return None
-    elif value[:4] == "AUTO":
+    elif patient_cache is not None and is_patient_invariant(value):
+        if value not in patient_cache:
+            patient_cache[value] = evaluate_value(value,singleRepeatdf,patient_df,plogger,patient_cache)
+        else:
+            plogger.debug("UTILS: Memoized value for %s", value)
+        return patient_cache[value]
+    return evaluate_value(value,singleRepeatdf,patient_df,plogger,patient_cache)
+
+def evaluate_value(value,singleRepeatdf,patient_df,plogger,patient_cache=None):
+    '''
+    Evaluate a mapping expression (see getRedCapValue)
+
+    Args:
+    value (str): The key_value to be replaced.
+    singleRepeatdf (pandas.DataFrame): The DataFrame containing the single repeat data.
+    patient_df (pandas.DataFrame): The DataFrame containing the patient data.
+    plogger (logging.Logger): The logger object.
+    patient_cache (dict): Cache for the values of the patient, or None to disable memoization.
+
+    Returns:
+    str: patient value.
+    '''
+    if value[:4] == "AUTO":
         return None
     elif value[:4] == "DROP":
         return value
     elif value[:4] == "SET_":
         return replace_SETvalue_with_value(value,plogger)
     elif value[:4] == "SRCH":
-        return replace_SRCHvalue_with_value(value,singleRepeatdf,patient_df,plogger)
+        return replace_SRCHvalue_with_value(value,singleRepeatdf,patient_df,plogger,patient_cache)
     elif value[:4] == "__IF":
-        return replace_IFvalue_with_value(value,singleRepeatdf,patient_df,plogger)
+        return replace_IFvalue_with_value(value,singleRepeatdf,patient_df,plogger,patient_cache)
     elif value[:4] == "LIST":
         return replace_LISTvalue_with_values(value,singleRepeatdf,patient_df,plogger)
     elif value[:4] == "GLOB":
@@ -99,6 +130,42 @@ def getRedCapValue(value,singleRepeatdf,patient_df,plogger):
     else:
         return get_value_from_df(value,singleRepeatdf,plogger)
 
+@functools.lru_cache(maxsize=None)
+def is_patient_invariant(value):
+    '''
+    Check if the value of an expression is the same for all repeats of a patient.
+    This is the case for GLOB, SET_, AUTO and DROP, and for SRCH and __IF statements built only from those
+    (for SRCH only the searched values count, the attribute and table names are literals).
+
+    Args:
+    value (str): The expression.
+
+    Returns:
+    bool: True if the expression does not depend on the repeat data.
+    '''
+    value = value.strip()
+    if value[:4] in ("GLOB", "SET_", "AUTO", "DROP"):
+        return True
+    elif value[:4] == "SRCH":
+        return all(is_patient_invariant(argument) for argument in parse_arguments(value)[3::2])
+    elif value[:4] == "__IF":
+        return all(is_patient_invariant(argument) for argument in parse_arguments(value))
+    return False
+
+@functools.lru_cache(maxsize=None)
+def parse_arguments(value):
+    '''
+    Parse the arguments of a function expression like "SRCH(w, SET_(x), y, z)" -> ("w", "SET_(x)", "y", "z")
+    The result is cached, as the same expressions are parsed for every row of every patient.
+
+    Args:
+    value (str): The expression.
+
+    Returns:
+    tuple: The stripped arguments.
+    '''
+    return tuple(item.strip() for item in split_string(str(value)[5:-1]))
+
 def replace_SETvalue_with_value(value,plogger):
     '''
     Replace "SET(xyz)" with "xyz" in the specified column
@@ -128,13 +195,30 @@ def get_value_from_df(value, df,plogger):
 
     plogger.debug("UTILS: Get value from PatienDF for %s", value)
     try:
-        value = df[df["field_name"] == value]["value"].values[0]
+        value = field_values(value, df)[0]
         plogger.debug("UTILS: Found Value in PatienDF: %s", value)
     except:
         plogger.warning("UTILS: Value not found in PatienDF: %s", value)
         value = "NULL"    
     return value
       
+def field_values(field_name, df):
+    '''
+    Get all values of a field from the repeat data, a data frame or the instance of a MULT entity (see MultInstance).
+    The values of the MULT field are taken from the row of the instance, the values of all other fields from the shared rows,
+    so an instance is read without copying the shared rows.
+
+    Args:
+    field_name (str): The field_name.
+    df (pandas.DataFrame or MultInstance): The repeat data.
+
+    Returns:
+    numpy.ndarray: The values of the field.
+    '''
+    if isinstance(df, MultInstance):
+        df = df.key_row if (df.key_row["field_name"].values == field_name).any() else df.base_rows
+    return df.loc[df["field_name"] == field_name, "value"].values
+
 def replace_LISTvalue_with_values(value,df,plogger):
     '''
     Replace "LIST(x)" with [x1,x2,x3]
@@ -150,7 +234,7 @@ def replace_LISTvalue_with_values(value,df,plogger):
     plogger.debug("Replace LIST value with values for %s", value)
     value = value[5:-1]
     try:
-        x_values = df.loc[df["field_name"] == value, "value"].values
+        x_values = field_values(value, df)
         plogger.debug("UTILS: LIST: Found following values for %s in df: %s",value,x_values)
         return list(x_values)
     except:
@@ -158,7 +242,7 @@ def replace_LISTvalue_with_values(value,df,plogger):
         plogger.warning("UTILS: LIST: No values found in df: %s", value)
         return x_values
 
-def replace_SRCHvalue_with_value(value,df,patient_df,plogger):
+def replace_SRCHvalue_with_value(value,df,patient_df,plogger,patient_cache=None):
     '''
     Replace "SRCH(searchedattribute,entity,(attribute,redcapattribute)*x)" with SQL statement to get the value, (SELECT searchedattribute FROM entity WHERE (attribute = redcapattribute)*x
     Example: SRCH(id,demographics,race,race,ethnicity,ethnicity, gender,gender,dob,dob) -> SELECT id FROM demographics WHERE race = race AND ethnicity ... AND dob = dob
@@ -168,6 +252,7 @@ def replace_SRCHvalue_with_value(value,df,patient_df,plogger):
     df (pandas.DataFrame): The DataFrame containing the single entity repeat data.
     patient_df (pandas.DataFrame): The DataFrame containing the whole patient data.
     plogger (logging.Logger): The logger object.
+    patient_cache (dict): Cache for values which do not change within a patient (see getRedCapValue).
 
     Returns:
     str: Select-statement, like SELECT searchedattribute FROM entity WHERE (attribute = redcapattribute)*x
@@ -175,12 +260,7 @@ def replace_SRCHvalue_with_value(value,df,patient_df,plogger):
 
     plogger.debug("UTILS: Replace SRCH-statement [%s] with select statement.", value)
     # split the string into entity, entity_name and redcapattribute
-    string = str(value)
-    string = string[5:-1]
-    # Split the string using function split_string
-    strings = split_string(string)
-    # Strip whitespace from the results
-    strings = [item.strip() for item in strings]
+    strings = parse_arguments(value)
     plogger.debug("Strings: %s", strings)
 
     # Check by length if the SRCH statement is valid
@@ -211,7 +291,7 @@ def replace_SRCHvalue_with_value(value,df,patient_df,plogger):
     redcapvalues = []
     for attribute, redcapattribute in zip(attributes, redcapattributes):
         # Recursively call getRedCapValue for each redcapattribute
-        redcapvalue = getRedCapValue(redcapattribute,df,patient_df,plogger)
+        redcapvalue = getRedCapValue(redcapattribute,df,patient_df,plogger,patient_cache)
         if redcapvalue is None:
             redcapvalue = "NULL"
         redcapvalues.append(redcapvalue)
@@ -222,17 +302,19 @@ def replace_SRCHvalue_with_value(value,df,patient_df,plogger):
     plogger.debug("UTILS: SQL Statement: %s", sql_statement)
     return sql_statement
 
-def replace_IFvalue_with_value(value,df,patient_df,plogger):
+def replace_IFvalue_with_value(value,df,patient_df,plogger,patient_cache=None):
     '''
     Replace "__IF(x,y,a,b)" with a if y in x.list else b in the specified column
     Check which values x stands for, if it is a field_name, get the values from the df and replace it with x
     Check IF Statement __IF(x,y,a,b): if y in x.list then a else b
+    Only the condition (x and y) and the chosen branch are evaluated, the other branch is never computed.
 
     Args:
     value (str): The IF statement.
     df (pandas.DataFrame): The DataFrame containing the single entity repeat data.
     patient_df (pandas.DataFrame): The DataFrame containing the whole patient data.
     plogger (logging.Logger): The logger object.
+    patient_cache (dict): Cache for values which do not change within a patient (see getRedCapValue).
 
     Returns:
     str: The replaced value.
@@ -240,13 +322,7 @@ def replace_IFvalue_with_value(value,df,patient_df,plogger):
   
     # split the string into entity, entity_name and redcapattribute
     plogger.debug("UTILS: Replace IF value %s", value)
-    string = str(value)
-    string = string[5:-1]
-
-    # Split the string using function split_string
-    strings = split_string(string)
-    # Strip whitespace from the results
-    strings = [item.strip() for item in strings]
+    strings = parse_arguments(value)
     # Check by length if the IF statement is valid
     if len(strings) != 4:
         plogger.error("Unvalid IF statetment: %s", value)
@@ -254,40 +330,38 @@ def replace_IFvalue_with_value(value,df,patient_df,plogger):
     plogger.debug("Valid IF statetment: %s", value)
 
     # Extract the x, y, a and b values
-    x = strings[0].strip()
-    y = strings[1].strip()
-    a = strings[2].strip()
-    b = strings[3].strip()
+    x, y, a, b = strings
     plogger.debug("x: %s", x)
     plogger.debug("y: %s", y)
     plogger.debug("a: %s", a)
     plogger.debug("b: %s", b)
 
-    # Recursively call getRedCapValue for each redcapattribute
-    x = getRedCapValue(x,df,patient_df,plogger)
-    y = getRedCapValue(y,df,patient_df,plogger)
-    a = getRedCapValue(a,df,patient_df,plogger)
-    b = getRedCapValue(b,df,patient_df,plogger)
+    # Recursively call getRedCapValue for the condition
+    x = getRedCapValue(x,df,patient_df,plogger,patient_cache)
+    y = getRedCapValue(y,df,patient_df,plogger,patient_cache)
 
-    def eval_if_statement(x, y, a, b):
+    def eval_if_condition(x, y):
         plogger.debug("CHECK IF: y (equal)|(in) x then a else b  %s", value)
         plogger.debug("x: %s", x)
         plogger.debug("y: %s", y)
-        plogger.debug("a: %s", a)
-        plogger.debug("b: %s", b)
         if type(x) is str and type(y) is str:
-            return a if y == x else b
+            return y == x
         elif type(x) is list and type(y) is str:
-            return a if y in x else b
+            return y in x
         elif type(x) is str and type(y) is list:
-            return a if x in y else b
+            return x in y
         elif type(x) is list and type(y) is list:
-            return a if any([item in x for item in y]) else b
+            return any([item in x for item in y])
         else:
             plogger.error("Unvalid IF statetment: x is a %s", type(x))
             return None
 
-    value = eval_if_statement(x, y, a, b)
+    condition = eval_if_condition(x, y)
+    if condition is None:
+        return None
+
+    # Recursively call getRedCapValue only for the chosen branch
+    value = getRedCapValue(a if condition else b,df,patient_df,plogger,patient_cache)
 
     plogger.debug("Final IF Value: %s", value)
     return value
@@ -326,6 +400,21 @@ def split_string(input_string):
 
     return sub_strings
 
+def clean_mapping_table(mapping):
+    '''
+    Drop the rows of a mapping table which are not assigned (no field_name) or are generated by the database (AUTO)
+
+    Args:
+    mapping (pandas.DataFrame): The mapping data of ONE entity.
+
+    Returns:
+    pandas.DataFrame: The cleaned mapping data.
+    '''
+    # shorten mapping table / Drop those which are not assigned
+    mapping = mapping.dropna(subset=['field_name'])
+    # clean mapping table
+    return mapping[~mapping["field_name"].str.contains('AUTO', case=True)]
+
 def drop_rows_with_NULL(df, column_name):
     '''
     Drop rows equals the keyword 'NULL' in the 'columname' column 
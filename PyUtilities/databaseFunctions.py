@@ -1,20 +1,165 @@
 import sqlite3
+import hashlib
 import re
 import os
+import threading
+import contextlib
+import itertools
+import weakref
 import pandas as pd
 import logging
 
 # Configure logger
 workflow_logger = logging.getLogger('workflow_logger')
 
-def create_database(database_name, database_sql ,wipe=False):
+# Search statements as generated by generate_search_statement, with literal values only (see parse_search_statement)
+SEARCH_STATEMENT = re.compile(r"\(SELECT (\w+) FROM (\w+) WHERE (.*)\)", re.DOTALL)
+SEARCH_CONDITION = re.compile(r"(\w+) (?:IS NULL|= ('(?:[^']|'')*'|\d+(?:\.\d+)?))(?: AND |$)")
+# Numbers as written in the data (see coerce_values)
+INTEGER_VALUE = r"[+-]?\d+"
+REAL_VALUE = r"[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?"
+
+# Cache of parsed schema files
+SCHEMA_CACHE = {}
+
+# Pooled connections, per thread and database file (see get_connection)
+CONNECTIONS = {}
+CONNECTIONS_LOCK = threading.Lock()
+# The owner of the pooled connections of a thread, its connections are closed when the thread ends
+THREAD_CONNECTIONS = threading.local()
+CONNECTION_OWNERS = itertools.count()
+# Prepared statements kept per connection, the insert statements of a table are the same for every batch
+CACHED_STATEMENTS = 512
+# PRAGMAs of every pooled connection
+CONNECTION_PRAGMAS = ("PRAGMA temp_store=MEMORY;", "PRAGMA cache_size=-16384;")
+# Table of the loaded batches in the destination database, written in the transaction of each batch (see record_loaded_batch)
+LOADED_BATCHES_TABLE = "etl_loaded_batches"
+
+class ConnectionOwner:
+    """
+    The owner of the pooled connections of one thread, kept in THREAD_CONNECTIONS.
+    When the thread ends, its thread-local data and so its owner are released, which closes its connections.
+    """
+    def __init__(self):
+        self.number = next(CONNECTION_OWNERS)
+        weakref.finalize(self, close_owner_connections, self.number)
+
+def get_connection(db_file):
+    """
+    This function returns the pooled connection of the current thread to a SQLite database, it is opened if needed.
+    The connections are in autocommit mode (use transaction for transactions), with the CONNECTION_PRAGMAS
+    and a statement cache of CACHED_STATEMENTS. A connection to a database file which was removed or replaced
+    since it was opened is opened again. The connections of a thread are closed when the thread ends
+    (e.g. a worker of a pool which is shut down), so short-lived threads do not leave open files behind.
+
+    Args:
+    db_file (str): The path to the SQLite database.
+
+    Returns:
+    sqlite3.Connection: The connection, only to be used by the current thread.
+    """
+    owner = getattr(THREAD_CONNECTIONS, 'owner', None)
+    if owner is None:
+        owner = THREAD_CONNECTIONS.owner = ConnectionOwner()
+    key = (owner.number, os.path.abspath(db_file))
+    with CONNECTIONS_LOCK:
+        pooled = CONNECTIONS.get(key)
+    if pooled is not None:
+        if pooled[1] == database_file_id(db_file):
+            return pooled[0]
+        pooled[0].close()
+
+    conn = sqlite3.connect(db_file, isolation_level=None, check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    with CONNECTIONS_LOCK:
+        CONNECTIONS[key] = (conn, database_file_id(db_file))
+    return conn
+
+def close_owner_connections(number):
+    """
+    This function closes the pooled connections of a thread which ended (see ConnectionOwner).
+
+    Args:
+    number (int): The number of the owner of the connections.
+
+    Returns:
+    None
+    """
+    with CONNECTIONS_LOCK:
+        keys = [key for key in CONNECTIONS if key[0] == number]
+        connections = [CONNECTIONS.pop(key)[0] for key in keys]
+    for conn in connections:
+        conn.close()
+
+def database_file_id(db_file):
+    """
+    This function identifies a database file by its device and inode, to notice a removed or replaced file.
+
+    Args:
+    db_file (str): The path to the SQLite database.
+
+    Returns:
+    tuple: The device and inode, or None if the file does not exist.
+    """
+    try:
+        stat = os.stat(db_file)
+    except OSError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+def close_connections(db_file=None):
+    """
+    This function closes the pooled connections of all threads to a database file, e.g. before the file is removed.
+
+    Args:
+    db_file (str): The path to the SQLite database, or None to close all connections.
+
+    Returns:
+    None
+    """
+    path = os.path.abspath(db_file) if db_file is not None else None
+    with CONNECTIONS_LOCK:
+        keys = [key for key in CONNECTIONS if path is None or key[1] == path]
+        connections = [CONNECTIONS.pop(key)[0] for key in keys]
+    for conn in connections:
+        conn.close()
+
+@contextlib.contextmanager
+def transaction(db_file):
+    """
+    This function opens a transaction on the pooled connection to a SQLite database (see get_connection).
+    The transaction is committed at the end of the with block, or rolled back if the block raises an exception.
+
+    Args:
+    db_file (str): The path to the SQLite database.
+
+    Yields:
+    sqlite3.Connection: The connection.
+    """
+    conn = get_connection(db_file)
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def create_database(database_name, database_sql ,wipe=False, template_dir=None):
     """
     This function creates a new SQLite database using the provided SQL schema.
+    If a template directory is given, the database is copied from the empty template database of the schema
+    (see get_template_database) with the SQLite backup API, which also replaces the content of an existing database
+    instead of dropping its tables and running the schema again. If the template cannot be built or copied
+    (e.g. the template directory is missing, read-only or full), the database is created from the schema.
 
     Args:
     database_name (str): The name of the database.
     database_sql (str): The path to the SQL schema file.
     wipe (bool): A flag to indicate if the database should be wiped if it already exists.
+    template_dir (str): The directory of the template databases, or None to run the schema.
 
     Returns:
     None
@@ -22,39 +167,70 @@ def create_database(database_name, database_sql ,wipe=False):
 
     # First check if the database already exists
     if os.path.exists(database_name):
-        if wipe:
+        if wipe and template_dir is None:
             wipe_sqlite_database(database_name)
             workflow_logger.info("Database wiped: %s", database_name)
         # If the database already exists, return
-        else:
+        elif not wipe:
             workflow_logger.info("Database have not been wiped: %s", database_name)
             return None
-        
-    try:
-        # Create a connection to the database
-        conn = sqlite3.connect(database_name)
 
-        # Create a cursor object to interact with the database
-        cursor = conn.cursor()
+    if template_dir is not None:
+        try:
+            template = get_template_database(database_sql, template_dir)
+            get_connection(template).backup(get_connection(database_name))
+            workflow_logger.info("Database created from template %s: %s", template, database_name)
+            return None
+        except (sqlite3.Error, OSError) as e:
+            # e.g. a missing, read-only or full template directory, the database is created from the schema instead
+            workflow_logger.warning("Database Creation: An error occurred: template %s, the database is created from the SQL schema", e)
+        if wipe and os.path.exists(database_name):
+            wipe_sqlite_database(database_name)
+            workflow_logger.info("Database wiped: %s", database_name)
 
+    try:
         # Open the SQL script file and read the content
         with open(database_sql, 'r') as sql_file:
             script = sql_file.read()
         workflow_logger.debug("Database schema loaded")
 
         # Execute the SQL script to initialize the database
-        cursor.executescript(script)
-        conn.commit()
+        get_connection(database_name).executescript(script)
         workflow_logger.info("Database created: %s", database_name)
 
-    except sqlite3.Error as e:
-        workflow_logger.error("Database Creation: An error occurred: SQL-shema", e)
+    except (sqlite3.Error, OSError) as e:
+        workflow_logger.error("Database Creation: An error occurred: SQL-shema %s", e)
         return None
-    
-    finally:
-        # Close the database connection
-        conn.close()
 
+def get_template_database(database_sql, template_dir):
+    """
+    This function returns the empty template database of a SQL schema, it is built once per version of the schema.
+    The template is named after the hash of the schema file, a changed schema gets a new template.
+
+    Args:
+    database_sql (str): The path to the SQL schema file.
+    template_dir (str): The directory of the template databases.
+
+    Returns:
+    str: The path to the template database.
+    """
+    with open(database_sql, 'rb') as sql_file:
+        schema_hash = hashlib.sha256(sql_file.read()).hexdigest()
+    template = os.path.join(template_dir, f'template-{schema_hash[:16]}.db')
+    if os.path.exists(template):
+        return template
+
+    # Build the template next to its final place and move it there, so no half-built template is used
+    os.makedirs(template_dir, exist_ok=True)
+    building = f'{template}.{os.getpid()}.tmp'
+    try:
+        with open(database_sql, 'r') as sql_file:
+            get_connection(building).executescript(sql_file.read())
+    finally:
+        close_connections(building)
+    os.replace(building, template)
+    workflow_logger.info("Template database created: %s", template)
+    return template
 
 def wipe_sqlite_database(db_name):
     """
@@ -68,31 +244,175 @@ def wipe_sqlite_database(db_name):
     """
 
     try:
-        # Connect to the SQLite database
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-
-        # Get all table names
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name != 'sqlite_sequence';")
-        tables = cursor.fetchall()
-        
-        # Drop all tables
-        for table_name in tables:
-            cursor.execute(f"DROP TABLE {table_name[0]};")
-            workflow_logger.debug(f"Table {table_name[0]} dropped")
-
-        # Commit the changes and close the connection
-        conn.commit()
-        conn.close()
+        with transaction(db_name) as conn:
+            # Get all table names
+            tables = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name != 'sqlite_sequence';").fetchall()
+
+            # Drop all tables
+            for table_name in tables:
+                conn.execute(f"DROP TABLE {table_name[0]};")
+                workflow_logger.debug(f"Table {table_name[0]} dropped")
         workflow_logger.debug("Database wiped: %s", db_name)
 
     except sqlite3.Error as e:
         workflow_logger.error("Database Creation (Wiping-step): An error occurred:", e)
         return None
 
+def delete_table_rows(db_file, tables):
+    """
+    This function deletes all rows of some tables of a SQLite database, in one transaction.
+    Tables which are not in the database are left out.
+
+    Args:
+    db_file (str): The path to the SQLite database.
+    tables (set): The names of the tables (case insensitive).
+
+    Returns:
+    dict: The number of deleted rows per table.
+    """
+    deleted = {}
+    with transaction(db_file) as conn:
+        existing = [name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name != 'sqlite_sequence';")]
+        for table_name in existing:
+            if table_name.lower() in tables:
+                deleted[table_name] = conn.execute(f"DELETE FROM `{table_name}`").rowcount
+    return deleted
+
+def read_schema(database_sql):
+    """
+    This function reads the tables of a SQL schema file.
+    The schema is created in an in-memory database and read with PRAGMA statements, the result is cached per file version.
+    The in-memory database is not pooled (see get_connection), it only lives for one schema.
+
+    Args:
+    database_sql (str): The path to the SQL schema file.
+
+    Returns:
+    dict: Per table (lower case name) a dict with
+          name (declared name), columns (list), types (declared type per column), notnull (set of columns),
+          primary_key (list of columns), foreign_keys (list of (column, referenced table (lower case), referenced column)),
+          unique (list of column lists of the unique indexes and constraints).
+    """
+    stat = os.stat(database_sql)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    cached = SCHEMA_CACHE.get(database_sql)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    conn = sqlite3.connect(':memory:')
+    try:
+        with open(database_sql, 'r') as sql_file:
+            conn.executescript(sql_file.read())
+        schema = {}
+        for (table_name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name != 'sqlite_sequence';").fetchall():
+            columns = conn.execute(f"PRAGMA table_info(`{table_name}`)").fetchall()
+            table = {
+                'name': table_name,
+                'columns': [column[1] for column in columns],
+                'types': {column[1]: column[2] for column in columns},
+                'notnull': {column[1] for column in columns if column[3]},
+                'primary_key': [column[1] for column in sorted(columns, key=lambda column: column[5]) if column[5]],
+                'foreign_keys': [(fk[3], fk[2].lower(), fk[4]) for fk in conn.execute(f"PRAGMA foreign_key_list(`{table_name}`)").fetchall()],
+                'unique': [],
+            }
+            for index in conn.execute(f"PRAGMA index_list(`{table_name}`)").fetchall():
+                if index[2]:
+                    table['unique'].append([info[2] for info in conn.execute(f"PRAGMA index_info(`{index[1]}`)").fetchall()])
+            schema[table_name.lower()] = table
     finally:
-        # Close the database connection
         conn.close()
+    SCHEMA_CACHE[database_sql] = (signature, schema)
+    return schema
+
+def column_affinity(declared_type):
+    """
+    This function determines the type affinity of a column from its declared type, with the rules of SQLite
+    (https://www.sqlite.org/datatype3.html#determination_of_column_affinity).
+
+    Args:
+    declared_type (str): The declared type of the column, e.g. VARCHAR(20).
+
+    Returns:
+    str: The affinity: INTEGER, TEXT, BLOB, REAL or NUMERIC.
+    """
+    declared_type = (declared_type or '').upper()
+    if 'INT' in declared_type:
+        return 'INTEGER'
+    if any(name in declared_type for name in ('CHAR', 'CLOB', 'TEXT')):
+        return 'TEXT'
+    if 'BLOB' in declared_type or not declared_type:
+        return 'BLOB'
+    if any(name in declared_type for name in ('REAL', 'FLOA', 'DOUB')):
+        return 'REAL'
+    return 'NUMERIC'
+
+def read_column_types(schema):
+    """
+    This function reads the type affinity of every column of a schema (see column_affinity).
+
+    Args:
+    schema (dict): The schema, as returned by read_schema.
+
+    Returns:
+    dict: Per table (lower case name) a dict of column (lower case) -> affinity.
+    """
+    return {table_name: {column.lower(): column_affinity(declared_type) for column, declared_type in table['types'].items()}
+            for table_name, table in schema.items()}
+
+def deduplicate_rows(table_name, rows, schema, seen=None):
+    """
+    This function drops the rows which the database would ignore as duplicates (INSERT OR IGNORE), before they are loaded.
+    Each row is hashed on the columns of every unique key (UNIQUE constraints and indexes, primary key) of the table.
+    A row is dropped if one of its keys was already seen. Like in SQLite, the first row wins.
+    The rows are deduplicated after their search statements are resolved (see resolve_search_values):
+    keys with a NULL or an unresolved search statement (a subquery, which could find NULL) are not compared,
+    as SQLite treats NULLs as distinct in a unique key. Only rows which are certain to be inserted
+    (all NOT NULL columns have a value which is not a subquery) are remembered,
+    so no row is dropped which the database would have inserted.
+
+    Args:
+    table_name (str): The name of the table.
+    rows (list): The rows (dicts of column -> value) in load order.
+    schema (dict): The schema, as returned by read_schema.
+    seen (set): The keys seen so far, to deduplicate over several batches of the table.
+
+    Returns:
+    tuple: The remaining rows (list) and the number of dropped rows (int).
+    """
+    table = schema.get(table_name.lower())
+    if table is None:
+        return rows, 0
+    unique_keys = [[column.lower() for column in key] for key in table['unique']]
+    if table['primary_key']:
+        unique_keys.append([column.lower() for column in table['primary_key']])
+    if not unique_keys:
+        return rows, 0
+    notnull = [column.lower() for column in table['notnull']]
+    seen = set() if seen is None else seen
+
+    remaining = []
+    for row in rows:
+        values = {column.lower(): value for column, value in row.items()}
+        row_keys = [(number, tuple(values.get(column) for column in key)) for number, key in enumerate(unique_keys)]
+        row_keys = [row_key for row_key in row_keys if not any(value is None or is_subquery(value) for value in row_key[1])]
+        if any(row_key in seen for row_key in row_keys):
+            continue
+        remaining.append(row)
+        if all(values.get(column) is not None and not is_subquery(values[column]) for column in notnull):
+            seen.update(row_keys)
+    return remaining, len(rows) - len(remaining)
+
+def is_subquery(value):
+    """
+    This function checks if a value of a row is a subquery (a value in brackets, e.g. a search statement).
+
+    Args:
+    value: The value.
+
+    Returns:
+    bool: True if the value is a subquery.
+    """
+    return isinstance(value, str) and value.startswith('(') and value.endswith(')')
 
 def generate_insert_statement(table_name, data):
     """
@@ -118,6 +438,82 @@ def generate_insert_statement(table_name, data):
     
     return insert_statement
 
+def coerce_values(rows, column_types=None):
+    """
+    This function converts the values of rows to the Python types of their columns, one column at a time.
+    Numbers are converted to int or float for INTEGER, REAL and NUMERIC columns (signs and exponents included),
+    the values of TEXT and BLOB columns are kept as they are (e.g. zip codes with leading zeros).
+    For columns which are not in the schema, unsigned numbers are converted, as by generate_insert_statement.
+    Subqueries (values in brackets, e.g. search statements) and values which are no strings are not converted.
+
+    Args:
+    rows (list): The rows (dicts of column -> value).
+    column_types (dict): The affinity per column (lower case) of the table (see read_column_types), or None.
+
+    Returns:
+    list: The rows with the converted values.
+    """
+    column_types = column_types or {}
+    coerced = [dict(row) for row in rows]
+    for column in {column for row in rows for column in row}:
+        affinity = column_types.get(column.lower())
+        if affinity in ('TEXT', 'BLOB'):
+            continue
+        positions = [number for number, row in enumerate(rows)
+                     if isinstance(row.get(column), str) and not (row[column].startswith('(') and row[column].endswith(')'))]
+        if not positions:
+            continue
+        values = pd.Series([rows[number][column] for number in positions], index=positions, dtype=object)
+        if affinity is None:
+            integers = values.str.fullmatch(r"\d+")
+            reals = values.str.fullmatch(r"\d+\.\d+")
+        elif affinity == 'REAL':
+            integers = pd.Series(False, index=values.index)
+            reals = values.str.fullmatch(REAL_VALUE)
+        else:
+            integers = values.str.fullmatch(INTEGER_VALUE)
+            reals = values.str.fullmatch(REAL_VALUE) & ~integers
+        for number, value in values[integers].items():
+            value = int(value)
+            # SQLite stores integers with 64 bits, larger numbers are REAL
+            coerced[number][column] = value if -2**63 <= value < 2**63 else float(value)
+        for number, value in values[reals].items():
+            coerced[number][column] = float(value)
+    return coerced
+
+def generate_parameterized_insert(table_name, data, column_types=None):
+    """
+    This function generates an insert statement with parameters for a given table and data.
+    The values are bound as parameters, so they keep their Python type (see coerce_values).
+    Subqueries (values in brackets) are part of the statement, the literal values of search statements
+    (see parse_search_statement) are bound as parameters as well, typed like the columns of the searched table,
+    so rows of the same columns share one statement.
+
+    Args:
+    table_name (str): The name of the table.
+    data (dict): The data to be inserted.
+    column_types (dict): The affinity per column of every table (see read_column_types), or None.
+
+    Returns:
+    tuple: The insert statement (str) and the parameters (list).
+    """
+    values = []
+    parameters = []
+    for value in data.values():
+        if not (isinstance(value, str) and value.startswith('(') and value.endswith(')')):
+            values.append('?')
+            parameters.append(value)
+            continue
+        search = parse_search_statement(value, column_types)
+        if search is None:
+            values.append(value)
+            continue
+        searched_attribute, table, conditions = search
+        values.append(f"(SELECT {searched_attribute} FROM {table} WHERE "
+                      + ' AND '.join(f"{attribute} IS NULL" if literal is None else f"{attribute} = ?" for attribute, literal in conditions) + ")")
+        parameters.extend(literal for _, literal in conditions if literal is not None)
+    return f"INSERT OR IGNORE INTO {table_name} ({', '.join(data.keys())}) VALUES ({', '.join(values)});", parameters
+
 def generate_search_statement(searched_attribute,table,attributes,redcapvalues):
     """
     This function generates an search statement for a given table and data.
@@ -131,14 +527,10 @@ def generate_search_statement(searched_attribute,table,attributes,redcapvalues):
     Returns:
     str: The search statement.
     """
-    # add ' before and after
-    redcapvalues = [f"'{value}'" for value in redcapvalues]
-    # remove ' before and after numeric values to avoid SQL errors
-    redcapvalues = [re.sub(r"'(\d+(\.\d+)?)'", r'\1', value) for value in redcapvalues]
-    # remove ' before opening brackets to avoid SQL errors
-    redcapvalues = [re.sub(r"'(\()", r'\1', value) for value in redcapvalues]
-    # remove ' after closing brackets to avoid SQL errors
-    redcapvalues = [re.sub(r"(\))'", r'\1', value) for value in redcapvalues]
+    # Quote every value, also numbers, so a TEXT value keeps its leading zeros (the literals are typed at load time,
+    # see parse_search_statement), nested search statements stay subqueries
+    redcapvalues = [str(value) if str(value).startswith('(') and str(value).endswith(')') else "'" + str(value).replace("'", "''") + "'"
+                    for value in redcapvalues]
 
     sql_statement = f"(SELECT {searched_attribute} FROM {table} WHERE {attributes[0]} = {redcapvalues[0]}"
     for attribute, redcapvalue in zip(attributes[1:], redcapvalues[1:]):
@@ -146,15 +538,130 @@ def generate_search_statement(searched_attribute,table,attributes,redcapvalues):
     sql_statement += ")"
     return fix_sql_query(sql_statement)
 
+def parse_search_statement(value, column_types=None):
+    """
+    This function parses a search statement (see generate_search_statement) whose values are literals.
+    The literals are converted to the types of the columns of the searched table, like the inserted values
+    (see coerce_literal), so they can be bound as parameters.
+
+    Args:
+    value (str): The value of a row.
+    column_types (dict): The affinity per column of every table (see read_column_types), or None.
+
+    Returns:
+    tuple: The searched attribute, the table and the conditions (tuple of (attribute, value), None for IS NULL),
+           or None if the value is no search statement or has nested statements.
+    """
+    match = SEARCH_STATEMENT.fullmatch(value) if isinstance(value, str) else None
+    if match is None:
+        return None
+    searched_attribute, table, conditions = match.groups()
+    table_types = (column_types or {}).get(table.lower(), {})
+    parsed = []
+    position = 0
+    while position < len(conditions):
+        condition = SEARCH_CONDITION.match(conditions, position)
+        if condition is None:
+            return None
+        attribute, literal = condition.groups()
+        if literal is None:
+            parsed.append((attribute, None))
+        elif literal.startswith("'"):
+            parsed.append((attribute, coerce_literal(literal[1:-1].replace("''", "'"), table_types.get(attribute.lower()))))
+        else:
+            # Unquoted numbers, as written by earlier versions of generate_search_statement
+            parsed.append((attribute, coerce_literal(literal, table_types.get(attribute.lower()), quoted=False)))
+        position = condition.end()
+    return searched_attribute, table, tuple(parsed)
+
+def coerce_literal(literal, affinity, quoted=True):
+    """
+    This function converts a literal of a search statement to the Python type of the searched column,
+    with the rules of coerce_values: numbers become int or float for INTEGER, REAL and NUMERIC columns,
+    the values of TEXT and BLOB columns are kept as text (e.g. zip codes with leading zeros).
+    For columns which are not in the schema, quoted literals are kept as text and unquoted numbers are converted.
+
+    Args:
+    literal (str): The literal, without quotes.
+    affinity (str): The affinity of the searched column (see column_affinity), or None.
+    quoted (bool): False if the literal was an unquoted number in the statement.
+
+    Returns:
+    str, int or float: The value.
+    """
+    if affinity in ('TEXT', 'BLOB') or (affinity is None and quoted):
+        return literal
+    if affinity != 'REAL' and re.fullmatch(INTEGER_VALUE, literal):
+        value = int(literal)
+        # SQLite stores integers with 64 bits, larger numbers are REAL
+        return value if -2**63 <= value < 2**63 else float(value)
+    if re.fullmatch(REAL_VALUE, literal):
+        return float(literal)
+    return literal
+
+def resolve_search_values(db_file, table_name, rows, column_types=None):
+    """
+    This function resolves the search statements of rows set-based, instead of one subquery per row at insert time.
+    The values searched by the rows are inserted into a temporary table, one per searched table and attributes,
+    and resolved with one UPDATE ... FROM joining the searched table. Like the subquery, the first matching row
+    (lowest rowid) is taken. Values which are not found, nested search statements and searches of the table itself
+    (which could find rows of the same batch) are left as search statements.
+    If the lookups fail (e.g. UPDATE ... FROM needs SQLite 3.33), the rows are returned unchanged.
+
+    Args:
+    db_file (str): The path to the SQLite database.
+    table_name (str): The name of the table of the rows.
+    rows (list): The rows (dicts of column -> value).
+    column_types (dict): The affinity per column of every table (see read_column_types), to type the searched values.
+
+    Returns:
+    list: The rows, with the resolved values instead of the search statements.
+    """
+    lookups = {}
+    for number, row in enumerate(rows):
+        for column, value in row.items():
+            parsed = parse_search_statement(value, column_types)
+            if parsed is None or parsed[1].lower() == table_name.lower() or all(v is None for _, v in parsed[2]):
+                continue
+            searched_attribute, table, conditions = parsed
+            shape = (searched_attribute, table, tuple((attribute, v is None) for attribute, v in conditions))
+            lookups.setdefault(shape, []).append((number, column) + tuple(v for _, v in conditions if v is not None))
+    if not lookups:
+        return rows
+
+    resolved = [dict(row) for row in rows]
+    conn = get_connection(db_file)
+    try:
+        for (searched_attribute, table, conditions), keys in lookups.items():
+            attributes = [attribute for attribute, is_null in conditions if not is_null]
+            null_attributes = [attribute for attribute, is_null in conditions if is_null]
+            values = [f"v{number}" for number in range(len(attributes))]
+            # The key columns have no type, the values are typed like the searched columns (see parse_search_statement)
+            conn.execute("DROP TABLE IF EXISTS temp.search_keys")
+            conn.execute(f"CREATE TEMP TABLE search_keys(number, column_name, {', '.join(values)}, result)")
+            conn.executemany(f"INSERT INTO temp.search_keys(number, column_name, {', '.join(values)}) VALUES ({', '.join('?' * (len(values) + 2))})", keys)
+            where = f"WHERE {' AND '.join(f'{attribute} IS NULL' for attribute in null_attributes)}" if null_attributes else ""
+            conn.execute(f"""UPDATE temp.search_keys SET result = found.result
+                             FROM (SELECT {searched_attribute} AS result, {', '.join(f'{attribute} AS k{number}' for number, attribute in enumerate(attributes))}, MIN(rowid)
+                                   FROM {table} {where} GROUP BY {', '.join(attributes)}) AS found
+                             WHERE {' AND '.join(f'found.k{number} = search_keys.v{number}' for number in range(len(attributes)))}""")
+            for number, column, result in conn.execute("SELECT number, column_name, result FROM temp.search_keys WHERE result IS NOT NULL"):
+                resolved[number][column] = result
+    except sqlite3.Error as e:
+        workflow_logger.warning("Search statements of %s are resolved row by row: %s", table_name, e)
+        return rows
+    finally:
+        conn.execute("DROP TABLE IF EXISTS temp.search_keys")
+    return resolved
+
 def execute_sql_statement(sql_statement, db_file):
     """
     :param db_file: complete file path to db
     :param sql_statement: insert statement creating the new entry if it doesn't exist yet
     :return: None or the result of the query
     """
-    # Connect to the SQLite database
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
+    # The pooled connection is in autocommit mode, an update, delete or insert is committed by itself
+    cursor = get_connection(db_file).cursor()
 
     try:
         # Execute the SQL statement
@@ -165,9 +672,7 @@ def execute_sql_statement(sql_statement, db_file):
             rows = cursor.fetchall()
             return rows
 
-        # If the statement is an update, delete, or insert, commit the changes
         else:
-            conn.commit()
             workflow_logger.debug(f"Statement:{sql_statement}: ran successfully")
             return "Statement executed successfully."
 
@@ -176,9 +681,7 @@ def execute_sql_statement(sql_statement, db_file):
         return f"Statement:{sql_statement}: failed: {e}"
 
     finally:
-        # Close the database connection
         cursor.close()
-        conn.close()
 
 def execute_sql_script(sql_script, db_file):
     """
@@ -191,53 +694,170 @@ def execute_sql_script(sql_script, db_file):
     Returns:
     None
     """
-    # Connect to the SQLite database
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-
     try:
         # Execute the SQL script
-        cursor.executescript(sql_script)
-        conn.commit()
+        get_connection(db_file).executescript(sql_script)
         return "successfully."
 
     except sqlite3.Error as e:
         workflow_logger.exception("SQL script execution failed:", e)
         return e
 
-    finally:
-        # Close the database connection
-        cursor.close()
-        conn.close()
+def execute_insert_statements(statements, db_file, batch_key=None):
+    """
+    This function executes insert statements on a SQLite database in one transaction, one statement at a time,
+    and reports the outcome of every statement: inserted, ignored (INSERT OR IGNORE did not insert a row) or failed.
+    A failing statement is logged and does not stop the other statements.
 
-# Data check Function
-def data_check(db_file):
+    Args:
+    statements (list): The insert statements, as str or as tuples of statement and parameters (see generate_parameterized_insert).
+    db_file (str): The path to the SQLite database.
+    batch_key (tuple): If given, the run and the name of the batch, recorded as loaded in the same transaction (see record_loaded_batch).
+
+    Returns:
+    list: The outcome of every statement, or the error if the transaction failed.
     """
-    Function to check if the data was loaded into the database.
-    It retrieves the number of rows in each table and logs the result.
-    :param db_file: complete file path to db
-    :return: None
+    outcomes = []
+    try:
+        with transaction(db_file) as conn:
+            for statement in statements:
+                try:
+                    cursor = conn.execute(*statement) if isinstance(statement, tuple) else conn.execute(statement)
+                    outcomes.append('inserted' if cursor.rowcount > 0 else 'ignored')
+                except sqlite3.Error as e:
+                    workflow_logger.error(f"Statement:{statement}: failed: {e}")
+                    outcomes.append('failed')
+            if batch_key is not None:
+                record_loaded_batch(conn, *batch_key)
+        return outcomes
+
+    except sqlite3.Error as e:
+        workflow_logger.exception("Insert statements failed: %s", e)
+        return e
+
+def record_loaded_batch(conn, run, batch):
     """
-    # Connect to the SQLite database
-    conn = sqlite3.connect(db_file)
-    
-    # Create a cursor object
-    cursor = conn.cursor()
-    
-    # Execute the SQL query to retrieve all table names
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    
-    # Fetch the result of the query
-    tables = cursor.fetchall()
-    
-    # For each table, execute a SQL query to count the number of rows
-    for table in tables:
-      cursor.execute(f"SELECT COUNT(*) FROM {table[0]}")
-      count = cursor.fetchone()[0]
-      workflow_logger.info(f"Data check: Table {table[0]} has {count} rows.")
-    
-    # Close the connection to the database
-    conn.close()
+    This function records a batch as loaded in the destination database, to be called in the transaction of the batch.
+    The batch and its record are committed together, so a resumed run (see is_batch_loaded) never loads a batch twice,
+    even if the process stopped before the batch was recorded in the run journal.
+
+    Args:
+    conn (sqlite3.Connection): The connection, in the transaction of the batch.
+    run (str): The run (the input hash of the run journal).
+    batch (str): The name of the batch.
+
+    Returns:
+    None
+    """
+    conn.execute(f"CREATE TABLE IF NOT EXISTS main.{LOADED_BATCHES_TABLE} (run TEXT, batch TEXT, PRIMARY KEY (run, batch)) WITHOUT ROWID")
+    conn.execute(f"INSERT OR IGNORE INTO main.{LOADED_BATCHES_TABLE} (run, batch) VALUES (?, ?)", (run, batch))
+
+def is_batch_loaded(db_file, run, batch):
+    """
+    This function checks if a batch was recorded as loaded in the destination database (see record_loaded_batch).
+
+    Args:
+    db_file (str): The path to the SQLite database.
+    run (str): The run (the input hash of the run journal).
+    batch (str): The name of the batch.
+
+    Returns:
+    bool: True if the batch was loaded.
+    """
+    conn = get_connection(db_file)
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (LOADED_BATCHES_TABLE,)).fetchone() is None:
+        return False
+    return conn.execute(f"SELECT 1 FROM {LOADED_BATCHES_TABLE} WHERE run = ? AND batch = ?", (run, batch)).fetchone() is not None
+
+def clear_loaded_batches(db_file):
+    """
+    This function removes the records of the loaded batches from the destination database, once the load is complete.
+
+    Args:
+    db_file (str): The path to the SQLite database.
+
+    Returns:
+    None
+    """
+    get_connection(db_file).execute(f"DROP TABLE IF EXISTS {LOADED_BATCHES_TABLE}")
+
+def merge_shard_database(db_file, shard_db, tables, counts=None, batch_key=None):
+    """
+    This function merges a shard database into a SQLite database, in one transaction.
+    The tables are copied with INSERT OR IGNORE ... SELECT in the given order (referenced tables first).
+    Surrogate keys (INTEGER PRIMARY KEY not taken from the data) get new values, the rows of the shard are moved
+    behind the rows of the database. Rows which are ignored, as an equal row is already in the database, are mapped to
+    that row by their unique key. The columns referencing a surrogate key (FOREIGN KEY or SRCH) are remapped accordingly.
+
+    Args:
+    db_file (str): The path to the SQLite database.
+    shard_db (str): The path to the shard database.
+    tables (list): Per table a dict with name, columns (list), surrogate_key (column or None),
+                   unique (list of column lists) and remap (column -> lower case name of the referenced table).
+    counts (dict): If given, the number of rows inserted into each table (lower case name) is added to it.
+    batch_key (tuple): If given, the run and the name of the merge, recorded as loaded in the same transaction (see record_loaded_batch).
+
+    Returns:
+    str: "successfully." or the error.
+    """
+    conn = get_connection(db_file)
+    try:
+        conn.execute("ATTACH DATABASE ? AS shard", (shard_db,))
+        conn.execute("DROP TABLE IF EXISTS temp.id_map")
+        conn.execute("CREATE TEMP TABLE id_map(tbl TEXT, old_id INTEGER, new_id INTEGER, PRIMARY KEY(tbl, old_id)) WITHOUT ROWID")
+        conn.execute("BEGIN")
+        for table in tables:
+            name = table['name']
+            surrogate_key = table['surrogate_key']
+
+            def value_of(column):
+                # The new value of a column of the shard row s
+                if column in table['remap']:
+                    return f"(SELECT new_id FROM temp.id_map WHERE tbl = '{table['remap'][column]}' AND old_id = s.`{column}`)"
+                return f"s.`{column}`"
+
+            columns = [column for column in table['columns'] if column != surrogate_key]
+            column_list = ', '.join(f"`{column}`" for column in columns)
+            value_list = ', '.join(value_of(column) for column in columns)
+            if surrogate_key is None:
+                inserted = conn.execute(f"INSERT OR IGNORE INTO main.`{name}` ({column_list}) SELECT {value_list} FROM shard.`{name}` AS s").rowcount
+                if counts is not None:
+                    counts[name.lower()] = counts.get(name.lower(), 0) + inserted
+                continue
+
+            # Move the surrogate keys of the shard behind the ones of the database
+            offset = conn.execute(f"SELECT COALESCE(MAX(`{surrogate_key}`), 0) FROM main.`{name}`").fetchone()[0]
+            inserted = conn.execute(f"""INSERT OR IGNORE INTO main.`{name}` (`{surrogate_key}`, {column_list})
+                             SELECT s.`{surrogate_key}` + {offset}, {value_list} FROM shard.`{name}` AS s ORDER BY s.`{surrogate_key}`""").rowcount
+            if counts is not None:
+                counts[name.lower()] = counts.get(name.lower(), 0) + inserted
+            # Map the inserted rows, all keys above the offset come from the shard
+            conn.execute(f"""INSERT INTO temp.id_map SELECT '{name.lower()}', s.`{surrogate_key}`, s.`{surrogate_key}` + {offset}
+                             FROM shard.`{name}` AS s WHERE EXISTS (SELECT 1 FROM main.`{name}` AS m WHERE m.`{surrogate_key}` = s.`{surrogate_key}` + {offset})""")
+            # Map the ignored rows to the equal row of the database
+            for unique in table['unique']:
+                if surrogate_key in unique:
+                    continue
+                condition = ' AND '.join(f"m.`{column}` = {value_of(column)}" for column in unique)
+                conn.execute(f"""INSERT OR IGNORE INTO temp.id_map SELECT '{name.lower()}', s.`{surrogate_key}`, m.`{surrogate_key}`
+                                 FROM shard.`{name}` AS s JOIN main.`{name}` AS m ON {condition}
+                                 WHERE NOT EXISTS (SELECT 1 FROM temp.id_map WHERE tbl = '{name.lower()}' AND old_id = s.`{surrogate_key}`)""")
+        if batch_key is not None:
+            record_loaded_batch(conn, *batch_key)
+        conn.execute("COMMIT")
+        return "successfully."
+
+    except sqlite3.Error as e:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        workflow_logger.exception("Shard merge failed: %s", shard_db)
+        return e
+
+    finally:
+        # The connection is pooled, so it must not keep the shard
+        conn.execute("DROP TABLE IF EXISTS temp.id_map")
+        if any(database[1] == 'shard' for database in conn.execute("PRAGMA database_list")):
+            conn.execute("DETACH DATABASE shard")
 
 def fix_sql_query(sql_query):
     """
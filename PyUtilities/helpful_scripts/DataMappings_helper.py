@@ -1,4 +1,6 @@
+import argparse
 import json
+import os
 import sqlite3
 import csv
 
@@ -61,23 +63,85 @@ def write_to_csv(table_attributes, path):
 
     print(f"Total {counter} CSV files created.")
 
+def collect_search_lookups(mapping_tables):
+    # Collect the lookup column sets of all SRCH statements of the compiled mapping tables
+    from ETL.Transform.planner import find_search_lookups
+    from ETL.Transform.transform_utils import clean_mapping_table
+
+    lookups = set()
+    for mapping_file, mapping in mapping_tables:
+        for field_name in clean_mapping_table(mapping)["field_name"]:
+            lookups.update(find_search_lookups(field_name))
+    return sorted(lookups)
+
+def advise_indexes(lookups, sql_file):
+    # Create the schema in memory and ask the query planner how each lookup is searched
+    conn = sqlite3.connect(':memory:')
+    with open(sql_file, 'r') as f:
+        conn.executescript(f.read())
+
+    statements = []
+    for table, searched, columns in lookups:
+        where = ' AND '.join(f"{column} = ?" for column in columns)
+        try:
+            plan = conn.execute(f"EXPLAIN QUERY PLAN SELECT {searched} FROM {table} WHERE {where}", [None] * len(columns)).fetchall()
+        except sqlite3.Error as e:
+            print(f"Skipping lookup on {table}({', '.join(columns)}): {e}")
+            continue
+        # The lookup is served if an index is used with an equality on every searched column
+        detail = ' '.join(row[-1] for row in plan)
+        if 'USING' in detail and detail.count('=?') >= len(columns):
+            print(f"Lookup on {table}({', '.join(columns)}) is served: {detail}")
+            continue
+        print(f"Lookup on {table}({', '.join(columns)}) needs an index: {detail}")
+        # Add the searched attribute to the index, so the lookup does not need to read the table
+        # (an INTEGER PRIMARY KEY is the rowid, which every index holds anyway)
+        primary_key = [(column[1], column[2].upper()) for column in conn.execute(f"PRAGMA table_info(`{table}`)").fetchall() if column[5]]
+        is_rowid = primary_key == [(searched, 'INTEGER')]
+        index_columns = list(columns) + ([searched] if searched not in columns and not is_rowid else [])
+        index_name = f"srch_{table}_" + '_'.join(columns)
+        statements.append(f"CREATE INDEX IF NOT EXISTS `{index_name}` ON `{table}`({', '.join(f'`{column}`' for column in index_columns)});")
+    conn.close()
+    return statements
+
+def write_index_file(statements, path):
+    with open(path, 'w') as file:
+        file.write('-- Indexes for the SRCH lookups of the mapping tables (DataMappings_helper.py --indexes)\n')
+        for statement in statements:
+            file.write(statement + '\n')
+    print(f"Total {len(statements)} indexes written to {path}.")
+
 # Main function
-# Read Config file to specify the input and output file paths
-config_file = 'config.json'
-with open(config_file, 'r') as f:
-    config = json.load(f)
-    sql_file = config['db_schema']   # Input SQL file
-    table_path = config['mapping_path']   # Output CSV file
+if __name__ == "__main__":
+    # Read Config file to specify the input and output file paths
+    parser = argparse.ArgumentParser(description="Create the mapping table templates of a schema, or the indexes for the SRCH lookups of the mapping tables.")
+    parser.add_argument('--indexes', metavar='INDEX_FILE', help="write a CREATE INDEX file for the SRCH lookups which no index of the schema serves (run from the repository root)")
+    args = parser.parse_args()
 
-# Extract table attributes
-table_attributes = extract_table_attributes(sql_file)
+    config_file = 'config.json'
+    with open(config_file, 'r') as f:
+        config = json.load(f)
+        sql_file = config['db_schema']   # Input SQL file
+        table_path = config['mapping_path']   # Output CSV file
 
-# check if there are already csv files in the folder
-import os
-files = os.listdir(table_path)
-if len(files) > 0:
-    print(f"Files already exist in the folder: {table_path}. Are you sure you want to overwrite the existing ones? Please delete the files and run the script again.")
-    exit()
+    if args.indexes:
+        # The mapping tables are compiled like in the workflow, which reads the config file of the current directory
+        import sys
+        sys.path.insert(0, os.getcwd())
+        from ETL.Transform.planner import compile_mapping_plan
+
+        lookups = collect_search_lookups(compile_mapping_plan()['mapping_tables'])
+        write_index_file(advise_indexes(lookups, sql_file), args.indexes)
+        sys.exit()
+
+    # Extract table attributes
+    table_attributes = extract_table_attributes(sql_file)
+
+    # check if there are already csv files in the folder
+    files = os.listdir(table_path)
+    if len(files) > 0:
+        print(f"Files already exist in the folder: {table_path}. Are you sure you want to overwrite the existing ones? Please delete the files and run the script again.")
+        exit()
 
-# Write the table attributes to CSV
-write_to_csv(table_attributes, table_path)
+    # Write the table attributes to CSV
+    write_to_csv(table_attributes, table_path)
@@ -0,0 +1,192 @@
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+# Local stand-in of the REDCap API, to test the extraction (e.g. large exports) without a REDCap server.
+# It serves the records of an extraction file (the format written by the extraction), repeated with new record IDs:
+#
+#   python PyUtilities/helpful_scripts/redcap_stand_in.py ClassicDB_example/rawdata/ClassicDatabase_DATA.csv --copies 10000 \
+#          --mapping-path ClassicDB_example/mappingtables
+#
+# and set "extract_redcap": true, "redcap_api_address": "http://127.0.0.1:8765/api/" and a token of 32 characters in the config file.
+# The metadata (data dictionary) lists the fields of the source, the fields of a data dictionary file (--dictionary)
+# and the fields referenced by mapping tables (--mapping-path), as a real data dictionary also lists fields no record has filled in.
+
+# The mapping expressions are parsed like in the workflow
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from ETL.Transform.transform_utils import getAllOccurringAttributes
+
+def read_source(source_path):
+    """
+    This function reads the rows of an extraction file.
+
+    Args:
+    source_path (str): The path to the extraction file.
+
+    Returns:
+    tuple: The columns (without the index column) and the rows (lists of values).
+    """
+    with open(source_path, 'r', encoding='utf-8', newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        rows = [row[1:] for row in reader]
+    return header[1:], rows
+
+def read_dictionary_fields(dictionary_path):
+    """
+    This function reads the fields of a REDCap data dictionary file (CSV, the field names in the first column).
+
+    Args:
+    dictionary_path (str): The path to the data dictionary file.
+
+    Returns:
+    list: The fields.
+    """
+    with open(dictionary_path, 'r', encoding='utf-8', newline='') as file:
+        reader = csv.reader(file)
+        next(reader)
+        return [row[0] for row in reader if row and row[0]]
+
+def read_mapping_fields(mapping_path):
+    """
+    This function reads the fields referenced by the field_name expressions of the mapping tables of a folder.
+    Like in the workflow (see planner.list_referenced_fields), the list also holds the other arguments of the expressions.
+
+    Args:
+    mapping_path (str): The path to the folder of the mapping tables.
+
+    Returns:
+    list: The fields.
+    """
+    field_names = []
+    for mapping_file in sorted(os.listdir(mapping_path)):
+        if not mapping_file.endswith('.csv'):
+            continue
+        with open(os.path.join(mapping_path, mapping_file), 'r', encoding='utf-8', newline='') as file:
+            field_names.extend(row['field_name'] for row in csv.DictReader(file)
+                               if row.get('field_name') and 'AUTO' not in row['field_name'])
+    return getAllOccurringAttributes(field_names)
+
+def generate_records(columns, rows, copies, records=None, fields=None):
+    """
+    This function generates the rows of the export, the source rows once per copy, the record IDs of the copies get a suffix.
+
+    Args:
+    columns (list): The columns of the source.
+    rows (list): The rows of the source.
+    copies (int): The number of copies.
+    records (set): Only generate the rows of these record IDs, or None for all records.
+    fields (set): Only generate the rows of these fields, or None for all fields.
+
+    Yields:
+    list: The values of one row.
+    """
+    field_column = columns.index('field_name')
+    for copy in range(copies):
+        for row in rows:
+            record = row[0] if copy == 0 else f"{row[0]}-{copy}"
+            if (records is None or record in records) and (fields is None or row[field_column] in fields):
+                yield [record] + row[1:]
+
+def build_handler(columns, rows, copies, def_field, extra_fields=()):
+    """
+    This function builds the request handler of the stand-in for the rows of a source.
+
+    Args:
+    columns (list): The columns of the source.
+    rows (list): The rows of the source.
+    copies (int): The number of copies.
+    def_field (str): The record ID field of the project.
+    extra_fields (list): Fields of the metadata which are not in the rows (e.g. of a data dictionary file).
+
+    Returns:
+    type: The request handler class.
+    """
+    field_column = columns.index('field_name')
+    fields = dict.fromkeys([row[field_column] for row in rows] + list(extra_fields))
+    field_names = [def_field] + [field for field in fields if field != def_field]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            payload = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            content = payload.get('content', [''])[0]
+            records = {value[0] for key, value in payload.items() if key.startswith('records[')} or None
+            fields = {value[0] for key, value in payload.items() if key.startswith('fields[')} or None
+            if content == 'metadata':
+                self.send_json([{'field_name': field, 'form_name': 'form'} for field in field_names])
+            elif content == 'record' and payload.get('format', [''])[0] == 'json':
+                record_ids = dict.fromkeys(row[0] for row in generate_records(columns, rows, copies, records))
+                self.send_json([{def_field: record} for record in record_ids])
+            elif content == 'record':
+                self.send_csv(generate_records(columns, rows, copies, records, fields))
+            else:
+                self.send_error(400, f"content {content} is not supported by the stand-in")
+
+        def send_json(self, data):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_csv(self, records):
+            # The export is generated while it is sent, in chunks, compressed if the client accepts it
+            compressor = zlib.compressobj(wbits=31) if 'gzip' in self.headers.get('Accept-Encoding', '') else None
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv; charset=utf-8')
+            self.send_header('Transfer-Encoding', 'chunked')
+            if compressor is not None:
+                self.send_header('Content-Encoding', 'gzip')
+            self.end_headers()
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator='\n')
+            writer.writerow(columns)
+            for number, record in enumerate(records, 1):
+                writer.writerow(record)
+                if number % 10000 == 0:
+                    self.send_chunk(buffer, compressor)
+            self.send_chunk(buffer, compressor)
+            if compressor is not None:
+                self.write_chunk(compressor.flush())
+            self.wfile.write(b'0\r\n\r\n')
+
+        def send_chunk(self, buffer, compressor):
+            data = buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            self.write_chunk(compressor.compress(data) if compressor is not None else data)
+
+        def write_chunk(self, data):
+            if data:
+                self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+
+    return Handler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in of the REDCap API serving the records of an extraction file")
+    parser.add_argument('source', help="the extraction file with the records to serve")
+    parser.add_argument('--copies', type=int, default=1, help="serve the records this many times, with new record IDs")
+    parser.add_argument('--def-field', dest='def_field', default='record_id', help="the record ID field of the project")
+    parser.add_argument('--dictionary', help="a REDCap data dictionary file (CSV), its fields are listed in the metadata")
+    parser.add_argument('--mapping-path', dest='mapping_path', help="a folder of mapping tables, the fields they reference are listed in the metadata")
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    columns, rows = read_source(args.source)
+    extra_fields = []
+    if args.dictionary:
+        extra_fields.extend(read_dictionary_fields(args.dictionary))
+    if args.mapping_path:
+        extra_fields.extend(read_mapping_fields(args.mapping_path))
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), build_handler(columns, rows, args.copies, args.def_field, extra_fields))
+    print(f"Serving {len(rows) * args.copies} rows on http://127.0.0.1:{args.port}/api/")
+    server.serve_forever()
@@ -0,0 +1,119 @@
+import os
+import json
+import threading
+import logging
+
+# Configure logger
+workflow_logger = logging.getLogger('workflow_logger')
+
+# Lock for the journal, patients are recorded from several threads
+JOURNAL_LOCK = threading.Lock()
+
+def open_run_journal(journal_path, input_hash):
+    """
+    This function opens the run journal.
+    The journal is an append-only file with one JSON event per line, the first line records the input hash of the run.
+    If the journal belongs to an unfinished run with the same input hash, the run is resumed and the recorded
+    checkpoints are returned. Otherwise a new journal is started.
+
+    Args:
+    journal_path (str): The path to the journal file.
+    input_hash (str): The fingerprint of the run input.
+
+    Returns:
+    dict: The journal with the keys path, input_hash, resumed and one set of keys per recorded event.
+    """
+    journal = {'path': journal_path, 'input_hash': input_hash, 'resumed': False,
+               'patient': set(), 'table': set(), 'batch': set(), 'database_ready': set()}
+
+    events = read_journal_events(journal_path)
+    if events and events[0].get('input_hash') == input_hash and not any(e['event'] == 'finished' for e in events):
+        journal['resumed'] = True
+        for event in events[1:]:
+            if event['event'] in journal:
+                journal[event['event']].add(event['key'])
+        workflow_logger.info("Resuming unfinished run %s: %s patients transformed, %s batches loaded",
+                             input_hash[:12], len(journal['patient']), len(journal['batch']))
+        return journal
+
+    # Start a new journal
+    os.makedirs(os.path.dirname(journal_path) or '.', exist_ok=True)
+    with open(journal_path, 'w') as file:
+        file.write(json.dumps({'event': 'started', 'input_hash': input_hash}) + '\n')
+    workflow_logger.debug("Run journal started: %s", journal_path)
+    return journal
+
+def read_journal_events(journal_path):
+    """
+    This function reads all events of a journal file.
+    A last line which was cut off by a crash is ignored.
+
+    Args:
+    journal_path (str): The path to the journal file.
+
+    Returns:
+    list: The events (dicts) of the journal.
+    """
+    if not os.path.exists(journal_path):
+        return []
+    events = []
+    with open(journal_path, 'r') as file:
+        for line in file:
+            try:
+                events.append(json.loads(line))
+            except json.JSONDecodeError:
+                workflow_logger.warning("Run journal: ignoring incomplete entry %s", line.strip())
+    return events
+
+def record_journal_event(journal, event, key):
+    """
+    This function records a checkpoint in the journal.
+    The entry is flushed to disk before the function returns, so it survives a crash of the process.
+
+    Args:
+    journal (dict): The journal, as returned by open_run_journal. If None, nothing is recorded.
+    event (str): The kind of checkpoint: patient, table, batch or database_ready.
+    key (str): The key of the checkpoint, e.g. the patient ID, the mapping filename or the batch name.
+
+    Returns:
+    None
+    """
+    if journal is None:
+        return
+    with JOURNAL_LOCK:
+        with open(journal['path'], 'a') as file:
+            file.write(json.dumps({'event': event, 'key': key}) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        journal[event].add(key)
+
+def is_journaled(journal, event, key):
+    """
+    This function checks if a checkpoint was already recorded in the journal.
+
+    Args:
+    journal (dict): The journal, as returned by open_run_journal. If None, nothing is recorded.
+    event (str): The kind of checkpoint: patient, table, batch or database_ready.
+    key (str): The key of the checkpoint.
+
+    Returns:
+    bool: True if the checkpoint was recorded.
+    """
+    return journal is not None and key in journal[event]
+
+def finish_run_journal(journal):
+    """
+    This function marks the run of the journal as finished, a later run with the same input starts from scratch.
+
+    Args:
+    journal (dict): The journal, as returned by open_run_journal.
+
+    Returns:
+    None
+    """
+    if journal is None:
+        return
+    with JOURNAL_LOCK:
+        with open(journal['path'], 'a') as file:
+            file.write(json.dumps({'event': 'finished'}) + '\n')
+    workflow_logger.debug("Run journal finished: %s", journal['path'])
@@ -0,0 +1,55 @@
+import os
+import sys
+import logging
+try:
+    import resource
+except ImportError:
+    # resource is not available on Windows, the peak memory is then not reported
+    resource = None
+
+# Configure logger
+workflow_logger = logging.getLogger('workflow_logger')
+
+def current_rss_mb():
+    """
+    This function returns the memory (resident set size) the process uses at the moment.
+    It is read from /proc, so it is only available on Linux.
+
+    Returns:
+    float: The memory in MB, or None if it is not available.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            pages = int(file.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+def peak_rss_mb():
+    """
+    This function returns the highest memory (resident set size) the process used so far.
+
+    Returns:
+    float: The memory in MB, or None if it is not available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, in KB elsewhere
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def over_memory_budget(budget_mb, other_mb=0):
+    """
+    This function checks if the process uses more memory than the budget.
+
+    Args:
+    budget_mb (float): The memory budget in MB, or None for no budget.
+    other_mb (float): The memory of other processes counted against the budget (e.g. worker processes), in MB.
+
+    Returns:
+    bool: True if the budget is reached, False if not or if the memory of the process is not known.
+    """
+    if not budget_mb:
+        return False
+    rss = current_rss_mb()
+    return rss is not None and rss + other_mb >= budget_mb
@@ -1,12 +1,54 @@
 import os
+import collections.abc
+import contextlib
+import contextvars
 import datetime
+import hashlib
 import json
+import threading
 import pandas as pd
 import logging
 
 # Configure logger
 workflow_logger = logging.getLogger('workflow_logger')
 
+# Configuration per file path, shared by all modules
+CONFIG_CACHE = {}
+# Configuration of the project running in the current thread (see project_context)
+ACTIVE_PROJECT = contextvars.ContextVar('active_project', default=None)
+
+class RunConfig(collections.abc.MutableMapping):
+    """
+    The configuration shared by all modules.
+    Within project_context, the keys are looked up in the configuration of the running project,
+    otherwise in the configuration file.
+    """
+    def __init__(self, config_data):
+        self.base = config_data
+
+    def current(self):
+        project = ACTIVE_PROJECT.get()
+        return self.base if project is None else project
+
+    def __getitem__(self, key):
+        return self.current()[key]
+
+    def __setitem__(self, key, value):
+        self.current()[key] = value
+
+    def __delitem__(self, key):
+        del self.current()[key]
+
+    def __iter__(self):
+        return iter(self.current())
+
+    def __len__(self):
+        return len(self.current())
+
+# Cache of parsed mapping tables, kept warm between runs of a long-running process
+MAPPING_CACHE = {}
+MAPPING_CACHE_LOCK = threading.Lock()
+
 def add_timestamp_to_filename(filename):
     """
     Adds a timestamp for versioning to the filename.
@@ -29,13 +71,17 @@ def add_timestamp_to_filename(filename):
 def read_config_file(file_path):
     """
     This function checks if the configuration file exists and loads it.
+    The file is read once, every module gets the same configuration, so changes of the configuration at runtime
+    (e.g. the run options of the command line) apply to all modules.
 
     Args:
     file_path (str): The path to the configuration file.
 
     Returns:
-    dict: The configuration data.
+    RunConfig: The configuration data, of the running project within project_context.
     """
+    if file_path in CONFIG_CACHE:
+        return CONFIG_CACHE[file_path]
     try:
         with open(file_path, 'r') as file:
             config_data = json.load(file)
@@ -43,7 +89,49 @@ def read_config_file(file_path):
     except FileNotFoundError:
         workflow_logger.error(f"Configuration file not found at {file_path}, search path: {os.getcwd()}")
         raise
-    return config_data
+    CONFIG_CACHE[file_path] = RunConfig(config_data)
+    return CONFIG_CACHE[file_path]
+
+def list_project_configs(config):
+    """
+    This function lists the configurations of the projects of a configuration file.
+    Every entry of the "projects" list overrides keys of the configuration file (e.g. redcap_project, redcap_api_token,
+    extraction_path, data_path, mapping_path, db_path) for one project. Without "projects", the file describes one project.
+
+    Args:
+    config (RunConfig): The configuration, as returned by read_config_file.
+
+    Returns:
+    list: The configurations (dicts) of the projects, each with a "name".
+    """
+    base = {key: value for key, value in config.base.items() if key != 'projects'}
+    projects = []
+    for number, project in enumerate(config.base.get('projects') or [{}]):
+        project_config = dict(base)
+        project_config.update(project)
+        project_config.setdefault('name', project_config.get('redcap_project') or f'project-{number}')
+        projects.append(project_config)
+    names = [project['name'] for project in projects]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        workflow_logger.error(f"The names of the projects have to be unique, found several projects named {duplicates}")
+        exit()
+    return projects
+
+@contextlib.contextmanager
+def project_context(project_config):
+    """
+    This context manager makes a project configuration the configuration of the current thread (see RunConfig).
+    Threads started in the context have to be started with a copy of it (contextvars.copy_context).
+
+    Args:
+    project_config (dict): The configuration of the project, see list_project_configs.
+    """
+    token = ACTIVE_PROJECT.set(project_config)
+    try:
+        yield project_config
+    finally:
+        ACTIVE_PROJECT.reset(token)
 
 def csvs_reader(folder_path):
     # Get a list of all CSV files in the folder
@@ -62,4 +150,61 @@ def csvs_reader(folder_path):
         workflow_logger.debug("Read in: %s", str(csv_path))
         
         # Yield the DataFrame to the caller
-        yield df
\ No newline at end of file
+        yield df
+
+def list_mapping_files(folder_path):
+    """
+    Lists the mapping CSVs of a folder, sorted by filename.
+
+    Args:
+    folder_path (str): The path to the mapping folder.
+
+    Returns:
+    list: The full paths of the mapping CSVs.
+    """
+    csv_files = sorted(file for file in os.listdir(folder_path) if file.endswith('.csv'))
+    return [os.path.join(folder_path, csv_file) for csv_file in csv_files]
+
+def read_mapping_tables(folder_path):
+    """
+    Reads all mapping CSVs of a folder and keeps them cached.
+    The cache is keyed by the name, size and modification time of every mapping file,
+    so the CSVs are only parsed again when one of them changed.
+
+    Args:
+    folder_path (str): The path to the mapping folder.
+
+    Returns:
+    list: Tuples of (filename, pandas.DataFrame) sorted by filename.
+    """
+    csv_paths = list_mapping_files(folder_path)
+    signature = tuple((path, os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in csv_paths)
+    with MAPPING_CACHE_LOCK:
+        cached = MAPPING_CACHE.get(folder_path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        mapping_tables = [(os.path.basename(path), pd.read_csv(path)) for path in csv_paths]
+        MAPPING_CACHE[folder_path] = (signature, mapping_tables)
+        workflow_logger.debug("Mapping tables (re)loaded: %s", [name for name, _ in mapping_tables])
+    return mapping_tables
+
+def compute_input_hash(data, file_paths):
+    """
+    Computes a fingerprint of the run input: the extracted data and the content of the given files
+    (mapping tables, database schema). Two runs with the same fingerprint produce the same result.
+
+    Args:
+    data (pandas.DataFrame): The extracted data.
+    file_paths (list): Paths of files the result depends on.
+
+    Returns:
+    str: The hex digest of the input.
+    """
+    digest = hashlib.sha256()
+    digest.update(','.join(map(str, data.columns)).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+    for file_path in file_paths:
+        digest.update(file_path.encode('utf-8'))
+        with open(file_path, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
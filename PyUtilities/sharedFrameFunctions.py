@@ -0,0 +1,110 @@
+import logging
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+
+# Configure logger
+workflow_logger = logging.getLogger('workflow_logger')
+
+# Code of a missing value in the codes of a shared frame
+MISSING_CODE = -1
+
+def publish_frame(data):
+    """
+    This function publishes an encoded copy of a data frame (the EAV data of the extraction) in shared memory,
+    once for all process workers, instead of pickling the rows of every patient to the workers.
+    The copy is integer-coded: every cell holds the code of its value in a pool of the distinct values (as text).
+    Building it takes a temporary object array of all cells in the publishing process, besides the blocks.
+    The rows are ordered by record (records in the order of their first row, rows of a record in their order),
+    so the rows of a record are one slice. Four blocks are published: the codes (rows x columns), the value pool (UTF-8),
+    the offsets of the values in the pool and the offsets of the records in the codes.
+
+    Args:
+    data (pandas.DataFrame): The data, the first column holds the record ID.
+
+    Returns:
+    tuple: The descriptor of the frame (dict, to be passed to the workers, see attach_frame)
+           and the shared memory blocks (list, to be released with release_frame when the workers are done).
+    """
+    id_col_name = data.columns[0]
+    record_rows = data.groupby(id_col_name, sort=False, dropna=False).indices
+    records = list(record_rows.keys())
+    order = np.concatenate([record_rows[record] for record in records]) if records else np.zeros(0, dtype=np.int64)
+    record_offsets = np.zeros(len(records) + 1, dtype=np.int64)
+    record_offsets[1:] = np.cumsum([len(record_rows[record]) for record in records])
+
+    # Code the cells of all columns with one pool of values
+    codes, uniques = pd.factorize(data.to_numpy(dtype=object)[order].ravel(), use_na_sentinel=True)
+    code_dtype = np.int32 if len(uniques) < 2**31 else np.int64
+    codes = codes.astype(code_dtype).reshape(len(order), len(data.columns))
+    encoded = [str(value).encode('utf-8') for value in uniques]
+    pool_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    pool_offsets[1:] = np.cumsum([len(value) for value in encoded])
+    pool = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    blocks = []
+    descriptor = {'columns': list(data.columns), 'records': records}
+    try:
+        for key, array in (('codes', codes), ('pool', pool), ('pool_offsets', pool_offsets), ('record_offsets', record_offsets)):
+            block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+            blocks.append(block)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            descriptor[key] = {'name': block.name, 'shape': array.shape, 'dtype': array.dtype.str}
+    except Exception:
+        release_frame(blocks)
+        raise
+    workflow_logger.info("Shared frame published: %s rows, %s records, %s distinct values, %.1f MB",
+                         len(order), len(records), len(uniques), sum(block.size for block in blocks) / 2**20)
+    return descriptor, blocks
+
+def attach_frame(descriptor):
+    """
+    This function attaches a process to a frame published with publish_frame. The arrays are views of the shared memory.
+
+    Args:
+    descriptor (dict): The descriptor of the frame.
+
+    Returns:
+    dict: The frame, with the keys columns, records (record ID -> number), blocks and the arrays
+          codes, pool, pool_offsets and record_offsets.
+    """
+    frame = {'columns': descriptor['columns'], 'records': {record: number for number, record in enumerate(descriptor['records'])}, 'blocks': []}
+    for key in ('codes', 'pool', 'pool_offsets', 'record_offsets'):
+        block = shared_memory.SharedMemory(name=descriptor[key]['name'])
+        frame['blocks'].append(block)
+        frame[key] = np.ndarray(descriptor[key]['shape'], dtype=np.dtype(descriptor[key]['dtype']), buffer=block.buf)
+    return frame
+
+def read_record_frame(frame, record):
+    """
+    This function reads the rows of one record from a shared frame (see attach_frame).
+    The codes of the record are a slice of the shared codes (no copy), the distinct values of the record are decoded
+    from the pool into a new data frame of the record, which is a copy owned by the worker.
+
+    Args:
+    frame (dict): The attached frame.
+    record (str): The record ID.
+
+    Returns:
+    pandas.DataFrame: The rows of the record, with a new index, missing values are NaN.
+    """
+    number = frame['records'][record]
+    codes = frame['codes'][frame['record_offsets'][number]:frame['record_offsets'][number + 1]]
+    distinct, positions = np.unique(codes, return_inverse=True)
+    pool, offsets = frame['pool'], frame['pool_offsets']
+    values = np.array([np.nan if code == MISSING_CODE else pool[offsets[code]:offsets[code + 1]].tobytes().decode('utf-8') for code in distinct], dtype=object)
+    return pd.DataFrame(values[positions.reshape(codes.shape)], columns=frame['columns'])
+
+def release_frame(blocks):
+    """
+    This function releases the shared memory blocks of a published frame.
+
+    Args:
+    blocks (list): The blocks, as returned by publish_frame.
+
+    Returns:
+    None
+    """
+    for block in blocks:
+        block.close()
+        block.unlink()
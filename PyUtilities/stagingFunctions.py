@@ -0,0 +1,242 @@
+import os
+import json
+import sqlite3
+import threading
+import logging
+
+# Configure logger
+workflow_logger = logging.getLogger('workflow_logger')
+
+# One connection per staging database, shared by the transform threads
+STAGING_CONNECTIONS = {}
+STAGING_LOCK = threading.Lock()
+# Seconds to wait for a lock of the staging database, the transform processes stage their rows concurrently
+STAGING_TIMEOUT = 60
+
+STAGING_SCHEMA = """
+CREATE TABLE IF NOT EXISTS staged_rows(
+    id INTEGER PRIMARY KEY,
+    level INTEGER NOT NULL,
+    entity TEXT NOT NULL,
+    mapping_file TEXT NOT NULL,
+    patient_id TEXT NOT NULL,
+    row TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS staged_rows_entity ON staged_rows(level, entity, id);
+CREATE INDEX IF NOT EXISTS staged_rows_patient ON staged_rows(patient_id);
+"""
+
+def staging_path(data_path):
+    """
+    This function returns the path to the staging database in the data folder.
+
+    Args:
+    data_path (str): The path to the data folder.
+
+    Returns:
+    str: The path to the staging database.
+    """
+    return os.path.join(data_path, 'staging.db')
+
+def open_staging(staging_db, reset=False):
+    """
+    This function opens the staging database of a run.
+    The staging database holds the rows created by the transformation, one table for all entities and patients,
+    until they are loaded entity by entity into the destination database.
+
+    Args:
+    staging_db (str): The path to the staging database.
+    reset (bool): A flag to indicate if the rows of a previous run should be removed.
+
+    Returns:
+    None
+    """
+    with STAGING_LOCK:
+        if staging_db in STAGING_CONNECTIONS:
+            STAGING_CONNECTIONS.pop(staging_db).close()
+        if reset:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(staging_db + suffix):
+                    os.remove(staging_db + suffix)
+        os.makedirs(os.path.dirname(staging_db) or '.', exist_ok=True)
+        conn = sqlite3.connect(staging_db, check_same_thread=False, timeout=STAGING_TIMEOUT)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.executescript(STAGING_SCHEMA)
+        STAGING_CONNECTIONS[staging_db] = conn
+    workflow_logger.debug("Staging database opened: %s", staging_db)
+
+def get_staging_connection(staging_db):
+    """
+    This function returns the connection to a staging database, it is opened if needed.
+
+    Args:
+    staging_db (str): The path to the staging database.
+
+    Returns:
+    sqlite3.Connection: The connection, only to be used while holding STAGING_LOCK.
+    """
+    if staging_db not in STAGING_CONNECTIONS:
+        open_staging(staging_db)
+    return STAGING_CONNECTIONS[staging_db]
+
+def stage_rows(staging_db, rows):
+    """
+    This function appends rows to the staging database, in one transaction.
+
+    Args:
+    staging_db (str): The path to the staging database.
+    rows (list): Tuples of (level, entity, mapping_file, patient_id, row), row being a dict of attribute -> value.
+
+    Returns:
+    int: The number of staged rows.
+    """
+    records = [(level, entity, mapping_file, str(patient_id), json.dumps(row)) for level, entity, mapping_file, patient_id, row in rows]
+    conn = get_staging_connection(staging_db)
+    with STAGING_LOCK:
+        with conn:
+            conn.executemany("INSERT INTO staged_rows(level, entity, mapping_file, patient_id, row) VALUES (?, ?, ?, ?, ?)", records)
+    return len(records)
+
+def discard_unfinished_rows(staging_db, patients, mapping_files, column_mapping_files):
+    """
+    This function removes the rows of an interrupted run which were staged by unfinished work:
+    rows of per-patient entities of patients which are not finished, and rows of column-wise mapping tables which are not finished.
+
+    Args:
+    staging_db (str): The path to the staging database.
+    patients (set): The IDs of the finished patients.
+    mapping_files (set): The filenames of the finished column-wise mapping tables.
+    column_mapping_files (set): The filenames of all column-wise mapping tables, the others are transformed per patient.
+
+    Returns:
+    int: The number of removed rows.
+    """
+    conn = get_staging_connection(staging_db)
+    with STAGING_LOCK:
+        with conn:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS finished(kind TEXT, key TEXT)")
+            conn.execute("DELETE FROM finished")
+            conn.executemany("INSERT INTO finished VALUES ('patient', ?)", [(patient,) for patient in patients])
+            conn.executemany("INSERT INTO finished VALUES ('table', ?)", [(mapping_file,) for mapping_file in mapping_files])
+            conn.executemany("INSERT INTO finished VALUES ('column', ?)", [(mapping_file,) for mapping_file in column_mapping_files])
+            removed = conn.execute("""DELETE FROM staged_rows WHERE CASE
+                                      WHEN mapping_file IN (SELECT key FROM finished WHERE kind = 'column')
+                                      THEN mapping_file NOT IN (SELECT key FROM finished WHERE kind = 'table')
+                                      ELSE patient_id NOT IN (SELECT key FROM finished WHERE kind = 'patient') END""").rowcount
+    return removed
+
+def list_staged_entities(staging_db):
+    """
+    This function lists the entities with staged rows, in load order (level of the mapping plan, then name).
+
+    Args:
+    staging_db (str): The path to the staging database.
+
+    Returns:
+    list: Tuples of (level, entity name).
+    """
+    conn = get_staging_connection(staging_db)
+    with STAGING_LOCK:
+        entities = conn.execute("SELECT level, MIN(entity) FROM staged_rows GROUP BY level, lower(entity) ORDER BY level, lower(entity)").fetchall()
+    return entities
+
+def count_staged_rows(staging_db):
+    """
+    This function counts the staged rows per entity, the number of insert statements the transformation produced.
+
+    Args:
+    staging_db (str): The path to the staging database.
+
+    Returns:
+    dict: The number of rows per entity (lower case).
+    """
+    conn = get_staging_connection(staging_db)
+    with STAGING_LOCK:
+        counts = conn.execute("SELECT lower(entity), COUNT(*) FROM staged_rows GROUP BY lower(entity)").fetchall()
+    return dict(counts)
+
+def assign_patient_shards(staging_db, shard_count):
+    """
+    This function assigns the patients of the staged rows to shards, for a sharded load.
+    The patients are assigned one by one, the patients with the most rows first, to the shard with the fewest rows,
+    so the shards are about the same size. The assignment only depends on the staged rows, a resumed run gets the same shards.
+
+    Args:
+    staging_db (str): The path to the staging database.
+    shard_count (int): The number of shards.
+
+    Returns:
+    list: The number of rows per shard.
+    """
+    conn = get_staging_connection(staging_db)
+    with STAGING_LOCK:
+        patients = conn.execute("SELECT patient_id, COUNT(*) AS n FROM staged_rows GROUP BY patient_id ORDER BY n DESC, patient_id").fetchall()
+        shard_rows = [0] * shard_count
+        assignment = []
+        for patient_id, count in patients:
+            shard = shard_rows.index(min(shard_rows))
+            shard_rows[shard] += count
+            assignment.append((patient_id, shard))
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS patient_shards(patient_id TEXT PRIMARY KEY, shard INTEGER NOT NULL)")
+            conn.execute("DELETE FROM patient_shards")
+            conn.executemany("INSERT INTO patient_shards VALUES (?, ?)", assignment)
+    return shard_rows
+
+def read_staged_rows(staging_db, entity, batch_size, shard=None):
+    """
+    This function reads the staged rows of an entity sequentially, in the order they were staged.
+
+    Args:
+    staging_db (str): The path to the staging database.
+    entity (str): The name of the entity (case insensitive).
+    batch_size (int): The number of rows per batch.
+    shard (int): Only read the rows of the patients of this shard (see assign_patient_shards), or None for all rows.
+
+    Yields:
+    list: Tuples of (id, patient_id, row) of one batch, row being a dict of attribute -> value.
+    """
+    conn = get_staging_connection(staging_db)
+    query = "SELECT id, patient_id, row FROM staged_rows WHERE lower(entity) = lower(?) AND id > ?"
+    if shard is not None:
+        query += f" AND patient_id IN (SELECT patient_id FROM patient_shards WHERE shard = {int(shard)})"
+    query += " ORDER BY id LIMIT ?"
+    last_id = 0
+    while True:
+        with STAGING_LOCK:
+            batch = conn.execute(query, (entity, last_id, batch_size)).fetchall()
+        if not batch:
+            return
+        last_id = batch[-1][0]
+        yield [(row_id, patient_id, json.loads(row)) for row_id, patient_id, row in batch]
+
+def read_patient_rows(staging_db, patient_id):
+    """
+    This function reads the staged rows of one patient, to inspect the result of the transformation of a patient.
+
+    Args:
+    staging_db (str): The path to the staging database.
+    patient_id (str): The ID of the patient.
+
+    Returns:
+    list: Tuples of (entity, mapping_file, row), row being a dict of attribute -> value.
+    """
+    conn = get_staging_connection(staging_db)
+    with STAGING_LOCK:
+        rows = conn.execute("SELECT entity, mapping_file, row FROM staged_rows WHERE patient_id = ? ORDER BY level, id", (str(patient_id),)).fetchall()
+    return [(entity, mapping_file, json.loads(row)) for entity, mapping_file, row in rows]
+
+def close_staging(staging_db):
+    """
+    This function closes the connection to a staging database.
+
+    Args:
+    staging_db (str): The path to the staging database.
+
+    Returns:
+    None
+    """
+    with STAGING_LOCK:
+        if staging_db in STAGING_CONNECTIONS:
+            STAGING_CONNECTIONS.pop(staging_db).close()
@@ -0,0 +1,72 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from PyUtilities.databaseFunctions import (CONNECTIONS, close_connections, get_connection, coerce_values, execute_insert_statements, execute_sql_script,
+                                           deduplicate_rows, execute_sql_statement, generate_parameterized_insert, generate_search_statement,
+                                           read_column_types, read_schema, resolve_search_values)
+
+SCHEMA = """
+CREATE TABLE addr (id INTEGER PRIMARY KEY, zip TEXT NOT NULL);
+CREATE TABLE person (id INTEGER PRIMARY KEY, addr_id INTEGER NOT NULL REFERENCES addr(id));
+"""
+
+class SearchStatementTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.directory.name, 'test.db')
+        schema_file = os.path.join(self.directory.name, 'schema.sql')
+        with open(schema_file, 'w') as file:
+            file.write(SCHEMA)
+        execute_sql_script(SCHEMA, self.db_file)
+        self.column_types = read_column_types(read_schema(schema_file))
+        # A zero-padded key of a TEXT column is stored as text
+        rows = coerce_values([{'zip': '00123'}], self.column_types['addr'])
+        execute_insert_statements([generate_parameterized_insert('addr', row, self.column_types) for row in rows], self.db_file)
+
+    def tearDown(self):
+        close_connections()
+        self.directory.cleanup()
+
+    def test_zero_padded_text_key_is_resolved(self):
+        rows = [{'addr_id': generate_search_statement('id', 'addr', ['zip'], ['00123'])}]
+        resolved = resolve_search_values(self.db_file, 'person', rows, self.column_types)
+        self.assertEqual(resolved, [{'addr_id': 1}])
+
+    def test_zero_padded_text_key_is_found_by_the_insert(self):
+        row = {'addr_id': generate_search_statement('id', 'addr', ['zip'], ['00123'])}
+        outcomes = execute_insert_statements([generate_parameterized_insert('person', row, self.column_types)], self.db_file)
+        self.assertEqual(outcomes, ['inserted'])
+        self.assertEqual(execute_sql_statement("SELECT addr_id FROM person", self.db_file), [(1,)])
+
+class DeduplicateRowsTest(unittest.TestCase):
+
+    SCHEMA = {'visit': {'name': 'visit', 'columns': ['id', 'code'], 'types': {'id': 'INTEGER', 'code': 'TEXT'},
+                        'notnull': set(), 'primary_key': ['id'], 'foreign_keys': [], 'unique': [['code']]}}
+
+    def test_equal_keys_are_dropped(self):
+        rows, dropped = deduplicate_rows('visit', [{'code': 'a'}, {'code': 'a'}], self.SCHEMA)
+        self.assertEqual((rows, dropped), ([{'code': 'a'}], 1))
+
+    def test_null_and_unresolved_keys_are_kept(self):
+        search = generate_search_statement('code', 'other', ['id'], ['1'])
+        rows = [{'code': None}, {'code': None}, {'code': search}, {'code': search}]
+        self.assertEqual(deduplicate_rows('visit', rows, self.SCHEMA), (rows, 0))
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def test_connections_of_ended_threads_are_closed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            db_file = os.path.join(directory, 'test.db')
+            thread = threading.Thread(target=get_connection, args=(db_file,))
+            thread.start()
+            thread.join()
+            self.assertFalse([key for key in CONNECTIONS if key[1] == os.path.abspath(db_file)])
+
+if __name__ == '__main__':
+    unittest.main()
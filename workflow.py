@@ -1,8 +1,31 @@
-from ETL.Extract.extract import extract_data
+from ETL.Extract.extract import extract_data, read_data_dictionary, KEEP_SNAPSHOTS
+from ETL.Transform.mapping_validator import validate_mappings
 from ETL.Transform.transform import transform_data
 from ETL.Load.load import load_data
+from ETL.Transform.planner import compute_table_hashes, compile_mapping_plan, MappingPlanError
+from ETL.Transform.estimator import estimate_run, format_estimate, write_estimate
+from PyUtilities.setupFunctions import read_config_file, compute_input_hash, list_mapping_files, list_project_configs, project_context
+from PyUtilities.journalFunctions import open_run_journal, finish_run_journal
+from PyUtilities.memoryFunctions import peak_rss_mb
 
+import argparse
+import concurrent.futures
+import contextlib
+import json
 import logging
+import os
+import signal
+import socket
+import threading
+import time
+try:
+  import fcntl
+except ImportError:
+  # fcntl is not available on Windows, runs are then only protected within one process
+  fcntl = None
+
+CONFIG_FILE_PATH = 'config.json'
+CONFIG = read_config_file(CONFIG_FILE_PATH)
 
 # Configure logger
 workflow_logger = logging.getLogger('workflow_logger')
@@ -12,25 +35,417 @@ formatter = logging.Formatter('%(asctime)-20s - %(levelname)-10s - %(filename)-2
 file_handler1.setFormatter(formatter)
 workflow_logger.addHandler(file_handler1)
 
+# Seconds a trigger client has to send its command (see serve_trigger_socket)
+TRIGGER_TIMEOUT = 5
+
+# Locks to prevent overlapping runs (of the same data path) within this process
+RUN_LOCKS = {}
+RUN_LOCKS_LOCK = threading.Lock()
+
+# Threads of the projects, created on first use and reused by every run of a daemon (see run_projects)
+PROJECT_POOL = {'executor': None}
+
 # Main Workflow
-def main_workflow():
+def main_workflow(previous_input_hash=None, metrics=None):
   """
   This function is the main workflow of the ETL process.
-  It calls the extract_data, transform_data, and load_data functions.
+  It checks the mapping tables (see validate_mappings) and calls the extract_data, transform_data, and load_data functions.
+  If the mapping tables cannot be compiled into a plan (e.g. a cycle in their dependencies), the run is skipped.
+  Runs never overlap: if another run is still in progress (in this or another process), this run is skipped.
+
+  Args:
+  previous_input_hash (str): Fingerprint of the input of the last successful run.
+                             If the data, mappings and schema did not change since, transform and load are skipped.
+  metrics (dict): If given, the durations of the steps (seconds), the numbers of records and transformed patients
+                  and the latency of the patients (see transform_data) are added to it.
+
+  Returns:
+  str: The fingerprint of the input of this run.
+  """
+  metrics = {} if metrics is None else metrics
+  with workflow_lock() as acquired:
+    if not acquired:
+      workflow_logger.warning("Another workflow run is still in progress, this run is skipped.")
+      metrics['status'] = 'skipped'
+      return previous_input_hash
+
+    # Log the start of the workflow
+    workflow_logger.info("Workflow started.")
+    # Check the mapping tables and compile the mapping plan before any data is processed
+    validate_mappings(read_data_dictionary())
+    try:
+      compile_mapping_plan()
+    except MappingPlanError as e:
+      workflow_logger.error("%s, the run is skipped.", e)
+      metrics['status'] = 'failed'
+      return previous_input_hash
+    # Extract data
+    started = time.monotonic()
+    extracted_data = extract_data()
+    metrics['extract_seconds'] = round(time.monotonic() - started, 3)
+    metrics['records'] = int(extracted_data.iloc[:, 0].nunique())
+    workflow_logger.info("Data extracted successfully.")
+
+    # Skip the run if nothing changed since the last one
+    input_hash = compute_input_hash(extracted_data, input_files())
+    if input_hash == previous_input_hash:
+      workflow_logger.info("Source data, mappings and schema unchanged since the last run, nothing to do.")
+      metrics['status'] = 'unchanged'
+      return input_hash
+
+    # Open the run journal, an unfinished run with the same input continues from its last checkpoint
+    journal = open_run_journal(os.path.join(CONFIG['data_path'], 'run_journal.jsonl'), input_hash)
+
+    # Select the tables to recompute, if only mapping tables changed since the last run
+    base_hash = compute_input_hash(extracted_data, [CONFIG['db_schema']] if CONFIG['db_schema'] is not None else [])
+    table_hashes = compute_table_hashes()
+    tables = select_changed_tables(base_hash, table_hashes)
+    if tables is None:
+      # The state of the tables is only valid again once all tables are rebuilt
+      remove_table_state()
+    metrics['tables'] = 'all' if tables is None else sorted(tables)
+
+    # Transform data
+    started = time.monotonic()
+    metrics['patients_transformed'] = transform_data(extracted_data, journal, tables, metrics)
+    # The extracted data is not needed by the load, it is freed before (unless kept as the snapshot of a daemon)
+    del extracted_data
+    metrics['transform_seconds'] = round(time.monotonic() - started, 3)
+    workflow_logger.info("Data transformed successfully.")
+
+    # Load data
+    started = time.monotonic()
+    load_data(journal, tables)
+    metrics['load_seconds'] = round(time.monotonic() - started, 3)
+    if not is_subset_configured():
+      write_table_state(base_hash, table_hashes)
+    finish_run_journal(journal)
+    metrics['status'] = 'finished'
+    workflow_logger.info("Workflow finished successfully.")
+    return input_hash
+
+def dry_run_workflow():
+  """
+  Function of a dry run: it checks the mapping tables and extracts the data like a run, and estimates the run from the
+  compiled mapping plan and statistics of the extracted data (see estimate_run) instead of transforming and loading.
+  Nothing is written to the database, the staging database, the run journal or the table state.
+  The report is printed and written to {data_path}/dry_run_report.json.
+
+  Returns:
+  dict: The report.
   """
-  # Log the start of the workflow
-  workflow_logger.info("Workflow started.")
-  # Extract data
+  validate_mappings(read_data_dictionary())
   extracted_data = extract_data()
-  workflow_logger.info("Data extracted successfully.")
-  
-  # Transform data
-  transform_data(extracted_data)
-  workflow_logger.info("Data transformed successfully.")
+  # The tables a run would recompute (see select_changed_tables)
+  base_hash = compute_input_hash(extracted_data, [CONFIG['db_schema']] if CONFIG['db_schema'] is not None else [])
+  tables = select_changed_tables(base_hash, compute_table_hashes())
+  report = estimate_run(extracted_data, tables)
+  print(format_estimate(report))
+  write_estimate(report, os.path.join(CONFIG['data_path'], 'dry_run_report.json'))
+  return report
+
+def dry_run_projects(projects):
+  """
+  Function to run a dry run (see dry_run_workflow) for every project, one after the other.
+
+  Args:
+  projects (list): The configurations of the projects, see list_project_configs.
+  """
+  for project in projects:
+    with project_context(project):
+      print(f"Project {project['name']}:")
+      try:
+        dry_run_workflow()
+      except SystemExit:
+        workflow_logger.error("Dry run of project %s aborted.", project['name'])
+      except MappingPlanError as e:
+        workflow_logger.error("Dry run of project %s aborted: %s", project['name'], e)
+
+def select_changed_tables(base_hash, table_hashes):
+  """
+  Function to select the tables a run has to recompute, by the state of the last successful run (see write_table_state).
+  If only mapping tables changed, only the tables whose fingerprint changed (see compute_table_hashes, the tables downstream
+  of a changed mapping table are included) and the tables which are no longer mapped are reloaded, the other rows stay in the database.
+  All tables are rebuilt if the extracted data or the schema changed, if there is no state for the database,
+  if the database is not rebuilt by every run (db_creation and db_wipe), in subset runs or with db_incremental set to false.
+
+  Args:
+  base_hash (str): The fingerprint of the extracted data and the schema.
+  table_hashes (dict): The fingerprints of the tables.
+
+  Returns:
+  set: The tables (lower case) to recompute, or None for all tables.
+  """
+  if CONFIG.get('db_incremental', True) is not True or CONFIG['db_creation'] is not True or CONFIG['db_wipe'] is not True or is_subset_configured():
+    return None
+  state = read_table_state()
+  if state is None or state['base_hash'] != base_hash or state['db_path'] != CONFIG['db_path'] or not os.path.exists(CONFIG['db_path']):
+    return None
+  tables = {table for table, table_hash in table_hashes.items() if state['tables'].get(table) != table_hash}
+  tables.update(table for table in state['tables'] if table not in table_hashes)
+  workflow_logger.info("Only mapping tables changed, recomputing the tables: %s", sorted(tables))
+  return tables
+
+def table_state_path():
+  """
+  Function to get the path of the table state file in the data path.
+  """
+  return os.path.join(CONFIG['data_path'], 'table_state.json')
+
+def read_table_state():
+  """
+  Function to read the table state of the last successful run.
+
+  Returns:
+  dict: The state with the keys base_hash, db_path and tables (fingerprint per table), or None if there is none.
+  """
+  try:
+    with open(table_state_path(), 'r') as file:
+      return json.load(file)
+  except (FileNotFoundError, json.JSONDecodeError):
+    return None
+
+def write_table_state(base_hash, table_hashes):
+  """
+  Function to write the table state of a successful run: the fingerprints of the data and schema and of every table.
+
+  Args:
+  base_hash (str): The fingerprint of the extracted data and the schema.
+  table_hashes (dict): The fingerprints of the tables.
+  """
+  with open(table_state_path() + '.tmp', 'w') as file:
+    json.dump({'base_hash': base_hash, 'db_path': CONFIG['db_path'], 'tables': table_hashes}, file, indent=2)
+  os.replace(table_state_path() + '.tmp', table_state_path())
+
+def remove_table_state():
+  """
+  Function to remove the table state, before all tables are rebuilt.
+  """
+  if os.path.exists(table_state_path()):
+    os.remove(table_state_path())
+
+def run_projects(projects, previous_input_hashes=None):
+  """
+  This function runs the workflow of several projects in one process, each project in its own thread.
+  The projects share the limit of concurrent extractions (max_concurrent_extractions), the transform worker pool
+  (split evenly between the projects transforming at the same time) and one loader per database.
+  The threads of the projects are reused by the next run of a daemon. A failing project does not stop the others. The metrics of each run are logged and written to {data_path}/run_metrics.json,
+  with the peak memory of the process (shared by the projects) and the memory budget (memory_budget_mb).
+
+  Args:
+  projects (list): The configurations of the projects, see list_project_configs.
+  previous_input_hashes (dict): Per project name, the fingerprint of the input of its last successful run.
+
+  Returns:
+  dict: Per project name, the fingerprint of the input of its last successful run.
+  """
+  previous_input_hashes = previous_input_hashes or {}
+  input_hashes = dict(previous_input_hashes)
+
+  def run_project(project):
+    with project_context(project):
+      metrics = {'project': project['name'], 'status': 'failed'}
+      started = time.monotonic()
+      try:
+        input_hashes[project['name']] = main_workflow(previous_input_hashes.get(project['name']), metrics)
+      except SystemExit:
+        workflow_logger.error("Workflow run of project %s aborted.", project['name'])
+      except Exception:
+        workflow_logger.exception("Workflow run of project %s failed.", project['name'])
+      metrics['total_seconds'] = round(time.monotonic() - started, 3)
+      peak = peak_rss_mb()
+      metrics['peak_rss_mb'] = round(peak, 1) if peak is not None else None
+      metrics['memory_budget_mb'] = CONFIG.get('memory_budget_mb')
+      if metrics['memory_budget_mb'] and peak is not None and peak > metrics['memory_budget_mb']:
+        workflow_logger.warning("Project %s: peak memory %s MB over the memory budget of %s MB", project['name'], metrics['peak_rss_mb'], metrics['memory_budget_mb'])
+      workflow_logger.info("Project %s: %s", project['name'], metrics)
+      if CONFIG['data_path'] is not None and os.path.isdir(CONFIG['data_path']):
+        with open(os.path.join(CONFIG['data_path'], 'run_metrics.json'), 'w') as file:
+          json.dump(metrics, file, indent=2)
+
+  if len(projects) == 1:
+    run_project(projects[0])
+    return input_hashes
+  if PROJECT_POOL['executor'] is None:
+    PROJECT_POOL['executor'] = concurrent.futures.ThreadPoolExecutor(len(projects), thread_name_prefix='project')
+  list(PROJECT_POOL['executor'].map(run_project, projects))
+  return input_hashes
+
+def input_files():
+  """
+  Function to list the files besides the extracted data a run depends on: the mapping tables and the database schema.
+  """
+  files = list_mapping_files(CONFIG['mapping_path'])
+  if CONFIG['db_schema'] is not None:
+    files.append(CONFIG['db_schema'])
+  return files
+
+def apply_subset_options(args):
+  """
+  Function to apply the subset options of the command line, they override the subset keys of the config file (of all projects):
+  subset_records (list of record IDs), subset_sample (number of random records, subset_seed), subset_first (number of records)
+  and subset_tables (entities, with the entities they depend on).
+
+  Args:
+  args (argparse.Namespace): The parsed command line options.
+  """
+  options = {'subset_records': args.records, 'subset_sample': args.sample, 'subset_first': args.first,
+             'subset_seed': args.seed, 'subset_tables': args.tables, 'scratch_db': args.scratch_db}
+  CONFIG.update({key: value for key, value in options.items() if value is not None})
+
+def configure_subset_run():
+  """
+  Function to configure a subset run, to test mapping tables on a part of the data (see apply_subset_options).
+  A subset run works in the Scratch folder of the data path and writes into a new scratch database (scratch_db),
+  so the data and the database of the full runs are not touched.
+  Within project_context, the run of the project is configured.
+  """
+  if not is_subset_configured():
+    return
+
+  scratch_path = os.path.join(CONFIG['data_path'], 'Scratch')
+  os.makedirs(scratch_path, exist_ok=True)
+  CONFIG['data_path'] = scratch_path
+  CONFIG['db_path'] = CONFIG.get('scratch_db') or os.path.join(scratch_path, 'scratch.db')
+  CONFIG['db_creation'] = True
+  CONFIG['db_wipe'] = True
+  # The extraction from REDCap must not overwrite the extraction file of the full runs
+  if CONFIG['extract_redcap'] is True:
+    CONFIG['extraction_path'] = os.path.join(scratch_path, 'extraction.csv')
+  workflow_logger.info("Subset run in %s, writing into %s", scratch_path, CONFIG['db_path'])
+
+def is_subset_configured():
+  """
+  Function to check if the run is a subset run (see configure_subset_run).
+  """
+  return any(CONFIG.get(key) for key in ('subset_records', 'subset_sample', 'subset_first', 'subset_tables'))
 
-  # Load data
-  load_data()
-  workflow_logger.info("Workflow finished successfully.")
+@contextlib.contextmanager
+def workflow_lock():
+  """
+  Context manager to protect a run against overlapping runs.
+  It takes the in-process lock and a file lock in the data path, which also protects against runs of other processes (e.g. cron).
+  Runs of projects with different data paths do not block each other.
+  Yields True if the locks were acquired, False otherwise.
+  """
+  with RUN_LOCKS_LOCK:
+    run_lock = RUN_LOCKS.setdefault(os.path.abspath(CONFIG['data_path']), threading.Lock())
+  if not run_lock.acquire(blocking=False):
+    yield False
+    return
+  try:
+    if fcntl is None:
+      yield True
+      return
+    os.makedirs(CONFIG['data_path'], exist_ok=True)
+    with open(os.path.join(CONFIG['data_path'], 'workflow.lock'), 'w') as lock_file:
+      try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        yield False
+        return
+      try:
+        yield True
+      finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+  finally:
+    run_lock.release()
+
+# Daemon mode
+def run_daemon(projects):
+  """
+  This function runs the workflow as a long-running daemon with an internal scheduler.
+  The process stays alive between runs, so imports, parsed mapping tables and the extraction snapshot stay warm
+  (the snapshot is not kept with a memory budget, see extract_project_data).
+  A run is started at startup, every daemon_interval_hours hours and on demand:
+  - on SIGUSR1,
+  - on a "run" or "force" command sent to the daemon_socket (see --trigger).
+  Runs whose input did not change since the last successful run are skipped, unless forced.
+  SIGTERM or SIGINT stop the daemon after the current run.
+
+  Args:
+  projects (list): The configurations of the projects, see list_project_configs.
+  """
+  interval = CONFIG.get('daemon_interval_hours', 6) * 3600
+  KEEP_SNAPSHOTS.set()
+  trigger = threading.Event()
+  stop = threading.Event()
+  state = {'force': False}
+
+  def request_stop(signum, frame):
+    stop.set()
+    trigger.set()
+  signal.signal(signal.SIGUSR1, lambda signum, frame: trigger.set())
+  signal.signal(signal.SIGTERM, request_stop)
+  signal.signal(signal.SIGINT, request_stop)
+
+  if CONFIG.get('daemon_socket'):
+    serve_trigger_socket(CONFIG['daemon_socket'], trigger, state)
+
+  workflow_logger.info("Daemon started, running every %s hours.", interval / 3600)
+  input_hashes = {}
+  next_run = time.monotonic()
+  while not stop.is_set():
+    trigger.wait(timeout=max(0, next_run - time.monotonic()))
+    if stop.is_set():
+      break
+    trigger.clear()
+    force = state['force']
+    state['force'] = False
+    input_hashes = run_projects(projects, None if force else input_hashes)
+    next_run = time.monotonic() + interval
+  workflow_logger.info("Daemon stopped.")
+
+def serve_trigger_socket(socket_path, trigger, state):
+  """
+  Function to listen on a local (unix) socket for on-demand triggers in a background thread.
+  Accepted commands are "run" (run if the input changed) and "force" (run in any case).
+  A client has TRIGGER_TIMEOUT seconds to send its command, failing connections are logged and skipped.
+
+  Args:
+  socket_path (str): The path of the socket.
+  trigger (threading.Event): The event waking up the scheduler.
+  state (dict): The scheduler state, "force" is set for forced runs.
+  """
+  if os.path.exists(socket_path):
+    os.remove(socket_path)
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  server.bind(socket_path)
+  server.listen()
+
+  def serve():
+    while True:
+      connection, _ = server.accept()
+      # A client which fails (closes early, never sends a command) must not stop the triggers of the other clients
+      try:
+        with connection:
+          connection.settimeout(TRIGGER_TIMEOUT)
+          command = connection.recv(64).decode('utf-8', errors='replace').strip()
+          if command in ('run', 'force'):
+            state['force'] = state['force'] or command == 'force'
+            trigger.set()
+            connection.sendall(b"queued\n")
+          else:
+            connection.sendall(b"unknown command\n")
+      except OSError as e:
+        workflow_logger.warning("Trigger connection failed: %s", e)
+  threading.Thread(target=serve, name='trigger-socket', daemon=True).start()
+  workflow_logger.info("Listening for triggers on %s", socket_path)
+
+def send_trigger(command):
+  """
+  Function to send a trigger command to a running daemon over the daemon_socket.
+
+  Args:
+  command (str): "run" or "force".
+
+  Returns:
+  str: The answer of the daemon.
+  """
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+    client.connect(CONFIG['daemon_socket'])
+    client.sendall(command.encode('utf-8'))
+    return client.recv(64).decode('utf-8').strip()
 
 # Main program
 if __name__ == "__main__":
@@ -41,5 +456,34 @@ if __name__ == "__main__":
   2) Transform the data, according to the mapping rules.
   3) (Optional) Create the SQLite Database
   4) Load the transformed data into the destination database. SQLite in this case.
+  With --daemon the workflow is repeated by an internal scheduler instead of cron.
+  With --records, --sample or --first (and --tables) only a part of the data is processed, into a scratch database.
+  With a "projects" list in the config file, the projects are run together in this process (see run_projects).
+  With --dry-run the run is only estimated (see dry_run_workflow), nothing is written to the database.
   """
-  main_workflow()
+  parser = argparse.ArgumentParser(description="REDCap to SQLite ETL workflow")
+  parser.add_argument('--daemon', action='store_true', help="run as a long-running daemon with an internal scheduler")
+  parser.add_argument('--trigger', nargs='?', const='run', choices=['run', 'force'], help="trigger a run of a running daemon")
+  parser.add_argument('--dry-run', dest='dry_run', action='store_true', help="estimate the rows, SRCH lookups and bytes of a run and show its plan, without writing to the database")
+  subset = parser.add_mutually_exclusive_group()
+  subset.add_argument('--records', type=lambda value: value.split(','), help="only process these records (comma separated IDs)")
+  subset.add_argument('--sample', type=int, help="only process a random sample of this many records")
+  subset.add_argument('--first', type=int, help="only process the first records")
+  parser.add_argument('--seed', type=int, help="seed of the random sample")
+  parser.add_argument('--tables', type=lambda value: value.split(','), help="only create these entities (comma separated), and the entities they depend on")
+  parser.add_argument('--scratch-db', dest='scratch_db', help="the database of a subset run (default: Scratch/scratch.db in the data path)")
+  args = parser.parse_args()
+  apply_subset_options(args)
+  projects = list_project_configs(CONFIG)
+  for project in projects:
+    with project_context(project):
+      configure_subset_run()
+
+  if args.trigger:
+    print(send_trigger(args.trigger))
+  elif args.dry_run:
+    dry_run_projects(projects)
+  elif args.daemon:
+    run_daemon(projects)
+  else:
+    run_projects(projects)